@@ -14,15 +14,280 @@ Web Services using Python and MongoDB
     can implement CRUD operations with our API.
 '''
 
+import argparse
+import atexit
+import base64
+import bisect
+import codecs
+import contextlib
+import copy
+import datetime
+import functools
+import hashlib
+import importlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
 import flask
 from flask import request, jsonify
 import pymongo
+from pymongo import monitoring, DeleteMany, DeleteOne, InsertOne, ReturnDocument, \
+    UpdateMany, UpdateOne
+from pymongo.write_concern import WriteConcern
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+import bson
+from bson import json_util
+from bson.objectid import ObjectId
+
+import snapshot_mongo
+
+# Our routes hang off a Blueprint instead of a Flask object.  The
+# Flask object is made by create_app() at the very bottom of this file,
+# that way a server like gunicorn can build one in every worker process
+
+api = flask.Blueprint('api', __name__)
+log = logging.getLogger(__name__)
+
+# Settings can be overridden with environment variables of the
+# same name, so the same code runs on your laptop and a server
+
+def from_env(name, default, cast=int):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return cast(value)
+
+
+TRUE_STRINGS = ('1', 'true', 'yes', 'on')
+FALSE_STRINGS = ('0', 'false', 'no', 'off')
+
+
+def to_bool(value):
+    value = value.lower()
+    if value in TRUE_STRINGS:
+        return True
+    if value in FALSE_STRINGS:
+        return False
+    raise ValueError("not a boolean: %r" % value)
+
+
+def to_namespaces(value):
+    # "apitest.v1, titanic.guests," -> ['apitest.v1', 'titanic.guests']
+    return [namespace.strip() for namespace in value.split(',')
+            if '.' in namespace.strip()]
+
+# Every setting the API understands and its default.  create_app()
+# copies these into app.config, hand it a dict to change any of them
+settings = flask.Config(os.path.dirname(os.path.abspath(__file__)))
+
+# Debug mode is handy while you write code, but it's slow and it lets
+# anyone run Python on your server from the error page, so it's off
+# unless you ask for it
+settings["DEBUG"] = from_env("DEBUG", False, to_bool)
+
+# MongoDB connection pool, all timeouts are in milliseconds and
+# None means "use the driver default"
+settings["MONGO_URI"] = from_env("MONGO_URI", "mongodb://localhost:27017", str)
+settings["MONGO_MAX_POOL_SIZE"] = from_env("MONGO_MAX_POOL_SIZE", 100)
+settings["MONGO_MIN_POOL_SIZE"] = from_env("MONGO_MIN_POOL_SIZE", 0)
+settings["MONGO_CONNECT_TIMEOUT_MS"] = from_env("MONGO_CONNECT_TIMEOUT_MS", 5000)
+settings["MONGO_SERVER_SELECTION_TIMEOUT_MS"] = from_env("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)
+settings["MONGO_SOCKET_TIMEOUT_MS"] = from_env("MONGO_SOCKET_TIMEOUT_MS", None)
+settings["MONGO_WAIT_QUEUE_TIMEOUT_MS"] = from_env("MONGO_WAIT_QUEUE_TIMEOUT_MS", None)
+
+# How many documents we pull from the cursor and encode at a time
+# when streaming results back to the client
+settings["FIND_BATCH_SIZE"] = from_env("FIND_BATCH_SIZE", 500)
+
+# The most rows a single find may return.  Bigger pages are refused,
+# and so are queries without a limit that would match more than this
+settings["FIND_MAX_ROWS"] = from_env("FIND_MAX_ROWS", 1000)
+
+# Fields (besides _id) that clients may page through with ?sort=
+# Index them!  Paging on an unindexed key is a scan every page
+settings["FIND_SORT_KEYS"] = from_env("FIND_SORT_KEYS", [], lambda v: v.split(','))
+
+# Read find results as raw BSON batches, BSON answers are passed
+# through without decoding and JSON is encoded a batch at a time.
+# Switch it off for stand-ins (mongomock) that don't have find_raw_batches
+settings["FIND_RAW_BATCHES"] = from_env("FIND_RAW_BATCHES", True, to_bool)
+
+# What type each field is stored as, per "database.collection", so
+# query strings like ?age=30 can be turned into numbers before they
+# reach MongoDB.  Fields that aren't listed are compared as strings
+settings["FIELD_TYPES"] = from_env("FIELD_TYPES", {
+    'apitest.v1': {
+        'survived': 'int',
+        'class': 'int',
+        'age': 'float',
+        'siblings_spouses': 'int',
+        'parents_children': 'int',
+        'fare_paid': 'float',
+        'name': 'str',
+        'gender': 'str',
+        'ticket_number': 'str',
+        'point_of_embarkation': 'str',
+    },
+}, json.loads)
+
+# How many compiled query strings we remember
+settings["QUERY_CACHE_SIZE"] = from_env("QUERY_CACHE_SIZE", 1024)
+
+# Indexes we want on each "database.collection".  Each one is a list
+# of fields (prefix with - for descending) or a dict with 'keys' and
+# any create_index() options.  They are created when the app starts
+settings["MONGO_INDEXES"] = from_env("MONGO_INDEXES", {
+    'apitest.v1': [
+        ['survived', 'age'],
+        ['class', 'gender'],
+        ['parents_children'],
+        ['age'],
+    ],
+}, json.loads)
+settings["MONGO_ENSURE_INDEXES"] = from_env("MONGO_ENSURE_INDEXES", True, to_bool)
+
+# The advisor remembers at most this many different filter shapes
+settings["ADVISOR_MAX_SHAPES"] = from_env("ADVISOR_MAX_SHAPES", 500)
+
+# Cache find results in memory.  Writes through this API clear the
+# collection's entries, writes from anywhere else show up after TTL
+# seconds at the latest.  RESULT_CACHE_SHARED adds a second tier
+# shared by every worker: 'local' for the in-process stand-in, or a
+# redis:// URL (needs the redis package)
+settings["RESULT_CACHE_ENABLED"] = from_env("RESULT_CACHE_ENABLED", True, to_bool)
+settings["RESULT_CACHE_TTL"] = from_env("RESULT_CACHE_TTL", 10.0, float)
+settings["RESULT_CACHE_MAX_ENTRIES"] = from_env("RESULT_CACHE_MAX_ENTRIES", 1024)
+settings["RESULT_CACHE_MAX_ENTRY_BYTES"] = from_env("RESULT_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+settings["RESULT_CACHE_SHARED"] = from_env("RESULT_CACHE_SHARED", '', str)
+
+# Identical finds that arrive while one is already running wait for it
+# and share its answer instead of asking MongoDB again.  A follower
+# gives up on a leader that hasn't sent anything new in
+# SINGLE_FLIGHT_WAIT seconds and asks MongoDB itself
+settings["SINGLE_FLIGHT_ENABLED"] = from_env("SINGLE_FLIGHT_ENABLED", True, to_bool)
+settings["SINGLE_FLIGHT_WAIT"] = from_env("SINGLE_FLIGHT_WAIT", 30.0, float)
+
+# Find answers carry an ETag and Last-Modified, a client that sends them
+# back gets 304 Not Modified while the collection hasn't changed.  Each
+# namespace in VERSION_CHANGE_STREAMS is watched with a change stream
+# (needs a replica set), so writes from anywhere change the ETag at once,
+# otherwise they do within RESULT_CACHE_TTL seconds like the cache
+settings["FIND_ETAGS"] = from_env("FIND_ETAGS", True, to_bool)
+settings["VERSION_CHANGE_STREAMS"] = from_env("VERSION_CHANGE_STREAMS", [],
+                                              to_namespaces)
+
+# Compress find answers with brotli (needs the brotli package) or gzip,
+# whichever the client's Accept-Encoding prefers.  Answers that aren't
+# streamed are only compressed from COMPRESSION_MIN_BYTES up
+settings["COMPRESSION_ENABLED"] = from_env("COMPRESSION_ENABLED", True, to_bool)
+settings["COMPRESSION_MIN_BYTES"] = from_env("COMPRESSION_MIN_BYTES", 1024)
+settings["COMPRESSION_GZIP_LEVEL"] = from_env("COMPRESSION_GZIP_LEVEL", 6)
+settings["COMPRESSION_BROTLI_QUALITY"] = from_env("COMPRESSION_BROTLI_QUALITY", 4)
+
+# Bulk ingest: documents per insert_many() call, the biggest single
+# document we are willing to buffer while looking for its end, and how
+# many of the batches that had failures the answer lists (the last ones)
+settings["BULK_BATCH_SIZE"] = from_env("BULK_BATCH_SIZE", 1000)
+settings["BULK_MAX_BATCH_SIZE"] = from_env("BULK_MAX_BATCH_SIZE", 10000)
+settings["BULK_MAX_DOC_BYTES"] = from_env("BULK_MAX_DOC_BYTES", 16 * 1024 * 1024)
+settings["BULK_REPORT_FAILED_BATCHES"] = from_env("BULK_REPORT_FAILED_BATCHES", 10)
+
+# Write-behind: /insert and /insertargs put documents on a queue and a
+# background thread writes them in batches, when BATCH_SIZE documents
+# are waiting or FLUSH_INTERVAL seconds after the first one arrived.
+# A full queue answers 429.  WRITE_CONCERN is the w option: 0, 1,
+# 'majority'...
+settings["WRITE_BEHIND_ENABLED"] = from_env("WRITE_BEHIND_ENABLED", False, to_bool)
+settings["WRITE_BEHIND_QUEUE_SIZE"] = from_env("WRITE_BEHIND_QUEUE_SIZE", 10000)
+settings["WRITE_BEHIND_BATCH_SIZE"] = from_env("WRITE_BEHIND_BATCH_SIZE", 500)
+settings["WRITE_BEHIND_FLUSH_INTERVAL"] = from_env("WRITE_BEHIND_FLUSH_INTERVAL", 0.5, float)
+settings["WRITE_BEHIND_WRITE_CONCERN"] = from_env("WRITE_BEHIND_WRITE_CONCERN", 1,
+                                                  lambda v: int(v) if v.isdigit() else v)
+settings["WRITE_BEHIND_DRAIN_TIMEOUT"] = from_env("WRITE_BEHIND_DRAIN_TIMEOUT", 10.0, float)
+
+# Rollups are statistics we keep up to date instead of counting them
+# every time they're asked for.  Per "database.collection", each one is
+# {'count': filter} or {'distinct': field, 'filter': filter}, and they
+# live in ROLLUP_COLLECTION in the same database.  Every
+# ROLLUP_REFRESH_INTERVAL seconds the stale ones are recounted, and all
+# of them once they're ROLLUP_MAX_AGE seconds old
+settings["ROLLUPS"] = from_env("ROLLUPS", {
+    'apitest.v1': {
+        'passengers': {'count': {}},
+        'survivors': {'count': {'survived': 1}},
+        'minors': {'count': {'age': {'$lt': 18}}},
+        'minor_survivors': {'count': {'$and': [{'survived': 1}, {'age': {'$lt': 18}}]}},
+        'named_mis': {'count': {'name': {'$regex': 'Mis'}}},
+        'no_ticket_number': {'count': {'ticket_number': {'$exists': False}}},
+        'embarkation_points': {'distinct': 'point_of_embarkation'},
+        'zero_fare_classes': {'distinct': 'class', 'filter': {'fare_paid': 0}},
+    },
+}, json.loads)
+settings["ROLLUP_COLLECTION"] = from_env("ROLLUP_COLLECTION", "rollups", str)
+settings["ROLLUP_REFRESH_INTERVAL"] = from_env("ROLLUP_REFRESH_INTERVAL", 60.0, float)
+settings["ROLLUP_MAX_AGE"] = from_env("ROLLUP_MAX_AGE", 3600.0, float)
+
+# Log queries that take longer than SLOW_QUERY_MS (below 0 logs none).
+# SLOW_QUERY_EXPLAIN_RATE of them also get explain()ed to see how many
+# documents MongoDB looked at.  The log is JSON lines in SLOW_QUERY_LOG
+# ('' for none), rotated every SLOW_QUERY_LOG_BYTES, and the last
+# SLOW_QUERY_BUFFER entries are kept in memory for the admin route
+settings["SLOW_QUERY_MS"] = from_env("SLOW_QUERY_MS", 100.0, float)
+settings["SLOW_QUERY_EXPLAIN_RATE"] = from_env("SLOW_QUERY_EXPLAIN_RATE", 0.1, float)
+settings["SLOW_QUERY_LOG"] = from_env("SLOW_QUERY_LOG", "slow_queries.log", str)
+settings["SLOW_QUERY_LOG_BYTES"] = from_env("SLOW_QUERY_LOG_BYTES", 10 * 1024 * 1024)
+settings["SLOW_QUERY_LOG_BACKUPS"] = from_env("SLOW_QUERY_LOG_BACKUPS", 5)
+settings["SLOW_QUERY_BUFFER"] = from_env("SLOW_QUERY_BUFFER", 500)
+
+# Time every phase of every request (connect, query, iterate, encode,
+# render) and count requests, errors, documents and bytes, for /metrics.
+# METRICS_BUCKETS are the histogram buckets, in seconds
+settings["METRICS_ENABLED"] = from_env("METRICS_ENABLED", True, to_bool)
+settings["METRICS_BUCKETS"] = from_env("METRICS_BUCKETS", [
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+], lambda v: [float(bucket) for bucket in v.split(',')])
+
+# Answer reads from a snapshot file instead of MongoDB when there is
+# one for the collection in SNAPSHOT_DIR ('' turns snapshots off), see
+# snapshot_mongo.py.  Workers look for a new export every
+# SNAPSHOT_CHECK_INTERVAL seconds
+settings["SNAPSHOT_DIR"] = from_env("SNAPSHOT_DIR", '', str)
+settings["SNAPSHOT_CHECK_INTERVAL"] = from_env("SNAPSHOT_CHECK_INTERVAL", 1.0, float)
+
+# How `python app.py` serves the API.  Every one of these can also be
+# given on the command line, try `python app.py --help`
+settings["SERVER_BIND"] = from_env("SERVER_BIND", "127.0.0.1:80", str)
+settings["SERVER_WORKERS"] = from_env("SERVER_WORKERS", os.cpu_count() or 1)
+settings["SERVER_THREADS"] = from_env("SERVER_THREADS", 4)
+settings["SERVER_KEEPALIVE"] = from_env("SERVER_KEEPALIVE", 5)
+settings["SERVER_TIMEOUT"] = from_env("SERVER_TIMEOUT", 60)
+settings["SERVER_GRACEFUL_TIMEOUT"] = from_env("SERVER_GRACEFUL_TIMEOUT", 30)
+
+
+def current_config():
+    # the settings of the app handling this request.  Outside of a
+    # request (background threads, app_async.py, scripts) we use the
+    # app this module builds for itself at the bottom of the file
+    if flask.has_app_context():
+        return flask.current_app.config
+    return app.config
 
-# Creating our initial Flask object and setting
-# the debug mode to something that is helpful
 
-app = flask.Flask(__name__)
-app.config["DEBUG"] = True
+def current_route():
+    # the route we are answering, None outside of a request
+    if not flask.has_request_context():
+        return None
+    return request.endpoint or 'unknown'
 
 
 
@@ -86,21 +351,194 @@ Section One:  Helper Functions
 
 
 '''
-    To connect to the MongoDB we have to establish a connection
-    This will happen anytime we perform a CRUD operation, so
-    I put it into a function to save a few lines of code.
-    In practice... we would close the session with 
-    client.close() once we are done with it.  I'm lazy and
-    don't do this in this document, however, yous should as
-    you build out your API.
-
-    It reallly is a case of 'do as I say, not as I do'.
+    To connect to the MongoDB we have to establish a connection.
+    The first version of this document built a brand new
+    MongoClient for every CRUD operation and never closed it.
+    Every client opens its own sockets and starts its own
+    monitor threads, so under load we leaked both and paid the
+    connection setup on every single request.
+
+    MongoClient already keeps a pool of connections for us, we
+    just have to stop throwing it away.  So there is now ONE
+    client per process, kept in a registry, and it hands out
+    database/collection handles that are reused between calls.
+    The pool is sized from the MONGO_* settings at the top of
+    this file.
+
+    MongoClient is not safe to share across a fork(), which is
+    exactly what gunicorn and uwsgi do when they start their
+    workers.  The registry remembers which process built the
+    client and a forked child simply builds its own.
+
+    PoolStats listens to the driver's connection pool events so
+    we can see how busy the pool is (checked out, waiting,
+    created...) and size it properly.  Look at /api/v1/mongo/pool
+
+    Set client_factory to a function that takes the config and
+    returns a client if you need a different one, bench_mongo.py
+    uses it to run against an in-memory stand-in.
 '''
+class PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.waiting = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.pool_clears = 0
+
+    def _bump(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'created': self.created,
+                'closed': self.closed,
+                'open': self.created - self.closed,
+                'checked_out': self.checked_out,
+                'waiting': self.waiting,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'pool_clears': self.pool_clears,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._bump(pool_clears=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._bump(created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._bump(closed=1)
+
+    def connection_check_out_started(self, event):
+        self._bump(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._bump(waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._bump(waiting=-1, checked_out=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._bump(checked_out=-1)
+
+
+def mongo_client_options(config):
+    # the MONGO_* settings as MongoClient keyword arguments
+    options = {
+        'maxPoolSize': config.get('MONGO_MAX_POOL_SIZE', 100),
+        'minPoolSize': config.get('MONGO_MIN_POOL_SIZE', 0),
+        'connectTimeoutMS': config.get('MONGO_CONNECT_TIMEOUT_MS'),
+        'serverSelectionTimeoutMS': config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+        'socketTimeoutMS': config.get('MONGO_SOCKET_TIMEOUT_MS'),
+        'waitQueueTimeoutMS': config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+
+class MongoRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._client = None
+        self._pid = None
+        self._handles = {}
+        self.pool_stats = PoolStats()
+        self.client_factory = None
+
+    def configure(self, config):
+        # config is any mapping with the MONGO_* keys, normally app.config.
+        # It is read when the client gets built, not when we are configured
+        self._config = config
+
+    def client(self):
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = self._build_client()
+                    self._pid = pid
+                    self._handles = {}
+        return self._client
+
+    def _build_client(self):
+        config = self._config
+        if self.client_factory is not None:
+            return self.client_factory(config)
+        return pymongo.MongoClient(
+            config.get('MONGO_URI', 'mongodb://localhost:27017'),
+            connect=False,
+            event_listeners=[self.pool_stats],
+            **mongo_client_options(config))
+
+    def collection(self, database, collection):
+        client = self.client()
+        key = (database, collection)
+        handles = self._handles
+        if key not in handles:
+            db = client[database]
+            handles[key] = (db, db[collection])
+        return handles[key]
+
+    def stats(self):
+        stats = self.pool_stats.snapshot()
+        stats['pid'] = os.getpid()
+        stats['connected'] = self._client is not None and self._pid == os.getpid()
+        stats['max_pool_size'] = self._config.get('MONGO_MAX_POOL_SIZE', 100)
+        stats['min_pool_size'] = self._config.get('MONGO_MIN_POOL_SIZE', 0)
+        stats['handles'] = len(self._handles)
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+            self._handles = {}
+
+    def _after_fork(self):
+        # the parent's sockets and locks are useless to us now, don't
+        # close() them (that would be the parent's problem), just forget them
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._handles = {}
+        self.pool_stats.reset()
+
+
+mongo_registry = MongoRegistry()
+mongo_registry.configure(settings)
+atexit.register(mongo_registry.close)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=mongo_registry._after_fork)
+
+
 def create_mongo_session(database, collection):
-    client = pymongo.MongoClient('localhost', 27017)
-    db = client[database]
-    col = db[collection]
-    return db, col
+    with metrics.timed('connect'):
+        return mongo_registry.collection(database, collection)
 
 
 
@@ -154,6 +592,99 @@ def parse_form():
 
 
 
+'''
+    request.args is full of strings, but our documents aren't.
+    ?age=30 would never match an age stored as the number 30,
+    and there was no way to ask for "younger than 18" at all,
+    so people pulled everything and filtered it themselves.
+
+    compile_query() turns a query string into a real MongoDB
+    filter.  A field on its own means equals, add __<operator>
+    for anything else:
+
+        ?age__lt=18&class__in=1,2
+        -> {'age': {'$lt': 18.0}, 'class': {'$in': [1, 2]}}
+
+    The operators are eq, ne, lt, lte, gt, gte, in, nin (comma
+    separated lists), exists (true/false) and regex, the same
+    ones we used in titanic_mongo.py.  FIELD_TYPES says what
+    type each field is, so the values get converted properly.
+
+    Dashboards send the same query strings over and over, so
+    compiled filters are cached, keyed on the sorted arguments.
+'''
+QUERY_OPERATORS = ('eq', 'ne', 'lt', 'lte', 'gt', 'gte', 'in', 'nin',
+                   'exists', 'regex')
+LIST_OPERATORS = ('in', 'nin')
+
+FIELD_CASTS = {
+    'str': str,
+    'int': int,
+    'float': float,
+    'bool': to_bool,
+    'objectid': ObjectId,
+}
+
+
+def compile_query(args, namespace='apitest.v1', ignore=()):
+    # args is request.args (or any MultiDict), ignore lists the keys
+    # that aren't part of the filter, like limit or fields
+    normalized = tuple(sorted(
+        (key, tuple(args.getlist(key))) for key in args.keys()
+        if key not in ignore))
+    try:
+        compiled = compile_normalized(namespace, normalized)
+    except (ValueError, TypeError) as e:
+        flask.abort(400, str(e))
+    # the cached filter is shared, don't let anyone change it
+    return copy.deepcopy(compiled)
+
+
+@functools.lru_cache(maxsize=settings["QUERY_CACHE_SIZE"])
+def compile_normalized(namespace, normalized):
+    types = current_config()["FIELD_TYPES"].get(namespace, {})
+    query = {}
+    for key, values in normalized:
+        field, _, op = key.partition('__')
+        op = op or 'eq'
+        if not field or field.startswith('$'):
+            raise ValueError("bad field name %r" % field)
+        if op not in QUERY_OPERATORS:
+            raise ValueError("unknown operator %r on %r" % (op, field))
+        cast = FIELD_CASTS[types.get(field, 'str')]
+        conditions = query.setdefault(field, {})
+        for value in values:
+            if op == 'exists':
+                conditions['$exists'] = to_bool(value)
+            elif op == 'regex':
+                conditions['$regex'] = value
+            elif op in LIST_OPERATORS:
+                items = [cast(item) for item in value.split(',')]
+                conditions.setdefault('$' + op, []).extend(items)
+            elif op == 'eq' and '$eq' in conditions:
+                # ?name=a&name=b means either of them
+                conditions.setdefault('$in', []).extend(
+                    [conditions.pop('$eq'), cast(value)])
+            elif op == 'eq' and '$in' in conditions:
+                conditions['$in'].append(cast(value))
+            else:
+                conditions['$' + op] = cast(value)
+    for field, conditions in query.items():
+        # plain equality reads better as {'age': 30}
+        if list(conditions) == ['$eq']:
+            query[field] = conditions['$eq']
+    return query
+
+
+
+
+
+
+
+
+
+
+
 
 
 
@@ -174,17 +705,1097 @@ def parse_form():
 
     Do as you wish!
 '''
-def mongo_find(query):
+def mongo_find(query, stream=False, fields=None, limit=None, after=None, sort=None):
+    shape_query, shape_sort = query, sort
+    batch_size = current_config()["FIND_BATCH_SIZE"]
+    sort = parse_sort(sort)
+    projection = parse_fields(fields)
+    hidden = ()
+    if limit is not None:
+        projection, hidden = page_projection(projection, sort)
+    query = dict(query)
+    position = None
+    if after is not None:
+        position = decode_after(sort, after)
+        query = {'$and': [query, after_filter(sort, position)]}
+    mimetype = response_format()
+    encoding = RESPONSE_FORMATS[mimetype]
+    parts = (query, projection, sort, limit)
+    if encoding != 'json':
+        parts += (encoding,)
+    key = result_cache.key('apitest.v1', *parts)
+    snapshot = snapshots.get('apitest.v1')
+    if snapshot is not None:
+        validators = snapshot_validators(snapshot, key)
+        if not_modified(validators):
+            return not_modified_response(validators)
+        body = snapshot_find(snapshot, shape_query, projection, hidden, sort, limit,
+                             position, encoding)
+        if body is not None:
+            if not stream:
+                body = ('' if encoding == 'json' else b'').join(body)
+            return find_response(body, mimetype, validators)
+    validators = find_validators(key)
+    if not_modified(validators):
+        return not_modified_response(validators)
+    cache_key = None
+    if current_config()["RESULT_CACHE_ENABLED"]:
+        cache_key = key
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return find_response(cached, mimetype, validators)
+    raw = current_config()["FIND_RAW_BATCHES"] and not hidden and \
+        encoding in RAW_ENCODINGS
+    route = current_route()
+    metrics_route = metrics.route()
+    command = {'find': 'v1', 'filter': query, 'projection': projection,
+               'sort': dict(sort_spec(sort))}
+    if limit is not None:
+        command['limit'] = limit + 1
+
+    def on_done(seconds, returned):
+        query_advisor.record('apitest.v1', shape_query, shape_sort, seconds)
+        slow_queries.record('find', 'apitest.v1', query, seconds, route=route,
+                            returned=returned, sort=shape_sort, command=command)
+
+    def start():
+        _, col = create_mongo_session('apitest', 'v1')
+        find = col.find_raw_batches if raw else col.find
+        if limit is None:
+            check_row_cap(col, query)
+            cursor = find(query, projection, sort=sort_spec(sort), batch_size=batch_size)
+        else:
+            # ask for one extra document, that's how we know there is a next page
+            cursor = find(query, projection, sort=sort_spec(sort),
+                          limit=limit + 1, batch_size=min(batch_size, limit + 1))
+        cursor = PrimedCursor(cursor)
+        if raw:
+            body = stream_raw_results(cursor, limit, sort, on_done, metrics_route,
+                                      encoding)
+        else:
+            body = stream_results(cursor, batch_size, limit, sort, hidden, on_done,
+                                  metrics_route, encoding)
+        if cache_key is not None:
+            body = result_cache.tee(cache_key, body)
+        return body
+
+    body = single_flight.run(key, start)
+    if not stream:
+        body = ('' if encoding == 'json' else b'').join(body)
+    return find_response(body, mimetype, validators)
+
+
+
+
+
+
+
+
+
+
+'''
+    Building a list of every document and then calling str() on
+    it means the whole collection sits in memory twice before the
+    client sees a single byte... and what they get isn't even
+    valid JSON, it's a Python repr.
+
+    stream_json() is a generator, so Flask sends each piece to
+    the client as soon as we yield it.  We encode the documents
+    with bson's json_util (it knows what an ObjectId is) a batch
+    at a time as the cursor hands them to us, so memory stays
+    flat no matter how big the collection gets.
+
+    stream_results() wraps that array in the envelope every find
+    route answers with:
+
+        {"results": [...], "next": "<token or null>"}
+'''
+def stream_json(docs, batch_size):
+    yield '['
+    batch = []
+    first = True
+    for doc in docs:
+        batch.append(json_util.dumps(doc))
+        if len(batch) >= batch_size:
+            yield ('' if first else ',') + ','.join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ('' if first else ',') + ','.join(batch)
+    yield ']'
+
+
+def stream_results(cursor, batch_size, limit, sort, hidden=(), on_done=None,
+                   route=None, encoding='json'):
+    # a PrimedCursor has already waited for its first batch
+    page = {'last': None, 'more': False, 'count': 0,
+            'seconds': getattr(cursor, 'waited', 0.0), 'first': None, 'producing': 0.0}
+
+    def docs():
+        # only the time spent waiting on the cursor is MongoDB's fault
+        while True:
+            started = time.perf_counter()
+            doc = next(cursor, None)
+            page['seconds'] += time.perf_counter() - started
+            if page['first'] is None:
+                page['first'] = page['seconds']
+            if doc is None:
+                return
+            if limit is not None and page['count'] == limit:
+                page['more'] = True
+                return
+            page['count'] += 1
+            page['last'] = doc
+            if hidden:
+                doc = {k: v for k, v in doc.items() if k not in hidden}
+            yield doc
+
+    def encoded_page():
+        # the binary formats need the whole page before they can write it
+        results = list(docs())
+        next_token = None
+        if page['more']:
+            next_token = encode_after(sort, page['last'])
+        yield ENCODERS[encoding](results, next_token)
+
+    try:
+        if encoding != 'json':
+            for chunk in timed_chunks(encoded_page(), page):
+                yield chunk
+            return
+        yield '{"results": '
+        for chunk in timed_chunks(stream_json(docs(), batch_size), page):
+            yield chunk
+        next_token = None
+        if page['more']:
+            next_token = encode_after(sort, page['last'])
+        yield ', "next": %s}' % json.dumps(next_token)
+    finally:
+        # the client may hang up half way through, don't leave the
+        # cursor open on the server when that happens
+        cursor.close()
+        if on_done is not None:
+            on_done(page['seconds'], page['count'])
+        if route is not None:
+            metrics.record_cursor(route, page)
+
+
+def timed_chunks(chunks, page):
+    # how long making each chunk took, waiting on the cursor included,
+    # whatever isn't the cursor's time was spent encoding
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        page['producing'] += time.perf_counter() - started
+        if chunk is None:
+            return
+        yield chunk
+
+
+
+
+
+
+
+
+
+
+'''
+    JSON is nice to read, but our analytics people load the results
+    straight into DataFrames, and for them parsing JSON row by row is
+    pure waste.  So the find routes look at the Accept header and
+    can also answer with:
+
+        application/bson                      one BSON document
+        application/msgpack                   one MessagePack map
+        application/vnd.apache.arrow.stream   an Arrow IPC stream
+
+    BSON and MessagePack hold the same {"results": [...], "next": ...}
+    as the JSON, so bson.decode() or msgpack.unpackb() gives you the
+    page and the token.  Arrow is columnar, one column per field,
+    with the token in the schema metadata under b'next':
+
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        df = table.to_pandas()
+        token = table.schema.metadata[b'next']  # b'' on the last page
+
+    MessagePack and Arrow need the msgpack and pyarrow packages.
+    If they aren't installed we don't offer them, and anyone who
+    doesn't ask for a format we have gets JSON.  Binary answers are
+    built a page at a time (find/all stops at FIND_MAX_ROWS anyway)
+    and the result cache only keeps them in this process.
+'''
+RESPONSE_FORMATS = OrderedDict([
+    ('application/json', 'json'),
+    ('application/bson', 'bson'),
+    ('application/msgpack', 'msgpack'),
+    ('application/x-msgpack', 'msgpack'),
+    ('application/vnd.apache.arrow.stream', 'arrow'),
+])
+FORMAT_MODULES = {'msgpack': 'msgpack', 'arrow': 'pyarrow'}
+
+
+@functools.lru_cache(maxsize=None)
+def module_available(name):
+    try:
+        importlib.import_module(name)
+    except ImportError:
+        return False
+    return True
+
+
+def format_available(encoding):
+    return encoding not in FORMAT_MODULES or module_available(FORMAT_MODULES[encoding])
+
+
+def response_format():
+    # the mimetype we answer with, whatever the client prefers and we have
+    if not flask.has_request_context():
+        return 'application/json'
+    offers = [mimetype for mimetype, encoding in RESPONSE_FORMATS.items()
+              if format_available(encoding)]
+    return request.accept_mimetypes.best_match(offers, default='application/json')
+
+
+def find_response(body, mimetype, validators=None):
+    # the chunk generators wrapped around body don't close it if they
+    # never started (a HEAD), werkzeug always closes the response
+    closing = getattr(body, 'close', None)
+    coding = content_coding()
+    if coding is not None and not isinstance(body, (str, bytes)):
+        body = compressed(body, coding)
+    elif coding is not None and \
+            len(body) >= current_config()["COMPRESSION_MIN_BYTES"]:
+        body = b''.join(compressed([body], coding))
+    else:
+        coding = None
+    response = flask.Response(body, mimetype=mimetype)
+    if closing is not None:
+        response.call_on_close(closing)
+    response.vary.add('Accept')
+    if current_config()["COMPRESSION_ENABLED"]:
+        response.vary.add('Accept-Encoding')
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    if validators is not None:
+        etag, modified = validators
+        response.set_etag(etag, weak=True)
+        response.last_modified = modified
+        # keep it, but ask us before using it again
+        response.cache_control.no_cache = True
+    return response
+
+
+def plain_value(value):
+    # what msgpack and Arrow can't store goes in as a string
+    if isinstance(value, dict):
+        return {k: plain_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [plain_value(v) for v in value]
+    if value is None or isinstance(value, (bool, int, float, str, bytes,
+                                           datetime.datetime)):
+        return value
+    return str(value)
+
+
+def encode_bson(results, next_token):
+    return bson.encode({'results': results, 'next': next_token})
+
+
+def encode_msgpack(results, next_token):
+    import msgpack
+    return msgpack.packb({'results': results, 'next': next_token},
+                         default=str, datetime=False)
+
+
+def encode_arrow(results, next_token):
+    import pyarrow
+    fields = OrderedDict()
+    for doc in results:
+        for field in doc:
+            fields[field] = None
+    arrays = []
+    for field in fields:
+        values = [plain_value(doc.get(field)) for doc in results]
+        try:
+            arrays.append(pyarrow.array(values))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            # a field with mixed types, say numbers and strings
+            arrays.append(pyarrow.array(
+                [None if v is None else str(v) for v in values], pyarrow.string()))
+    schema = pyarrow.schema(
+        [pyarrow.field(field, array.type) for field, array in zip(fields, arrays)],
+        metadata={'next': next_token or ''})
+    table = pyarrow.Table.from_arrays(arrays, schema=schema)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+ENCODERS = {
+    'bson': encode_bson,
+    'msgpack': encode_msgpack,
+    'arrow': encode_arrow,
+}
+
+
+
+
+
+
+
+
+
+
+'''
+    Polling.  Dashboards ask for /find/all every few seconds and
+    almost every time the answer is exactly what they got last time.
+
+    So every find answer gets an ETag, a hash of everything that
+    changes the answer (the result cache's key, which has the
+    collection's version in it), and a Last-Modified, when the
+    collection last changed.  A client that sends the ETag back in
+    If-None-Match (or the date in If-Modified-Since) while nothing
+    changed gets a 304 Not Modified with no body, and we don't even
+    ask MongoDB.
+
+    The version counts the writes this process knows about.  With a
+    shared cache tier all workers share it, and with a change stream
+    (VERSION_CHANGE_STREAMS) every write anywhere bumps it.  Without
+    a change stream the ETag also changes every RESULT_CACHE_TTL
+    seconds, so a write we didn't see is never hidden longer than the
+    cache would hide it.  Without a shared tier every worker makes
+    its own ETags, so a client that lands on another worker gets one
+    full answer before the 304s start again.
+
+    The answer itself is compressed with brotli or gzip if the client
+    says it can take them, chunk by chunk as it streams out.  The
+    ETags are weak (W/"..."), the answer is the same whether or not
+    it was compressed, and small ones aren't, so a 304 can't know
+    which bytes the client holds.
+'''
+CONTENT_CODINGS = OrderedDict([('br', 'brotli'), ('gzip', 'zlib')])
+
+
+def content_coding():
+    # how we compress the answer, None for not at all
+    if not flask.has_request_context() or not current_config()["COMPRESSION_ENABLED"]:
+        return None
+    offers = [coding for coding, module in CONTENT_CODINGS.items()
+              if module_available(module)]
+    return request.accept_encodings.best_match(offers)
+
+
+def compressed(chunks, coding):
+    config = current_config()
+    if coding == 'br':
+        compressor = importlib.import_module('brotli').Compressor(
+            quality=config["COMPRESSION_BROTLI_QUALITY"])
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits 31 means a gzip header and trailer around the deflate
+        compressor = zlib.compressobj(config["COMPRESSION_GZIP_LEVEL"], zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def find_validators(key):
+    # the (ETag, Last-Modified) for the answer result_cache keeps under key
+    if not current_config()["FIND_ETAGS"]:
+        return None
+    namespace, version, digest = key
+    modified = result_cache.changed_at(namespace)
+    parts = [digest, str(version)]
+    if result_cache.shared is None:
+        parts.append(result_cache.epoch())
+    if not change_feed.watching(namespace):
+        ttl = max(current_config()["RESULT_CACHE_TTL"], 1.0)
+        bucket = int(time.time() // ttl)
+        parts.append(str(bucket))
+        modified = max(modified, bucket * ttl)
+    etag = hashlib.sha1(':'.join(parts).encode('utf-8')).hexdigest()
+    return etag, datetime.datetime.fromtimestamp(int(modified), datetime.timezone.utc)
+
+
+def snapshot_validators(snapshot, key):
+    # a snapshot answer only changes when the snapshot does
+    if not current_config()["FIND_ETAGS"]:
+        return None
+    stamp = '%s:%s:%d:%s' % (key[2], snapshot.exported_at, snapshot.size, snapshot.path)
+    modified = datetime.datetime.fromisoformat(snapshot.exported_at)
+    return (hashlib.sha1(stamp.encode('utf-8')).hexdigest(),
+            modified.replace(microsecond=0))
+
+
+def not_modified(validators):
+    if validators is None or not flask.has_request_context():
+        return False
+    etag, modified = validators
+    if request.if_none_match:
+        # If-None-Match wins when there is one, If-Modified-Since is ignored
+        return request.if_none_match.contains_weak(etag)
+    return request.if_modified_since is not None and modified <= request.if_modified_since
+
+
+def not_modified_response(validators):
+    response = flask.Response(status=304)
+    response.vary.add('Accept')
+    if current_config()["COMPRESSION_ENABLED"]:
+        response.vary.add('Accept-Encoding')
+    etag, modified = validators
+    response.set_etag(etag, weak=True)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    return response
+
+
+
+
+
+
+
+
+
+
+'''
+    Reading a find the normal way, pymongo turns every BSON document
+    MongoDB sends into a dict, then json_util walks that dict in
+    Python to turn it into JSON.  For a big page that round trip is
+    most of our CPU time.
+
+    find_raw_batches() hands us each batch exactly as it came off
+    the wire, the documents one after the other, each starting with
+    its length.  split_documents() cuts a batch up by those lengths
+    without looking inside, then:
+
+      - BSON answers are glued together from those bytes untouched,
+        bson_envelope() only writes the {"results": [...], "next": ...}
+        around them.  Nothing gets decoded
+      - JSON answers decode the batch with one decode_all() call (C
+        code, in one go) and encode the whole batch with one call to
+        the json module's C encoder, json_util only gets asked about
+        the types JSON doesn't have, like ObjectId
+
+    Either way only the last document is decoded on its own, when
+    there is a next page and we need its sort key for the token.
+
+    The formats that need every field (MessagePack, Arrow) and pages
+    that hide their sort key take the normal path.
+'''
+RAW_ENCODINGS = ('json', 'bson')
+BATCH_ENCODER = json.JSONEncoder(default=json_util.default, allow_nan=False)
+
+
+def split_documents(data):
+    # the documents in a batch, as views into it, nothing is copied
+    view = memoryview(data)
+    docs, offset = [], 0
+    while offset < len(view):
+        size = struct.unpack_from('<i', view, offset)[0]
+        docs.append(view[offset:offset + size])
+        offset += size
+    return docs
+
+
+def encode_raw_json(docs):
+    decoded = bson.decode_all(b''.join(docs))
+    try:
+        return BATCH_ENCODER.encode(decoded)[1:-1]
+    except ValueError:
+        # NaN and infinity aren't JSON, json_util writes them as $numberDouble
+        return ','.join(json_util.dumps(doc) for doc in decoded)
+
+
+def bson_envelope(docs, next_token):
+    # {"results": [docs...], "next": next_token} as BSON, from raw documents
+    parts = []
+    for index, doc in enumerate(docs):
+        parts.append(b'\x03%d\x00' % index)
+        parts.append(doc)
+    array = b''.join(parts)
+    array = struct.pack('<i', len(array) + 5) + array + b'\x00'
+    if next_token is None:
+        tail = b'\x0anext\x00'
+    else:
+        token = next_token.encode('utf-8')
+        tail = b'\x02next\x00' + struct.pack('<i', len(token) + 1) + token + b'\x00'
+    body = b'\x04results\x00' + array + tail
+    return struct.pack('<i', len(body) + 5) + body + b'\x00'
+
+
+def stream_raw_results(cursor, limit, sort, on_done=None, route=None, encoding='json'):
+    # a PrimedCursor has already waited for its first batch
+    page = {'last': None, 'more': False, 'count': 0,
+            'seconds': getattr(cursor, 'waited', 0.0), 'first': None, 'producing': 0.0}
+
+    def batches():
+        while not page['more']:
+            started = time.perf_counter()
+            batch = next(cursor, None)
+            page['seconds'] += time.perf_counter() - started
+            if page['first'] is None:
+                page['first'] = page['seconds']
+            if batch is None:
+                return
+            docs = split_documents(batch)
+            if limit is not None and page['count'] + len(docs) > limit:
+                docs = docs[:limit - page['count']]
+                page['more'] = True
+            if docs:
+                page['count'] += len(docs)
+                page['last'] = docs[-1]
+                yield docs
+
+    def next_token():
+        if not page['more']:
+            return None
+        return encode_after(sort, bson.decode(page['last']))
+
+    def json_chunks():
+        first = True
+        for docs in batches():
+            yield ('[' if first else ',') + encode_raw_json(docs)
+            first = False
+        yield ('[' if first else '') + ']'
+
+    def bson_chunks():
+        docs = [doc for batch in batches() for doc in batch]
+        yield bson_envelope(docs, next_token())
+
+    try:
+        if encoding == 'bson':
+            for chunk in timed_chunks(bson_chunks(), page):
+                yield chunk
+            return
+        yield '{"results": '
+        for chunk in timed_chunks(json_chunks(), page):
+            yield chunk
+        yield ', "next": %s}' % json.dumps(next_token())
+    finally:
+        cursor.close()
+        if on_done is not None:
+            on_done(page['seconds'], page['count'])
+        if route is not None:
+            metrics.record_cursor(route, page)
+
+
+
+
+
+
+
+
+
+
+'''
+    Projections.  Most of the time the client wants a couple of
+    fields, not the whole document, so let them say which with
+    ?fields=name,age  (only those fields, plus _id)
+    ?fields=name,age,-_id  (only those, no _id)
+    ?fields=-ticket_number,-cabin  (everything BUT those)
+
+    This gets handed to MongoDB as the projection, just like we
+    did by hand in titanic_mongo.py, so the fields we don't want
+    never leave the database.  Like MongoDB, you can't mix
+    including and excluding, except to leave out _id.
+'''
+def parse_fields(fields):
+    # fields can be 'name,-_id', a list of names, or a ready made projection
+    if not fields:
+        return None
+    if isinstance(fields, dict):
+        return fields
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    projection = {}
+    for name in fields:
+        name = name.strip()
+        if name.startswith('-'):
+            projection[name[1:]] = 0
+        elif name:
+            projection[name] = 1
+    included = [k for k, v in projection.items() if v]
+    excluded = [k for k, v in projection.items() if not v and k != '_id']
+    if included and excluded:
+        flask.abort(400, "fields can include or exclude fields, not both "
+                         "(except -_id)")
+    return projection or None
+
+
+
+
+
+
+
+
+
+
+'''
+    Paging.  The lazy way to page is skip(), but to skip N
+    documents MongoDB still has to walk past all N of them, so
+    page 1000 is a thousand times slower than page 1.
+
+    Instead we remember where the last page ended (the value of
+    the sort key and the _id of the last document) and ask for
+    everything AFTER that.  With an index on the sort key that's
+    a single index seek, no matter how deep into the results we
+    are.  _id breaks ties, since sort keys like 'age' repeat.
+
+    The position is handed to the client as an opaque 'next'
+    token, which they send back as ?after= to get the next page.
+    It's just base64'd JSON, but clients shouldn't care.
+
+    Sorting is on _id unless the client asks for one of the
+    FIND_SORT_KEYS, prefix it with - to sort descending.  Keep
+    sort keys to one type per field, MongoDB only compares
+    values of the same type with $gt/$lt.
+'''
+PAGE_ARGS = ('limit', 'after', 'sort')
+FIND_ARGS = PAGE_ARGS + ('fields',)
+
+
+def find_args(args):
+    # everything mongo_find() understands from a request besides the filter
+    kwargs = page_args(args)
+    if args.get('fields'):
+        kwargs['fields'] = args.get('fields')
+    return kwargs
+
+
+def page_args(args):
+    # pulls limit/after/sort out of request.args or request.form,
+    # returns them as keyword arguments for mongo_find()
+    page = {}
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            page['limit'] = int(limit)
+        except ValueError:
+            flask.abort(400, "limit must be a whole number")
+        cap = current_config()["FIND_MAX_ROWS"]
+        if not 1 <= page['limit'] <= cap:
+            flask.abort(400, "limit must be between 1 and %d" % cap)
+    if args.get('after'):
+        page['after'] = args.get('after')
+    if args.get('sort'):
+        page['sort'] = args.get('sort')
+    return page
+
+
+def parse_sort(sort):
+    if not sort:
+        return ('_id', 1)
+    direction = 1
+    if sort.startswith('-'):
+        sort, direction = sort[1:], -1
+    if sort != '_id' and sort not in current_config()["FIND_SORT_KEYS"]:
+        flask.abort(400, "can't sort on '%s'" % sort)
+    return (sort, direction)
+
+
+def sort_spec(sort):
+    key, direction = sort
+    if key == '_id':
+        return [('_id', direction)]
+    return [(key, direction), ('_id', direction)]
+
+
+def check_row_cap(col, query):
+    # count at most one more than the cap, we don't care how many
+    # more there are, only that there are too many
+    cap = current_config()["FIND_MAX_ROWS"]
+    if col.count_documents(query, limit=cap + 1) > cap:
+        flask.abort(400, "query matches more than %d rows, page through "
+                         "it with limit and after" % cap)
+
+
+def page_projection(projection, sort):
+    # The next token needs _id and the sort key of the last document,
+    # so sneak them into the projection if the client left them out
+    # and remember to take them back out before we send the document
+    if projection is None:
+        return None, ()
+    projection = dict(projection)
+    including = any(v for k, v in projection.items() if k != '_id')
+    hidden = []
+    for key in ('_id', sort[0]):
+        if projection.get(key) == 0:
+            del projection[key]
+            hidden.append(key)
+        elif including and key != '_id' and key not in projection:
+            projection[key] = 1
+            hidden.append(key)
+    return (projection or None), tuple(hidden)
+
+
+def encode_after(sort, doc):
+    key, _ = sort
+    position = [key, doc.get(key), doc['_id']]
+    token = base64.urlsafe_b64encode(json_util.dumps(position).encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_after(sort, token):
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        key, value, last_id = json_util.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError):
+        flask.abort(400, "after is not a valid page token")
+    if key != sort[0]:
+        flask.abort(400, "after token was made for a different sort")
+    return value, last_id
+
+
+def after_filter(sort, position):
+    key, direction = sort
+    value, last_id = position
+    op = '$gt' if direction == 1 else '$lt'
+    if key == '_id':
+        return {'_id': {op: last_id}}
+    if value is None:
+        # null/missing sorts before everything else, so after a null
+        # comes every other null with a bigger _id, then every real value
+        if direction == 1:
+            return {'$or': [{key: {'$ne': None}},
+                            {key: None, '_id': {op: last_id}}]}
+        return {key: None, '_id': {op: last_id}}
+    after = [{key: {op: value}}, {key: value, '_id': {op: last_id}}]
+    if direction == -1:
+        # ...and going backwards the nulls are still to come
+        after.append({key: None})
+    return {'$or': after}
+
+
+
+
+
+
+
+
+
+
+
+
+
+'''
+    In titanic_mongo.py we counted survivors, found the distinct
+    embarkation points and ran an aggregation pipeline.  The API
+    could only find(), so people downloaded the whole collection
+    and did that math themselves.  mongo_aggregate() lets MongoDB
+    do the work and only the answer comes back.
+
+    We can't just run whatever pipeline a stranger sends us though
+    ($out would overwrite a collection, $function runs JavaScript on
+    our server), so check_pipeline() only lets through these stages:
+
+        $match  $project  $group  $sort  $limit  $count
+
+    plus {"$distinct": "field"} as a shortcut for grouping on one
+    field.  Pipelines run with allowDiskUse so a big $group or $sort
+    doesn't fail on MongoDB's memory limit, and the results are
+    streamed back like find's, at most FIND_MAX_ROWS of them.
+'''
+PIPELINE_STAGES = ('$match', '$project', '$group', '$sort', '$limit', '$count',
+                   '$distinct')
+GROUP_ACCUMULATORS = ('$sum', '$avg', '$min', '$max', '$first', '$last',
+                      '$push', '$addToSet', '$count')
+FORBIDDEN_OPERATORS = ('$where', '$function', '$accumulator')
+
+
+def check_operators(value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in FORBIDDEN_OPERATORS:
+                raise ValueError("%s is not allowed" % key)
+            check_operators(item)
+    elif isinstance(value, list):
+        for item in value:
+            check_operators(item)
+
+
+def check_pipeline(pipeline):
+    # returns the pipeline ready to run, raises ValueError if it isn't ok
+    if not isinstance(pipeline, list) or not pipeline:
+        raise ValueError("pipeline must be a list of stages")
+    checked = []
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise ValueError("every stage must have exactly one operator")
+        (name, spec), = stage.items()
+        if name not in PIPELINE_STAGES:
+            raise ValueError("%s is not an allowed stage" % name)
+        check_operators(spec)
+        if name == '$group':
+            if not isinstance(spec, dict) or '_id' not in spec:
+                raise ValueError("$group needs an _id")
+            for field, accumulator in spec.items():
+                if field == '_id':
+                    continue
+                if not isinstance(accumulator, dict) or len(accumulator) != 1 \
+                        or list(accumulator)[0] not in GROUP_ACCUMULATORS:
+                    raise ValueError("$group field %s needs one of %s"
+                                     % (field, ', '.join(GROUP_ACCUMULATORS)))
+        elif name == '$limit':
+            if not isinstance(spec, int) or spec < 1:
+                raise ValueError("$limit must be a positive whole number")
+        elif name == '$sort':
+            if not isinstance(spec, dict) or \
+                    any(direction not in (1, -1) for direction in spec.values()):
+                raise ValueError("$sort must map fields to 1 or -1")
+        elif name in ('$count', '$distinct'):
+            if not isinstance(spec, str) or not spec or spec.startswith('$'):
+                raise ValueError("%s needs a field name" % name)
+        elif not isinstance(spec, dict):
+            raise ValueError("%s needs a document" % name)
+        if name == '$distinct':
+            checked.append({'$group': {'_id': '$' + spec}})
+            checked.append({'$sort': {'_id': 1}})
+        else:
+            checked.append({name: spec})
+    return checked
+
+
+def mongo_aggregate(pipeline, stream=True):
     _, col = create_mongo_session('apitest', 'v1')
-    find_result = []
-    for i in col.find(query):
-        find_result.append(i)
-    return str(find_result)
+    config = current_config()
+    batch_size, cap = config["FIND_BATCH_SIZE"], config["FIND_MAX_ROWS"]
+    try:
+        pipeline = check_pipeline(pipeline)
+    except ValueError as e:
+        flask.abort(400, str(e))
+    cache_key = None
+    if config["RESULT_CACHE_ENABLED"]:
+        cache_key = result_cache.key('apitest.v1', 'aggregate', pipeline)
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return flask.Response(cached, mimetype='application/json')
+    # one more than we return, so we can tell the client we stopped early
+    pipeline = pipeline + [{'$limit': cap + 1}]
+    cursor = col.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+    route = current_route()
+
+    def on_done(seconds, returned):
+        slow_queries.record('aggregate', 'apitest.v1', pipeline, seconds,
+                            route=route, returned=returned, command={
+                                'aggregate': 'v1', 'pipeline': pipeline,
+                                'cursor': {}, 'allowDiskUse': True})
+
+    body = stream_aggregate(cursor, batch_size, cap, metrics.route(), on_done)
+    if cache_key is not None:
+        body = result_cache.tee(cache_key, body)
+    if not stream:
+        body = ''.join(body)
+    return flask.Response(body, mimetype='application/json')
+
+
+def stream_aggregate(cursor, batch_size, cap, route=None, on_done=None):
+    page = {'truncated': False, 'count': 0, 'seconds': 0.0, 'first': None,
+            'producing': 0.0}
+
+    def docs():
+        while True:
+            started = time.perf_counter()
+            doc = next(cursor, None)
+            page['seconds'] += time.perf_counter() - started
+            if page['first'] is None:
+                page['first'] = page['seconds']
+            if doc is None:
+                return
+            if page['count'] == cap:
+                page['truncated'] = True
+                return
+            page['count'] += 1
+            yield doc
+
+    try:
+        yield '{"results": '
+        for chunk in timed_chunks(stream_json(docs(), batch_size), page):
+            yield chunk
+        yield ', "truncated": %s}' % json.dumps(page['truncated'])
+    finally:
+        cursor.close()
+        if on_done is not None:
+            on_done(page['seconds'], page['count'])
+        if route is not None:
+            metrics.record_cursor(route, page)
+
+
+
+
+
 
 
 
 
 
+'''
+    "How many people survived?" shouldn't mean downloading
+    /find/all and calling len() on it.  mongo_count() and
+    mongo_distinct() ask MongoDB for just the answer, as cheaply
+    as it can give it:
+
+      - no filter at all and exact=false: estimated_document_count()
+        reads the count MongoDB keeps in the collection's metadata,
+        nothing gets scanned.  With exact=true (the default) we count
+        the keys of the _id index
+      - a filter on fields that one of our MONGO_INDEXES covers:
+        we hint that index, so MongoDB counts index keys (or walks
+        the distinct values of an index) without loading documents
+      - exact=false: if the filter is one of our ROLLUPS, and it
+        isn't waiting to be recounted, we answer from the rollup.
+        Could be a few seconds behind, dashboards don't mind
+
+    The estimated count comes from metadata too, it can be off
+    after an unclean shutdown or with orphaned documents on a
+    sharded cluster.  Anything else is a real count.
+
+    Answers go through the result cache, keyed on the filter, so a
+    dashboard tile asking the same thing every few seconds gets it
+    straight from memory until the next write.
+'''
+def query_fields(query):
+    # every field a filter looks at, including inside $and/$or/$nor
+    fields = set()
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            for part in value:
+                fields |= query_fields(part)
+        elif not key.startswith('$'):
+            fields.add(key)
+    return fields
+
+
+def covering_index(namespace, fields):
+    # the shortest declared index that has every field, and starts
+    # with one of them (an index that starts with something else
+    # would have to be read from end to end)
+    best = None
+    for spec in current_config()["MONGO_INDEXES"].get(namespace, []):
+        keys = index_keys(spec)
+        names = [field for field, _ in keys]
+        if fields and fields <= set(names) and names[0] in fields:
+            if best is None or len(keys) < len(best):
+                best = keys
+    return best
+
+
+def flatten_query(query):
+    # {'$and': [{'a': 1}, {'b': 2}]} and {'a': 1, 'b': 2} are the same filter
+    flat = {}
+    for key, value in query.items():
+        if key == '$and' and all(isinstance(part, dict) for part in value):
+            parts = [flatten_query(part) for part in value]
+        else:
+            parts = [{key: value}]
+        for part in parts:
+            for field, condition in part.items():
+                if field in flat:
+                    return query
+                flat[field] = condition
+    return flat
+
+
+def rollup_answer(namespace, kind, query, field=None):
+    # the value of a fresh rollup that answers exactly this, or None
+    query = flatten_query(query)
+    for name, spec in rollups.declared(namespace).items():
+        if kind == 'count' and flatten_query(spec.get('count', {'$none': 1})) != query:
+            continue
+        if kind == 'distinct' and (spec.get('distinct') != field or
+                                   flatten_query(spec.get('filter', {})) != query):
+            continue
+        try:
+            stats = rollups.get(namespace, name)[name]
+        except PyMongoError as e:
+            log.warning("could not read rollup %s: %s", name, e)
+            return None
+        if not stats['stale']:
+            return stats['value']
+    return None
+
+
+def hinted(call, query, hint, **kwargs):
+    # run count_documents/distinct with our index hint, and without it
+    # if the index isn't there (MONGO_ENSURE_INDEXES=false, or dropped)
+    if hint is not None:
+        try:
+            return call(query, hint=hint, **kwargs)
+        except OperationFailure as e:
+            log.warning("index hint %s failed, counting without it: %s", hint, e)
+    return call(query, **kwargs)
+
+
+def cached_answer(key, compute):
+    if key is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return flask.Response(cached, mimetype='application/json')
+    with metrics.timed('query'):
+        answer = compute()
+    with metrics.timed('encode'):
+        body = json_util.dumps(answer)
+    if key is not None:
+        result_cache.set(key, body)
+    return flask.Response(body, mimetype='application/json')
+
+
+def mongo_count(query, exact=True):
+    _, col = create_mongo_session('apitest', 'v1')
+    key = None
+    if current_config()["RESULT_CACHE_ENABLED"]:
+        key = result_cache.key('apitest.v1', 'count', query, exact)
+
+    def compute():
+        if not query and not exact:
+            return {'count': col.estimated_document_count(), 'source': 'estimated'}
+        if not exact:
+            value = rollup_answer('apitest.v1', 'count', query)
+            if value is not None:
+                return {'count': value, 'source': 'rollup'}
+        if query:
+            hint = covering_index('apitest.v1', query_fields(query))
+        else:
+            hint = [('_id', pymongo.ASCENDING)]
+        started = time.perf_counter()
+        count = hinted(col.count_documents, query, hint)
+        slow_queries.record('count', 'apitest.v1', query, time.perf_counter() - started,
+                            command={'count': 'v1', 'query': query})
+        return {'count': count, 'source': 'count'}
+
+    return cached_answer(key, compute)
+
+
+def mongo_distinct(field, query, exact=True):
+    if not field or field.startswith('$'):
+        flask.abort(400, "bad field name %r" % field)
+    _, col = create_mongo_session('apitest', 'v1')
+    key = None
+    if current_config()["RESULT_CACHE_ENABLED"]:
+        key = result_cache.key('apitest.v1', 'distinct', field, query, exact)
+
+    def compute():
+        if not exact:
+            value = rollup_answer('apitest.v1', 'distinct', query, field)
+            if value is not None:
+                return {'values': value, 'source': 'rollup'}
+        # an index starting with the field itself lets MongoDB jump
+        # from one value to the next instead of reading every key
+        hint = covering_index('apitest.v1', query_fields(query) | {field})
+        started = time.perf_counter()
+        values = hinted(lambda q, **kw: col.distinct(field, q, **kw), query, hint)
+        slow_queries.record('distinct', 'apitest.v1', query, time.perf_counter() - started,
+                            returned=len(values),
+                            command={'distinct': 'v1', 'key': field, 'query': query})
+        return {'values': values, 'source': 'distinct'}
+
+    return cached_answer(key, compute)
+
+
 
 
 
@@ -201,27 +1812,2059 @@ def mongo_find(query):
     I left two of these as incomplete, with the hopes that
     you implement them, but seriously think things through
     before you do.  There are large implications behind these
-    operations.
+    operations.  (They're done now, see mongo_update() and
+    mongo_delete() below for what thinking it through looks like.)
 '''
 def mongo_insert_one(doc):
     #insert one document in the 'v1' collection of the 'apitest' database
     _, col = create_mongo_session('apitest', 'v1')
-    col.insert_one(doc)
+    try:
+        col.insert_one(doc)
+    finally:
+        #anything we cached for this collection is out of date now
+        result_cache.invalidate('apitest.v1')
+    #and our rollups have one more document to count
+    rollups.on_insert('apitest.v1', [doc])
+
+def mongo_insert_many(doc, database='apitest', collection='v1', ordered=True,
+                      write_concern=None):
+    #inserting many... returns how many went in, how many didn't and why.
+    #with ordered=False MongoDB keeps going past a bad document instead
+    #of stopping at the first one, and can write the batch in parallel
+    namespace = database + '.' + collection
+    db, col = create_mongo_session(database, collection)
+    if write_concern is not None:
+        col = col.with_options(write_concern=write_concern)
+    try:
+        result = col.insert_many(doc, ordered=ordered)
+        inserted, errors = len(result.inserted_ids), []
+    except BulkWriteError as e:
+        inserted = e.details.get('nInserted', 0)
+        errors = e.details.get('writeErrors', [])
+    except PyMongoError:
+        #no idea what made it in, recount the rollups later
+        rollups.on_change(namespace)
+        raise
+    finally:
+        result_cache.invalidate(namespace)
+    failed_at = set(error['index'] for error in errors)
+    if ordered and failed_at:
+        written = doc[:min(failed_at)]
+    else:
+        written = [d for i, d in enumerate(doc) if i not in failed_at]
+    rollups.on_insert(namespace, written)
+    return inserted, len(doc) - inserted, errors
+
+'''
+    Reading a request body that could be gigabytes long, one
+    document at a time.  We read the body in chunks and pull
+    complete JSON values off the front of what we have so far with
+    raw_decode().  Between values we skip whitespace and one comma
+    (or the closing bracket of an array), so this reads NDJSON (one
+    document per line) and a plain JSON array alike, and a stray
+    bracket or a doubled comma is an error.
+
+    Only the current document is ever held in memory.  If we have
+    buffered more than BULK_MAX_DOC_BYTES without finding the end
+    of a document, the body is broken and we give up.
+'''
+JSON_WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+
+class BadDocumentStream(ValueError):
+    pass
+
+
+def iter_documents(stream, max_doc_bytes, chunk_size=64 * 1024):
+    decoder = json.JSONDecoder(object_hook=json_util.object_hook)
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer, at = '', 0
+    eof = False
+    # None until the first character tells us array or NDJSON
+    array = None
+    seen = after_value = closed = False
+    while True:
+        at = JSON_WHITESPACE.match(buffer, at).end()
+        if at < len(buffer):
+            char = buffer[at]
+            if closed:
+                raise BadDocumentStream("more data after the end of the array")
+            if array is None:
+                array = char == '['
+                if array:
+                    at += 1
+                    continue
+            if after_value:
+                # one separator between documents, a comma, or in an
+                # array the closing bracket
+                if char == ',':
+                    at += 1
+                    after_value = False
+                    continue
+                if array and char == ']':
+                    at += 1
+                    closed = True
+                    continue
+                if array:
+                    raise BadDocumentStream("expected , or ] after a document")
+            elif array and char == ']' and not seen:
+                # an empty array
+                at += 1
+                closed = True
+                continue
+            try:
+                doc, end = decoder.raw_decode(buffer, at)
+            except ValueError as e:
+                if eof:
+                    raise BadDocumentStream(str(e))
+                if len(buffer) - at > max_doc_bytes:
+                    raise BadDocumentStream("document bigger than %d bytes"
+                                            % max_doc_bytes)
+            else:
+                at, seen, after_value = end, True, True
+                yield doc
+                continue
+        if eof:
+            if array and not closed:
+                raise BadDocumentStream("the array never ends")
+            return
+        # drop what we've decoded once per chunk, not once per document
+        buffer, at = buffer[at:], 0
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer += text.decode(chunk, final=eof)
+
+
+
 
-def mongo_insert_many(doc):
-    #inserting many... just in case!
-    db, col = create_mongo_session('somedb', 'somecol')
-    col.insert_many(doc)
 
-def mongo_delete():
-    #delete some sh*t
-    db, col = create_mongo_session('apitest', 'v1')
-    return
 
-def mongo_update():
-    # update some s**t
+
+
+
+
+
+'''
+    Fixing data used to mean reading it through /find/all, changing
+    it and inserting it again.  Slow, and if two people did it at
+    once the last one won.  mongo_update() and mongo_delete() send
+    one update_many() or delete_many() and MongoDB changes every
+    matching document itself, atomically per document, and tells
+    us how many it matched, changed or deleted.
+
+    The implications I warned you about:
+      - an empty filter matches EVERYTHING, so it is refused unless
+        you say all=True
+      - the update must only use the operators in UPDATE_OPERATORS,
+        a plain document would replace every matching document
+      - dry_run=True only counts what the filter matches and writes
+        nothing.  MongoDB can't tell us how many would actually
+        change without doing it, so modified comes back as None
+
+    mongo_bulk_write() takes a list of operations like
+
+        {"update_many": {"filter": {...}, "update": {...}}}
+        {"delete_one": {"filter": {...}}}
+        {"insert_one": {"document": {...}}}
+
+    and sends them all in one bulk_write() round trip.  A dry run
+    counts each operation against the data as it is now, it doesn't
+    know what the earlier operations in the list would have done.
+'''
+UPDATE_OPERATORS = ('$set', '$unset', '$inc', '$mul', '$min', '$max', '$rename',
+                    '$push', '$addToSet', '$pull', '$pop', '$currentDate')
+BULK_OPERATIONS = {
+    'insert_one': InsertOne,
+    'update_one': UpdateOne,
+    'update_many': UpdateMany,
+    'delete_one': DeleteOne,
+    'delete_many': DeleteMany,
+}
+
+
+def check_filter(query, everything=False):
+    if not isinstance(query, dict):
+        raise ValueError("filter must be a document")
+    if not query and not everything:
+        raise ValueError("an empty filter matches every document, "
+                         "send all=true if that's really what you want")
+    check_operators(query)
+
+
+def check_update(update):
+    if not isinstance(update, dict) or not update:
+        raise ValueError("update must be a document of update operators")
+    for op, fields in update.items():
+        if op not in UPDATE_OPERATORS:
+            raise ValueError("%s is not an allowed update operator" % op)
+        if not isinstance(fields, dict) or not fields:
+            raise ValueError("%s needs a document of fields" % op)
+        if any(field.startswith('$') for field in fields):
+            raise ValueError("bad field name under %s" % op)
+        check_operators(fields)
+
+
+def check_operations(operations, everything=False):
+    # [{"update_many": {...}}, ...] -> pymongo write models
+    if not isinstance(operations, list) or not operations:
+        raise ValueError("operations must be a list")
+    models = []
+    for operation in operations:
+        if not isinstance(operation, dict) or len(operation) != 1:
+            raise ValueError("every operation must have exactly one name")
+        (name, spec), = operation.items()
+        if name not in BULK_OPERATIONS:
+            raise ValueError("%s is not an allowed operation" % name)
+        if not isinstance(spec, dict):
+            raise ValueError("%s needs a document" % name)
+        if name == 'insert_one':
+            if not isinstance(spec.get('document'), dict):
+                raise ValueError("insert_one needs a document")
+            models.append(InsertOne(spec['document']))
+            continue
+        check_filter(spec.get('filter'), everything)
+        if name.startswith('update'):
+            check_update(spec.get('update'))
+            models.append(BULK_OPERATIONS[name](spec['filter'], spec['update'],
+                                                upsert=bool(spec.get('upsert'))))
+        else:
+            models.append(BULK_OPERATIONS[name](spec['filter']))
+    return models
+
+
+def written(namespace):
+    # anything cached or rolled up for the collection is out of date
+    result_cache.invalidate(namespace)
+    rollups.on_change(namespace)
+
+
+def mongo_update(query, update, upsert=False, dry_run=False, everything=False):
+    db, col = create_mongo_session('apitest', 'v1')
+    try:
+        check_filter(query, everything)
+        check_update(update)
+    except ValueError as e:
+        flask.abort(400, str(e))
+    if dry_run:
+        return {'matched': col.count_documents(query), 'modified': None,
+                'upserted_id': None, 'dry_run': True}
+    started = time.perf_counter()
+    try:
+        result = col.update_many(query, update, upsert=upsert)
+    finally:
+        written('apitest.v1')
+    slow_queries.record('update', 'apitest.v1', query, time.perf_counter() - started,
+                        command={'update': 'v1', 'updates': [
+                            {'q': query, 'u': update, 'multi': True, 'upsert': upsert}]})
+    return {'matched': result.matched_count, 'modified': result.modified_count,
+            'upserted_id': result.upserted_id, 'dry_run': False}
+
+
+def mongo_delete(query, dry_run=False, everything=False):
     db, col = create_mongo_session('apitest', 'v1')
-    return
+    try:
+        check_filter(query, everything)
+    except ValueError as e:
+        flask.abort(400, str(e))
+    if dry_run:
+        return {'deleted': col.count_documents(query), 'dry_run': True}
+    started = time.perf_counter()
+    try:
+        result = col.delete_many(query)
+    finally:
+        written('apitest.v1')
+    slow_queries.record('delete', 'apitest.v1', query, time.perf_counter() - started,
+                        command={'delete': 'v1', 'deletes': [{'q': query, 'limit': 0}]})
+    return {'deleted': result.deleted_count, 'dry_run': False}
+
+
+def mongo_bulk_write(operations, ordered=True, dry_run=False, everything=False):
+    db, col = create_mongo_session('apitest', 'v1')
+    try:
+        models = check_operations(operations, everything)
+    except ValueError as e:
+        flask.abort(400, str(e))
+    if dry_run:
+        report = {'inserted': 0, 'matched': 0, 'modified': None, 'deleted': 0,
+                  'upserted': 0, 'errors': [], 'dry_run': True}
+        for operation in operations:
+            (name, spec), = operation.items()
+            if name == 'insert_one':
+                report['inserted'] += 1
+                continue
+            # the one-document operations stop at the first match
+            limit = {'limit': 1} if name.endswith('_one') else {}
+            matched = col.count_documents(spec['filter'], **limit)
+            report['deleted' if name.startswith('delete') else 'matched'] += matched
+        return report
+    errors = []
+    started = time.perf_counter()
+    try:
+        details = col.bulk_write(models, ordered=ordered).bulk_api_result
+    except BulkWriteError as e:
+        details = e.details
+        errors = details.get('writeErrors', [])
+    finally:
+        written('apitest.v1')
+    # no explain() for a bulk write, but the shape of each operation
+    slow_queries.record('bulk_write', 'apitest.v1',
+                        [{name: spec.get('filter', {}) for name, spec in op.items()}
+                         for op in operations],
+                        time.perf_counter() - started)
+    return {
+        'inserted': details.get('nInserted', 0),
+        'matched': details.get('nMatched', 0),
+        'modified': details.get('nModified', 0),
+        'deleted': details.get('nRemoved', 0),
+        'upserted': details.get('nUpserted', 0),
+        'errors': [{'index': e.get('index'), 'errmsg': e.get('errmsg')}
+                   for e in errors[:5]],
+        'dry_run': False,
+    }
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Indexes.  Without them every filter on survived, age or class
+    is a collection scan, MongoDB reads every document to find
+    the few we asked for.  MONGO_INDEXES (at the top) says which
+    indexes each collection should have, and ensure_indexes()
+    creates them when the app starts.  create_index() does
+    nothing if the index is already there, so this is safe to run
+    on every start, from every worker.
+'''
+def index_keys(spec):
+    # ['survived', '-age'] -> [('survived', 1), ('age', -1)]
+    if isinstance(spec, dict):
+        spec = spec['keys']
+    keys = []
+    for field in spec:
+        if field.startswith('-'):
+            keys.append((field[1:], pymongo.DESCENDING))
+        else:
+            keys.append((field, pymongo.ASCENDING))
+    return keys
+
+
+def ensure_indexes(indexes=None):
+    if indexes is None:
+        indexes = current_config()["MONGO_INDEXES"]
+    created = []
+    for namespace, specs in indexes.items():
+        database, _, collection = namespace.partition('.')
+        _, col = create_mongo_session(database, collection)
+        for spec in specs:
+            options = {}
+            if isinstance(spec, dict):
+                options = {k: v for k, v in spec.items() if k != 'keys'}
+            try:
+                name = col.create_index(index_keys(spec), **options)
+            except OperationFailure as e:
+                # a clash with an existing index shouldn't stop the app
+                log.warning("could not create index %s on %s: %s",
+                            spec, namespace, e)
+                continue
+            created.append((namespace, name))
+    return created
+
+
+
+
+
+
+
+
+
+
+'''
+    Of course the indexes above are just my guess at what people
+    will ask for.  QueryAdvisor keeps track of the filters that
+    really come through mongo_find(), grouped by their shape (the
+    fields and operators, with the values thrown away, so age<18
+    and age<30 are the same query), and how long they took.
+
+    report() takes the slowest shapes, asks MongoDB to explain()
+    them and points out the ones that still scan the whole
+    collection, with an index that would help.  The suggestion
+    follows the usual equality, sort, range rule: fields we match
+    exactly come first, then the sort, then the ranges.
+'''
+RANGE_OPERATORS = ('$lt', '$lte', '$gt', '$gte', '$ne', '$nin', '$regex',
+                   '$exists', '$not')
+
+
+def query_shape(query):
+    if isinstance(query, dict):
+        shape = {}
+        for key, value in query.items():
+            if key in ('$and', '$or', '$nor'):
+                shape[key] = [query_shape(part) for part in value]
+            elif isinstance(value, dict):
+                shape[key] = query_shape(value)
+            else:
+                shape[key] = 1
+        return shape
+    return 1
+
+
+def suggest_index(query, sort=None):
+    equality, ranges = [], []
+
+    def visit(query):
+        for key, value in query.items():
+            if key == '$and':
+                for part in value:
+                    visit(part)
+            elif key.startswith('$'):
+                # $or/$nor want an index per branch, don't guess
+                continue
+            elif isinstance(value, dict) and any(op in RANGE_OPERATORS
+                                                 for op in value):
+                ranges.append(key)
+            else:
+                equality.append(key)
+
+    visit(query)
+    # finds always end the sort with _id as a tie-breaker, and _id has
+    # its own index, putting it in ours would only get in the way
+    sort = list(sort or [])
+    while sort and sort[-1][0] == '_id':
+        sort.pop()
+    keys = []
+    for field in equality:
+        keys.append((field, pymongo.ASCENDING))
+    for field, direction in sort:
+        keys.append((field, direction))
+    for field in ranges:
+        keys.append((field, pymongo.ASCENDING))
+    seen = set()
+    return [(f, d) for f, d in keys if not (f in seen or seen.add(f))]
+
+
+def plan_stages(plan):
+    # every 'stage' anywhere in an explain() plan
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan['stage']
+        for value in plan.values():
+            for stage in plan_stages(value):
+                yield stage
+    elif isinstance(plan, list):
+        for item in plan:
+            for stage in plan_stages(item):
+                yield stage
+
+
+class QueryAdvisor(object):
+    def __init__(self, max_shapes=500):
+        self._lock = threading.Lock()
+        self.max_shapes = max_shapes
+        self.shapes = {}
+
+    def record(self, namespace, query, sort, seconds):
+        shape = query_shape(query)
+        key = (namespace, json.dumps(shape, sort_keys=True), sort or '')
+        with self._lock:
+            entry = self.shapes.get(key)
+            if entry is None:
+                if len(self.shapes) >= self.max_shapes:
+                    return
+                entry = self.shapes[key] = {
+                    'namespace': namespace,
+                    'shape': shape,
+                    'sort': sort,
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                }
+            ms = seconds * 1000
+            entry['count'] += 1
+            entry['total_ms'] += ms
+            entry['max_ms'] = max(entry['max_ms'], ms)
+            # keep a real filter around, explain() needs values
+            entry['sample'] = query
+
+    def slowest(self, top=10):
+        with self._lock:
+            entries = [dict(entry) for entry in self.shapes.values()]
+        for entry in entries:
+            entry['avg_ms'] = entry['total_ms'] / entry['count']
+        entries.sort(key=lambda entry: entry['avg_ms'], reverse=True)
+        return entries[:top]
+
+    def report(self, top=10):
+        report = []
+        for entry in self.slowest(top):
+            database, _, collection = entry['namespace'].partition('.')
+            _, col = create_mongo_session(database, collection)
+            sort = sort_spec(parse_sort(entry['sort']))
+            sample = entry.pop('sample')
+            try:
+                plan = col.find(sample, sort=sort).explain()
+            except PyMongoError as e:
+                entry['error'] = str(e)
+                report.append(entry)
+                continue
+            winning = plan.get('queryPlanner', {}).get('winningPlan', {})
+            entry['stages'] = sorted(set(plan_stages(winning)))
+            entry['collscan'] = 'COLLSCAN' in entry['stages']
+            if entry['collscan']:
+                entry['suggested_index'] = suggest_index(sample, sort)
+            report.append(entry)
+        return report
+
+    def reset(self):
+        with self._lock:
+            self.shapes = {}
+
+
+query_advisor = QueryAdvisor(settings["ADVISOR_MAX_SHAPES"])
+
+
+
+
+
+
+
+
+
+
+'''
+    The advisor tells you which shapes are slow on average.  When
+    one particular call was slow you want to know about THAT call:
+    which route, what it asked for, how long it took and how much
+    work MongoDB did to answer it.
+
+    SlowQueryLog gets told about every find, aggregate, count,
+    distinct, update and delete (for finds and aggregates the time
+    is what we spent waiting on the cursor, not the encoding).
+    Anything over SLOW_QUERY_MS goes in the log, with the filter
+    reduced to its shape like the advisor does, so no passenger's
+    name ends up in a log file.
+
+    Some of them (SLOW_QUERY_EXPLAIN_RATE) are run again with
+    explain("executionStats") to get docs examined vs returned.
+    Explain runs the query a second time, so it happens on a
+    background thread, and if that thread falls behind we just log
+    without it.  Explaining an update or delete doesn't change any
+    documents.
+
+    Each entry is one line of JSON in SLOW_QUERY_LOG, rotated when
+    it gets big, and the latest are in /api/v1/mongo/slowqueries.
+'''
+def find_key(value, key):
+    # the first value stored under key anywhere in an explain() plan
+    if isinstance(value, dict):
+        if key in value:
+            return value[key]
+        value = list(value.values())
+    if isinstance(value, list):
+        for item in value:
+            found = find_key(item, key)
+            if found is not None:
+                return found
+    return None
+
+
+class SlowQueryLog(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._entries = deque(maxlen=500)
+        self._queue = None
+        self._pid = None
+        self._logger = logging.getLogger(__name__ + '.slow_queries')
+        self._logger.propagate = False
+        self._handler = None
+
+    def configure(self, config):
+        self._config = config
+        with self._lock:
+            self._entries = deque(self._entries, maxlen=config.get('SLOW_QUERY_BUFFER', 500))
+            if self._handler is not None:
+                self._logger.removeHandler(self._handler)
+                self._handler.close()
+                self._handler = None
+
+    def _write(self, entry):
+        path = self._config.get('SLOW_QUERY_LOG')
+        if not path:
+            return
+        if self._handler is None:
+            with self._lock:
+                if self._handler is None:
+                    self._handler = logging.handlers.RotatingFileHandler(
+                        path, maxBytes=self._config.get('SLOW_QUERY_LOG_BYTES', 0),
+                        backupCount=self._config.get('SLOW_QUERY_LOG_BACKUPS', 0),
+                        delay=True)
+                    self._logger.addHandler(self._handler)
+                    self._logger.setLevel(logging.INFO)
+        self._logger.info(json_util.dumps(entry))
+
+    def record(self, operation, namespace, query, seconds, route=None, returned=None,
+               sort=None, command=None):
+        threshold = self._config.get('SLOW_QUERY_MS', -1)
+        if threshold < 0 or seconds * 1000.0 < threshold:
+            return None
+        if route is None:
+            route = current_route()
+        if isinstance(query, dict):
+            shape = query_shape(query)
+        else:
+            shape = [query_shape(part) for part in query]
+        entry = {
+            'at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'operation': operation,
+            'namespace': namespace,
+            'route': route,
+            'shape': shape,
+            'sort': sort,
+            'duration_ms': round(seconds * 1000.0, 3),
+            'returned': returned,
+            'explained': False,
+        }
+        with self._lock:
+            self._entries.append(entry)
+        if command is not None and \
+                random.random() < self._config.get('SLOW_QUERY_EXPLAIN_RATE', 0.0):
+            try:
+                self._explainer().put_nowait((namespace, command, query, sort, entry))
+                return entry
+            except queue.Full:
+                pass
+        self._write(entry)
+        return entry
+
+    def _explainer(self):
+        if self._queue is None or self._pid != os.getpid():
+            with self._lock:
+                if self._queue is None or self._pid != os.getpid():
+                    self._queue = queue.Queue(maxsize=100)
+                    self._pid = os.getpid()
+                    threading.Thread(target=self._run, args=(self._queue,),
+                                     name='slow-query-explain', daemon=True).start()
+        return self._queue
+
+    def _run(self, q):
+        while True:
+            namespace, command, query, sort, entry = q.get()
+            try:
+                self.explain(namespace, command, query, sort, entry)
+            except Exception as e:
+                # whatever went wrong, this thread has to keep going
+                entry['explain_error'] = str(e)
+            self._write(entry)
+
+    def explain(self, namespace, command, query, sort, entry):
+        database, _, collection = namespace.partition('.')
+        db, _ = create_mongo_session(database, collection)
+        plan = db.command({'explain': command, 'verbosity': 'executionStats'})
+        stats = find_key(plan, 'executionStats') or {}
+        winning = find_key(plan, 'winningPlan') or {}
+        entry['explained'] = True
+        entry['docs_examined'] = stats.get('totalDocsExamined')
+        entry['keys_examined'] = stats.get('totalKeysExamined')
+        entry['execution_ms'] = stats.get('executionTimeMillis')
+        if entry['returned'] is None:
+            entry['returned'] = stats.get('nReturned')
+        entry['stages'] = sorted(set(plan_stages(winning)))
+        entry['collscan'] = 'COLLSCAN' in entry['stages']
+        if entry['collscan'] and isinstance(query, dict):
+            # finds are always sorted, on _id if nothing else
+            if entry['operation'] == 'find':
+                sort = sort_spec(parse_sort(sort))
+            entry['suggested_index'] = suggest_index(query, sort)
+
+    def entries(self, operation=None, route=None, min_ms=0.0, limit=50):
+        with self._lock:
+            entries = list(self._entries)
+        found = []
+        for entry in reversed(entries):
+            if operation is not None and entry['operation'] != operation:
+                continue
+            if route is not None and entry['route'] != route:
+                continue
+            if entry['duration_ms'] < min_ms:
+                continue
+            found.append(dict(entry))
+            if len(found) >= limit:
+                break
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_queries = SlowQueryLog()
+slow_queries.configure(settings)
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Our dashboards ask for the same things thousands of times a
+    minute, and the data hardly ever changes, so ResultCache
+    remembers the encoded answer for a little while.  The key is
+    everything that changes the answer: the collection, the
+    filter, the projection, the sort and the page.
+
+    Entries live for RESULT_CACHE_TTL seconds and only the most
+    recently used RESULT_CACHE_MAX_ENTRIES are kept.  Results
+    bigger than RESULT_CACHE_MAX_ENTRY_BYTES aren't worth keeping.
+
+    Instead of hunting down every entry when a collection changes,
+    each collection has a version number that is part of every
+    key.  Our write helpers call invalidate(), which bumps the
+    version, and the old entries can never be found again.
+
+    With more than one worker process each one has its own cache,
+    so there can be a shared tier behind it.  SharedTier is the
+    little in-process stand-in, RedisTier the real thing, and
+    both answer to get(), set() and incr().  When there's a
+    shared tier the version numbers live there too, so a write in
+    one worker invalidates every worker.
+'''
+class SharedTier(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+            if expires is not None and expires < time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._values[key] = (value, expires)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self._values.get(key, (0, None))[0]) + 1
+            self._values[key] = (value, None)
+            return value
+
+
+class RedisTier(object):
+    def __init__(self, url):
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._redis.get(key)
+        return None if value is None else value.decode('utf-8')
+
+    def set(self, key, value, ttl=None):
+        self._redis.set(key, value, ex=None if ttl is None else max(1, int(ttl)))
+
+    def incr(self, key):
+        return self._redis.incr(key)
+
+
+class ResultCache(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._changed = {}
+        self._epoch = None
+        self._shared = None
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def configure(self, config):
+        self._config = config
+        self._shared = None
+
+    @property
+    def shared(self):
+        if self._shared is None:
+            url = self._config.get('RESULT_CACHE_SHARED')
+            if url == 'local':
+                self._shared = SharedTier()
+            elif url:
+                self._shared = RedisTier(url)
+        return self._shared
+
+    def version(self, namespace):
+        if self.shared is not None:
+            return int(self.shared.get('version:' + namespace) or 0)
+        return self._versions.get(namespace, 0)
+
+    def key(self, namespace, *parts):
+        # json_util knows how to write ObjectIds and dates, sort_keys
+        # makes {'a': 1, 'b': 2} and {'b': 2, 'a': 1} the same key
+        raw = json_util.dumps(parts, sort_keys=True).encode('utf-8')
+        digest = hashlib.sha1(raw).hexdigest()
+        return (namespace, self.version(namespace), digest)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+                self.expirations += 1
+        if self.shared is not None:
+            value = self.shared.get('result:%s:%s:%s' % key)
+            if value is not None:
+                self._store(key, value)
+                with self._lock:
+                    self.hits += 1
+                    self.shared_hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        if len(value) > self._config.get('RESULT_CACHE_MAX_ENTRY_BYTES', 1024 * 1024):
+            return
+        self._store(key, value)
+        # the shared tier only holds text, binary answers stay here
+        if self.shared is not None and isinstance(value, str):
+            self.shared.set('result:%s:%s:%s' % key, value,
+                            self._config.get('RESULT_CACHE_TTL', 10.0))
+
+    def _store(self, key, value):
+        expires = time.monotonic() + self._config.get('RESULT_CACHE_TTL', 10.0)
+        max_entries = self._config.get('RESULT_CACHE_MAX_ENTRIES', 1024)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def tee(self, key, chunks):
+        # pass a streamed body through to the client, keeping a copy
+        # to cache if it isn't too big and the client reads all of it
+        limit = self._config.get('RESULT_CACHE_MAX_ENTRY_BYTES', 1024 * 1024)
+        body, size = [], 0
+        for chunk in chunks:
+            if body is not None:
+                size += len(chunk)
+                if size <= limit:
+                    body.append(chunk)
+                else:
+                    body = None
+            yield chunk
+        if body is not None:
+            self.set(key, (b'' if body and isinstance(body[0], bytes) else '').join(body))
+
+    def invalidate(self, namespace):
+        now = time.time()
+        if self.shared is not None:
+            self.shared.incr('version:' + namespace)
+            self.shared.set('changed:' + namespace, repr(now))
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+            self._changed[namespace] = now
+            for key in [k for k in self._entries if k[0] == namespace]:
+                del self._entries[key]
+            self.invalidations += 1
+
+    def epoch(self):
+        # who is counting: a version number only means something
+        # together with the process that counted it
+        if self._epoch is None or self._epoch[0] != os.getpid():
+            self._epoch = (os.getpid(), os.urandom(8).hex(), time.time())
+        return self._epoch[1]
+
+    def changed_at(self, namespace):
+        # when the collection last changed, as far as we know, if we
+        # haven't seen it change that's when we started counting
+        self.epoch()
+        if self.shared is not None:
+            changed = self.shared.get('changed:' + namespace)
+            if changed is not None:
+                return float(changed)
+        with self._lock:
+            return self._changed.get(namespace, self._epoch[2])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': bool(self._config.get('RESULT_CACHE_ENABLED')),
+                'shared': bool(self._config.get('RESULT_CACHE_SHARED')),
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+result_cache = ResultCache()
+result_cache.configure(settings)
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Single-flight.  When a dashboard refreshes, dozens of requests
+    for the very same find arrive at once, all miss the cache
+    (nothing is cached until the first one finishes) and all go to
+    MongoDB.
+
+    run() lets the first one (the leader) go ahead and makes the
+    rest (followers) wait for it.  Every chunk the leader sends its
+    client is kept on the Flight and handed to each follower as it
+    arrives, so a herd of identical requests costs one query and
+    one encoding.  start() runs the query up to its first batch
+    (see PrimedCursor), so the herd can join while MongoDB works.
+    Followers can join until the first chunk is out, after that a
+    chunk is only kept until every follower has it, so a find nobody
+    shares still streams in constant memory.  The key is the result
+    cache's key, so only requests that would get exactly the same
+    answer share one, and a write bumps the version, so nobody joins
+    a query that started before it.
+
+    If the leader's client hangs up, the leader keeps reading for
+    the followers.  If the leader fails before its first chunk (a
+    400, MongoDB is down) or has nothing within SINGLE_FLIGHT_WAIT,
+    each follower runs the query itself, before it answers, and gets
+    its own answer or its own error.  Once the first chunk is out a
+    follower waits for the leader however long it takes.  This is
+    per process, each worker has its own flights.
+'''
+class PrimedCursor(object):
+    # a pymongo cursor doesn't ask MongoDB anything until the first
+    # next(), by then the leader has sent its first chunk and nobody
+    # can join any more.  This one asks straight away
+    def __init__(self, cursor):
+        self._cursor = cursor
+        started = time.perf_counter()
+        self._first = next(cursor, None)
+        self.waited = time.perf_counter() - started
+        self._primed = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._primed:
+            self._primed = False
+            if self._first is None:
+                raise StopIteration
+            first, self._first = self._first, None
+            return first
+        return next(self._cursor)
+
+    def close(self):
+        self._first = None
+        self._cursor.close()
+
+
+class Flight(object):
+    def __init__(self):
+        self.changed = threading.Condition()
+        # chunks[0] is chunk number first, produced counts them all
+        self.chunks = []
+        self.first = 0
+        self.produced = 0
+        # how many chunks each follower still reading has been sent
+        self.sent = {}
+        self.done = False
+        self.failed = False
+
+    def trim(self):
+        # drop what every follower already has, call with changed held
+        low = min(self.sent.values()) if self.sent else self.produced
+        del self.chunks[:low - self.first]
+        self.first = low
+
+
+class FlightBody(object):
+    # a generator never started never runs its finally, so a response
+    # nobody iterates (a HEAD) would hold its flight open for good
+    def __init__(self, chunks, unstarted):
+        self._chunks = chunks
+        self._unstarted = unstarted
+        self._started = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._started = True
+        return next(self._chunks)
+
+    def close(self):
+        if not self._started:
+            self._started = True
+            self._unstarted()
+        self._chunks.close()
+
+
+class SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._flights = {}
+        self.led = 0
+        self.coalesced = 0
+        self.fallbacks = 0
+
+    def configure(self, config):
+        self._config = config
+
+    def run(self, key, start):
+        # start() makes the body, run() returns one that may be shared
+        if not self._config.get('SINGLE_FLIGHT_ENABLED'):
+            return start()
+        token = object()
+        with self._lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = Flight()
+                self.led += 1
+            else:
+                with flight.changed:
+                    flight.sent[token] = 0
+                self.coalesced += 1
+        if leading:
+            try:
+                body = start()
+            except BaseException:
+                self._finish(key, flight, False)
+                raise
+
+            def unstarted():
+                body.close()
+                self._finish(key, flight, False)
+            return FlightBody(self._lead(key, flight, body), unstarted)
+        # make up our mind now, once we return a body the status has
+        # gone out and it's too late to run the query ourselves
+        with flight.changed:
+            flight.changed.wait_for(lambda: flight.produced or flight.done,
+                                    self._config.get('SINGLE_FLIGHT_WAIT', 30.0))
+            ready = flight.produced > 0 or (flight.done and not flight.failed)
+        if not ready:
+            self._leave(flight, token)
+            self._give_up(key, flight)
+            return start()
+        return FlightBody(self._follow(flight, token),
+                          lambda: self._leave(flight, token))
+
+    def _keep(self, key, flight, chunk):
+        if not flight.produced:
+            # from the first chunk on nobody new can join, that way
+            # we only keep what the followers we have still need
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+        with flight.changed:
+            flight.produced += 1
+            if flight.sent:
+                flight.chunks.append(chunk)
+            else:
+                flight.first = flight.produced
+            flight.changed.notify_all()
+
+    def _lead(self, key, flight, body):
+        finished = False
+        try:
+            for chunk in body:
+                self._keep(key, flight, chunk)
+                yield chunk
+            finished = True
+        except GeneratorExit:
+            # our client hung up, finish the query for the followers
+            if flight.sent:
+                try:
+                    for chunk in body:
+                        self._keep(key, flight, chunk)
+                    finished = True
+                except Exception:
+                    log.exception("shared find failed")
+            raise
+        finally:
+            body.close()
+            self._finish(key, flight, finished)
+
+    def _follow(self, flight, token):
+        sent = 0
+        try:
+            while True:
+                with flight.changed:
+                    flight.changed.wait_for(lambda: sent < flight.produced or flight.done)
+                    chunks = flight.chunks[sent - flight.first:]
+                    done, failed = flight.done, flight.failed
+                    sent += len(chunks)
+                    flight.sent[token] = sent
+                    flight.trim()
+                for chunk in chunks:
+                    yield chunk
+                if done and sent == flight.produced:
+                    if failed:
+                        raise RuntimeError("the find we were sharing broke off")
+                    return
+        finally:
+            self._leave(flight, token)
+
+    def _leave(self, flight, token):
+        with flight.changed:
+            if flight.sent.pop(token, None) is not None:
+                flight.trim()
+
+    def _finish(self, key, flight, ok):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        with flight.changed:
+            if flight.done:
+                return
+            flight.done = True
+            flight.failed = not ok
+            flight.changed.notify_all()
+
+    def _give_up(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            self.fallbacks += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': bool(self._config.get('SINGLE_FLIGHT_ENABLED')),
+                'in_flight': len(self._flights),
+                'led': self.led,
+                'coalesced': self.coalesced,
+                'fallbacks': self.fallbacks,
+            }
+
+
+single_flight = SingleFlight()
+single_flight.configure(settings)
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Change streams.  Our write helpers bump a collection's version,
+    but writes from another worker (without a shared cache tier), a
+    script or the mongo shell don't go through them.  For every
+    namespace in VERSION_CHANGE_STREAMS each process runs a thread
+    that watches the collection with a change stream and bumps the
+    version (which clears the cached answers too) on every change
+    MongoDB tells it about.
+
+    Change streams need a replica set.  While the stream is down
+    watching() says so, and the ETags fall back to changing every
+    RESULT_CACHE_TTL seconds.  After a reconnect we resume where we
+    left off, and bump the version once in case we missed something.
+'''
+class ChangeFeed(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._pid = None
+        self._watching = set()
+        self.changes = 0
+
+    def configure(self, config):
+        self._config = config
+
+    def namespaces(self):
+        # create_app() may be handed a list, skip what can't be a namespace
+        return [namespace for namespace in self._config.get('VERSION_CHANGE_STREAMS', ())
+                if isinstance(namespace, str) and '.' in namespace]
+
+    def watching(self, namespace):
+        if namespace not in self.namespaces():
+            return False
+        self._start()
+        with self._lock:
+            return namespace in self._watching
+
+    def _start(self):
+        # one thread per namespace per process, forked workers start their own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._watching = set()
+            for namespace in self.namespaces():
+                threading.Thread(target=self._run, args=(namespace,),
+                                 name='change-feed', daemon=True).start()
+
+    def _run(self, namespace):
+        database, _, collection = namespace.partition('.')
+        token = None
+        while True:
+            try:
+                _, col = create_mongo_session(database, collection)
+                with col.watch(resume_after=token) as stream:
+                    with self._lock:
+                        self._watching.add(namespace)
+                    result_cache.invalidate(namespace)
+                    for change in stream:
+                        token = stream.resume_token
+                        result_cache.invalidate(namespace)
+                        with self._lock:
+                            self.changes += 1
+            except Exception as e:
+                # whatever went wrong, this thread has to keep going
+                log.warning("change stream on %s stopped: %s", namespace, e)
+            with self._lock:
+                self._watching.discard(namespace)
+            time.sleep(1.0)
+
+
+change_feed = ChangeFeed()
+change_feed.configure(settings)
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Snapshots.  With SNAPSHOT_DIR set, mongo_find() looks for
+    <SNAPSHOT_DIR>/apitest.v1.snap (made by snapshot_mongo.py) and
+    answers from it when it can: equality and range filters, top
+    level projections, any sort and any page.  With numpy installed,
+    the filters its indexes can't do ($regex, $exists, $or, $ne...)
+    are run by filter_engine.py over the snapshot's columns instead.
+    Anything neither can answer exactly like MongoDB would goes to
+    MongoDB as usual, and is counted as a fallback.
+
+    Each process checks the file at most every
+    SNAPSHOT_CHECK_INTERVAL seconds.  When a new export has been
+    renamed over it, the new file is opened and swapped in, the old
+    one stays open for whoever is still reading it and is unmapped
+    when the last of them lets go.
+'''
+class Snapshots(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._loaded = {}
+        self.served = 0
+        self.fallbacks = 0
+        self.swaps = 0
+
+    def configure(self, config):
+        self._config = config
+        with self._lock:
+            self._loaded = {}
+
+    def get(self, namespace):
+        directory = self._config.get('SNAPSHOT_DIR')
+        if not directory:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            loaded = self._loaded.get(namespace)
+            interval = self._config.get('SNAPSHOT_CHECK_INTERVAL', 1.0)
+            if loaded is not None and now - loaded['checked'] < interval:
+                return loaded['snapshot']
+        path = snapshot_mongo.snapshot_path(directory, namespace)
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            stamp = None
+        snapshot = None
+        if loaded is not None and loaded['stamp'] == stamp:
+            snapshot = loaded['snapshot']
+        elif stamp is not None:
+            try:
+                snapshot = snapshot_mongo.Snapshot(path)
+            except (OSError, ValueError) as e:
+                # keep what we had rather than serving nothing
+                log.warning("can't open snapshot %s: %s", path, e)
+                snapshot = loaded and loaded['snapshot']
+                stamp = loaded and loaded['stamp']
+        with self._lock:
+            if loaded is not None and snapshot is not loaded['snapshot']:
+                self.swaps += 1
+            self._loaded[namespace] = {'snapshot': snapshot, 'stamp': stamp,
+                                       'checked': now}
+        return snapshot
+
+    def answered(self, served):
+        with self._lock:
+            if served:
+                self.served += 1
+            else:
+                self.fallbacks += 1
+
+    def stats(self):
+        with self._lock:
+            loaded = {namespace: entry['snapshot'] for namespace, entry
+                      in self._loaded.items() if entry['snapshot'] is not None}
+            return {
+                'enabled': bool(self._config.get('SNAPSHOT_DIR')),
+                'served': self.served,
+                'fallbacks': self.fallbacks,
+                'swaps': self.swaps,
+                'snapshots': {namespace: {
+                    'path': snapshot.path,
+                    'documents': snapshot.count,
+                    'bytes': snapshot.size,
+                    'exported_at': snapshot.exported_at,
+                    'fields': sorted(snapshot.columns),
+                } for namespace, snapshot in loaded.items()},
+            }
+
+
+snapshots = Snapshots()
+snapshots.configure(settings)
+
+
+@functools.lru_cache(maxsize=None)
+def load_filter_engine():
+    # filter_engine.py needs numpy, without it we only have the indexes
+    try:
+        return importlib.import_module('filter_engine')
+    except ImportError:
+        return None
+
+
+def snapshot_rows(snapshot, query, sort, position, at_most):
+    try:
+        return snapshot.find(query, sort, position, at_most)
+    except snapshot_mongo.Unanswerable:
+        engine = load_filter_engine()
+        if engine is None:
+            raise
+        return engine.find(engine.engine_for(snapshot), query, sort, position, at_most)
+
+
+def snapshot_find(snapshot, query, projection, hidden, sort, limit, position, encoding):
+    # mongo_find() from a snapshot, None if it can't answer this query
+    cap = current_config()["FIND_MAX_ROWS"]
+    try:
+        snapshot_mongo.project({}, projection)
+        rows = snapshot_rows(snapshot, query, sort, position,
+                             (cap if limit is None else limit) + 1)
+    except snapshot_mongo.Unanswerable:
+        snapshots.answered(False)
+        return None
+    snapshots.answered(True)
+    if limit is None and len(rows) > cap:
+        flask.abort(400, "query matches more than %d rows, page through "
+                         "it with limit and after" % cap)
+    batch_size = current_config()["FIND_BATCH_SIZE"]
+    if projection is None and encoding in RAW_ENCODINGS:
+        # the documents are already BSON, same as find_raw_batches() gives us
+        cursor = (b''.join(snapshot.document(row) for row in rows[i:i + batch_size])
+                  for i in range(0, len(rows), batch_size))
+        return stream_raw_results(cursor, limit, sort, None, metrics.route(), encoding)
+    cursor = (snapshot_mongo.project(bson.decode(snapshot.document(row)), projection)
+              for row in rows)
+    return stream_results(cursor, batch_size, limit, sort, hidden, None,
+                          metrics.route(), encoding)
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Write-behind.  Normally /insert waits for MongoDB to say the
+    document is safe before it answers, so when lots of inserts
+    arrive at once every request thread sits around waiting.
+
+    With WRITE_BEHIND_ENABLED the routes put the document on a
+    queue and answer straight away, and one background thread per
+    process writes whatever has piled up with insert_many().  The
+    trade off: the client hears "ok" before the data is written,
+    and whatever is still queued is lost if the process is killed
+    hard.  On a normal shutdown stop() writes out what's left.
+
+    The queue is bounded.  When it's full submit() raises
+    queue.Full and the route answers 429 Too Many Requests, so a
+    slow database pushes back on clients instead of eating all
+    our memory.
+'''
+class WriteBehind(object):
+    STOP = object()
+
+    def __init__(self, database='apitest', collection='v1'):
+        self.database = database
+        self.collection = collection
+        self._lock = threading.Lock()
+        self._config = {}
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.reset_metrics()
+
+    def configure(self, config):
+        self._config = config
+
+    def reset_metrics(self):
+        self.metrics = {
+            'queued': 0,
+            'rejected': 0,
+            'flushed': 0,
+            'failed': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'max_batch_size': 0,
+            'flush_ms_total': 0.0,
+            'flush_ms_max': 0.0,
+            'lag_ms_max': 0.0,
+        }
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self.metrics[name] += delta
+
+    def _start(self):
+        # one queue and one thread per process, a forked worker does not
+        # inherit the parent's thread, so it starts its own
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self._config.get('WRITE_BEHIND_QUEUE_SIZE', 10000))
+            self._thread = threading.Thread(target=self._run, args=(self._queue,),
+                                            name='write-behind', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def submit(self, doc):
+        self._start()
+        try:
+            self._queue.put_nowait((time.monotonic(), doc))
+        except queue.Full:
+            self._count(rejected=1)
+            raise
+        self._count(queued=1)
+
+    def _run(self, q):
+        batch_size = self._config.get('WRITE_BEHIND_BATCH_SIZE', 500)
+        interval = self._config.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.5)
+        batch, deadline = [], None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = q.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is self.STOP:
+                self._flush(batch)
+                return
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + interval
+                batch.append(item)
+            if batch and (len(batch) >= batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch, deadline = [], None
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        docs = [doc for _, doc in batch]
+        lag_ms = (time.monotonic() - batch[0][0]) * 1000
+        started = time.perf_counter()
+        try:
+            concern = WriteConcern(w=self._config.get('WRITE_BEHIND_WRITE_CONCERN', 1))
+            inserted, failed, errors = mongo_insert_many(
+                docs, self.database, self.collection, ordered=False,
+                write_concern=concern)
+            for error in errors[:5]:
+                log.warning("write-behind insert failed: %s", error.get('errmsg'))
+        except PyMongoError as e:
+            log.error("write-behind lost %d documents: %s", len(docs), e)
+            inserted, failed = 0, len(docs)
+        except Exception:
+            # a document BSON can't encode, a broken hook... the thread
+            # must live on, or the queue fills and every insert gets 429
+            log.exception("write-behind lost %d documents", len(docs))
+            inserted, failed = 0, len(docs)
+        flush_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            metrics = self.metrics
+            metrics['flushed'] += inserted
+            metrics['failed'] += failed
+            metrics['batches'] += 1
+            metrics['last_batch_size'] = len(docs)
+            metrics['max_batch_size'] = max(metrics['max_batch_size'], len(docs))
+            metrics['flush_ms_total'] += flush_ms
+            metrics['flush_ms_max'] = max(metrics['flush_ms_max'], flush_ms)
+            metrics['lag_ms_max'] = max(metrics['lag_ms_max'], lag_ms)
+
+    def stop(self, timeout=None):
+        # write out whatever is still queued, then let the thread end
+        if self._thread is None or self._pid != os.getpid():
+            return
+        if timeout is None:
+            timeout = self._config.get('WRITE_BEHIND_DRAIN_TIMEOUT', 10.0)
+        deadline = time.monotonic() + timeout
+        try:
+            # a full queue with MongoDB down never makes room for STOP
+            self._queue.put(self.STOP, timeout=timeout)
+            self._thread.join(max(0, deadline - time.monotonic()))
+        except queue.Full:
+            pass
+        if self._thread.is_alive():
+            # keep it, a submit() now must not start a second flusher
+            log.error("write-behind is still flushing with %d documents queued, "
+                      "they are lost if the process exits now", self._queue.qsize())
+            return
+        self._thread = None
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.metrics)
+        running = self._thread is not None and self._pid == os.getpid()
+        stats['enabled'] = bool(self._config.get('WRITE_BEHIND_ENABLED'))
+        stats['running'] = running
+        stats['queue_depth'] = self._queue.qsize() if running else 0
+        stats['flush_ms_avg'] = (stats['flush_ms_total'] / stats['batches']
+                                 if stats['batches'] else 0.0)
+        return stats
+
+
+write_behind = WriteBehind()
+write_behind.configure(settings)
+atexit.register(write_behind.stop)
+
+
+def insert_document(doc):
+    # what /insert and /insertargs call, straight to MongoDB, or onto
+    # the write-behind queue when that's switched on.  True if queued
+    if not current_config()["WRITE_BEHIND_ENABLED"]:
+        mongo_insert_one(doc)
+        return False
+    try:
+        write_behind.submit(doc)
+    except queue.Full:
+        flask.abort(429, "too many inserts waiting, try again shortly")
+    return True
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Every statistic in titanic_mongo.py (how many survived, how
+    many were under 18, where people boarded...) is a full count or
+    distinct over the whole collection, every single time someone
+    asks.  Those numbers only change when the data does, so the
+    Rollups keep them in a side collection (ROLLUP_COLLECTION) and
+    the stats routes just read them back, one lookup by _id.
+
+    To stay current without recounting:
+      - inserts through this API bump the counts, and add new values
+        to the distinct lists, for the documents that match
+      - updates and deletes mark the collection's rollups stale, the
+        refresh thread recounts them a little later
+      - everything is recounted once it is ROLLUP_MAX_AGE old anyway,
+        that catches writes that didn't come through the API
+
+    Every rollup says when it was last recounted (refreshed_at),
+    when it was last bumped (updated_at) and whether it is waiting to
+    be recounted (stale), so you know how far to trust it.
+
+    Deciding whether a new document matches a rollup's filter takes
+    a little MongoDB filter interpreter, doc_matches().  It knows the
+    operators we use in titanic_mongo.py, anything else makes the
+    rollup stale instead of guessing.
+'''
+class UnsupportedFilter(ValueError):
+    pass
+
+
+def bson_bracket(value):
+    # MongoDB only compares values of the same kind, 5 < 'a' is never true
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, float)):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, (list, dict)):
+        raise UnsupportedFilter("arrays and embedded documents")
+    return type(value).__name__
+
+
+def values_equal(a, b):
+    return bson_bracket(a) == bson_bracket(b) and a == b
+
+
+def match_operator(present, value, op, arg):
+    if op == '$exists':
+        return present == bool(arg)
+    if op == '$eq':
+        return values_equal(value, arg)
+    if op == '$ne':
+        return not values_equal(value, arg)
+    if op == '$in':
+        return any(values_equal(value, item) for item in arg)
+    if op == '$nin':
+        return not any(values_equal(value, item) for item in arg)
+    if op == '$regex':
+        return isinstance(value, str) and re.search(arg, value) is not None
+    if op in ('$lt', '$lte', '$gt', '$gte'):
+        if value is None or bson_bracket(value) != bson_bracket(arg):
+            return False
+        return {'$lt': value < arg, '$lte': value <= arg,
+                '$gt': value > arg, '$gte': value >= arg}[op]
+    raise UnsupportedFilter(op)
+
+
+def doc_matches(doc, query):
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(doc_matches(doc, part) for part in condition):
+                return False
+        elif key == '$or':
+            if not any(doc_matches(doc, part) for part in condition):
+                return False
+        elif key == '$nor':
+            if any(doc_matches(doc, part) for part in condition):
+                return False
+        elif key.startswith('$') or '.' in key:
+            raise UnsupportedFilter(key)
+        else:
+            present, value = key in doc, doc.get(key)
+            bson_bracket(value)
+            if isinstance(condition, dict) and condition and \
+                    all(op.startswith('$') for op in condition):
+                operators = condition.items()
+            else:
+                operators = [('$eq', condition)]
+            for op, arg in operators:
+                if not match_operator(present, value, op, arg):
+                    return False
+    return True
+
+
+class Rollups(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self._thread = None
+        self._pid = None
+
+    def configure(self, config):
+        self._config = config
+
+    def declared(self, namespace):
+        return self._config.get('ROLLUPS', {}).get(namespace, {})
+
+    def _side(self, namespace):
+        database, _, collection = namespace.partition('.')
+        _, side = create_mongo_session(database, self._config.get('ROLLUP_COLLECTION', 'rollups'))
+        return collection, side
+
+    def refresh(self, namespace, name=None):
+        # recount from scratch, all of the collection's rollups or just one
+        database, _, collection = namespace.partition('.')
+        _, col = create_mongo_session(database, collection)
+        _, side = self._side(namespace)
+        for rollup, spec in self.declared(namespace).items():
+            if name is not None and rollup != name:
+                continue
+            rollup_id = collection + ':' + rollup
+            for attempt in range(3):
+                # on_insert bumps version, if it moved while we counted an
+                # insert landed in between and our count may be off by it
+                version = side.find_one_and_update(
+                    {'_id': rollup_id},
+                    {'$setOnInsert': {'collection': collection, 'name': rollup,
+                                      'stale': True, 'version': 0}},
+                    upsert=True, return_document=ReturnDocument.AFTER).get('version')
+                if 'count' in spec:
+                    value = col.count_documents(spec['count'])
+                else:
+                    value = sorted(col.distinct(spec['distinct'], spec.get('filter', {})),
+                                   key=lambda v: (bson_bracket(v), v))
+                now = datetime.datetime.now(datetime.timezone.utc)
+                counted = {
+                    'collection': collection,
+                    'name': rollup,
+                    'value': value,
+                    'refreshed_at': now,
+                    'updated_at': now,
+                    'stale': False,
+                    'version': version or 0,
+                }
+                if side.replace_one({'_id': rollup_id, 'version': version},
+                                    counted).matched_count:
+                    break
+            else:
+                # inserts keep racing us, keep the count but have the
+                # refresh thread count it again
+                counted['stale'] = True
+                side.replace_one({'_id': rollup_id}, counted)
+
+    def on_insert(self, namespace, docs):
+        declared = self.declared(namespace)
+        if not declared or not docs:
+            return
+        collection, side = self._side(namespace)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        updates, stale = [], []
+        for rollup, spec in declared.items():
+            try:
+                if 'count' in spec:
+                    matched = sum(1 for doc in docs if doc_matches(doc, spec['count']))
+                    change = {'$inc': {'value': matched}}
+                else:
+                    field = spec['distinct']
+                    values = [doc[field] for doc in docs if field in doc
+                              and doc_matches(doc, spec.get('filter', {}))]
+                    for value in values:
+                        bson_bracket(value)
+                    change = {'$addToSet': {'value': {'$each': values}}}
+            except UnsupportedFilter:
+                stale.append(rollup)
+                continue
+            change['$set'] = {'updated_at': now}
+            change.setdefault('$inc', {})['version'] = 1
+            # only bump rollups that have been counted, the others get a
+            # full count the first time somebody asks for them anyway
+            updates.append(UpdateOne({'_id': collection + ':' + rollup}, change))
+        for rollup in stale:
+            updates.append(UpdateOne({'_id': collection + ':' + rollup},
+                                     {'$set': {'stale': True}}))
+        try:
+            side.bulk_write(updates, ordered=False)
+        except PyMongoError as e:
+            log.warning("could not update rollups for %s: %s", namespace, e)
+        self._start()
+
+    def on_change(self, namespace):
+        if not self.declared(namespace):
+            return
+        collection, side = self._side(namespace)
+        try:
+            side.update_many({'collection': collection}, {'$set': {'stale': True}})
+        except PyMongoError as e:
+            log.warning("could not mark rollups stale for %s: %s", namespace, e)
+        self._start()
+
+    def get(self, namespace, name=None):
+        # the stored rollups, counting any that have never been counted
+        self._start()
+        collection, side = self._side(namespace)
+        declared = self.declared(namespace)
+        if name is not None and name not in declared:
+            return None
+        wanted = [name] if name is not None else list(declared)
+        # a rollup without refreshed_at is one refresh() hasn't finished
+        found = {doc['name']: doc for doc in side.find(
+            {'_id': {'$in': [collection + ':' + rollup for rollup in wanted]}})
+            if 'refreshed_at' in doc}
+        missing = [rollup for rollup in wanted if rollup not in found]
+        for rollup in missing:
+            self.refresh(namespace, rollup)
+            found[rollup] = side.find_one({'_id': collection + ':' + rollup})
+        now = datetime.datetime.now(datetime.timezone.utc)
+        stats = {}
+        for rollup in wanted:
+            doc = found[rollup]
+            refreshed_at = doc['refreshed_at']
+            if refreshed_at.tzinfo is None:
+                refreshed_at = refreshed_at.replace(tzinfo=datetime.timezone.utc)
+            stats[rollup] = {
+                'value': doc['value'],
+                'refreshed_at': doc['refreshed_at'],
+                'updated_at': doc.get('updated_at'),
+                'stale': doc.get('stale', False),
+                'age_seconds': (now - refreshed_at).total_seconds(),
+            }
+        return stats
+
+    def refresh_due(self):
+        # what the refresh thread does: recount what's stale or too old
+        max_age = datetime.timedelta(seconds=self._config.get('ROLLUP_MAX_AGE', 3600.0))
+        oldest = datetime.datetime.now(datetime.timezone.utc) - max_age
+        for namespace, declared in self._config.get('ROLLUPS', {}).items():
+            collection, side = self._side(namespace)
+            due = side.find({'collection': collection,
+                             '$or': [{'stale': True}, {'refreshed_at': {'$lt': oldest}}]},
+                            {'name': 1})
+            for doc in due:
+                if doc['name'] not in declared:
+                    continue
+                try:
+                    self.refresh(namespace, doc['name'])
+                except Exception:
+                    # say a distinct that returns documents we can't sort,
+                    # don't let one bad rollup stop the thread for all
+                    log.exception("could not refresh rollup %s on %s",
+                                  doc['name'], namespace)
+                    side.update_one({'_id': doc['_id']}, {'$set': {'stale': True}})
+
+    def _start(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='rollups', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._config.get('ROLLUP_REFRESH_INTERVAL', 60.0))
+            try:
+                self.refresh_due()
+            except PyMongoError as e:
+                log.warning("rollup refresh failed: %s", e)
+            except Exception:
+                log.exception("rollup refresh failed")
+
+
+rollups = Rollups()
+rollups.configure(settings)
+
+
+
+
+
+
+
+
+
+
+'''
+    Where does the time go?  Metrics keeps a histogram of how long
+    each phase of each route takes:
+
+        connect   getting the collection from the registry (building
+                  the client the first time)
+        query     until MongoDB hands us the first batch
+        iterate   waiting on MongoDB for the batches after that
+        encode    turning documents into JSON
+        render    filling in an HTML template
+
+    plus the whole request, and counters for requests (by status),
+    errors, documents returned and bytes sent.  /metrics shows it
+    all in the text format Prometheus scrapes.
+
+    Every gunicorn worker keeps its own numbers, so a scrape only
+    sees the worker that answered it.  Scrape each worker, or run a
+    single worker with more threads when you need the full picture.
+
+    When METRICS_ENABLED is false timed() hands back the same
+    do-nothing context manager every time and nothing is recorded,
+    so all it costs is an if.
+'''
+METRIC_HELP = {
+    'api_requests_total': ('counter', "Requests answered, by route and status."),
+    'api_errors_total': ('counter', "Requests that failed with a 5xx or broke off mid-stream."),
+    'api_documents_returned_total': ('counter', "Documents sent back to clients."),
+    'api_response_bytes_total': ('counter', "Response body bytes sent to clients."),
+    'api_request_seconds': ('histogram', "Time to answer a request, body included."),
+    'api_phase_seconds': ('histogram', "Time spent in each phase of a request."),
+}
+NOT_TIMED = contextlib.nullcontext()
+
+
+class PhaseTimer(object):
+    __slots__ = ('metrics', 'route', 'phase', 'started')
+
+    def __init__(self, metrics, route, phase):
+        self.metrics, self.route, self.phase = metrics, route, phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe('api_phase_seconds', (self.route, self.phase),
+                             time.perf_counter() - self.started)
+
+
+class Metrics(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config = {}
+        self.enabled = False
+        self.buckets = ()
+        self.reset()
+
+    def configure(self, config):
+        self._config = config
+        self.enabled = bool(config.get('METRICS_ENABLED'))
+        self.buckets = tuple(sorted(config.get('METRICS_BUCKETS', ())))
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def route(self):
+        # the route being served, None when we aren't recording
+        if not self.enabled:
+            return None
+        return current_route()
+
+    def timed(self, phase):
+        route = self.route()
+        if route is None:
+            return NOT_TIMED
+        return PhaseTimer(self, route, phase)
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            values = self.counters.setdefault(name, {})
+            values[labels] = values.get(labels, 0) + value
+
+    def observe(self, name, labels, seconds):
+        with self._lock:
+            values = self.histograms.setdefault(name, {})
+            entry = values.get(labels)
+            if entry is None:
+                entry = values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect.bisect_left(self.buckets, seconds)] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def record_cursor(self, route, page):
+        first = page['first'] or 0.0
+        self.observe('api_phase_seconds', (route, 'query'), first)
+        self.observe('api_phase_seconds', (route, 'iterate'), page['seconds'] - first)
+        self.observe('api_phase_seconds', (route, 'encode'),
+                     max(0.0, page['producing'] - page['seconds']))
+        self.inc('api_documents_returned_total', (route,), page['count'])
+
+    def finish(self, route, started, size, failed=False):
+        self.observe('api_request_seconds', (route,), time.perf_counter() - started)
+        self.inc('api_response_bytes_total', (route,), size)
+        if failed:
+            self.inc('api_errors_total', (route,))
+
+    def counted(self, route, started, chunks, failed=False):
+        # a streamed body is only finished when the last chunk is sent.
+        # Our JSON is all ASCII, so len() of a str chunk is its bytes
+        size, broken = 0, True
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+            broken = False
+        finally:
+            self.finish(route, started, size, failed or broken)
+
+    def render(self):
+        labels = {
+            'api_requests_total': ('route', 'status'),
+            'api_phase_seconds': ('route', 'phase'),
+        }
+        lines = []
+        with self._lock:
+            counters = {name: dict(values) for name, values in self.counters.items()}
+            histograms = {name: {key: (list(entry[0]), entry[1], entry[2])
+                                 for key, entry in values.items()}
+                          for name, values in self.histograms.items()}
+        for name, values in sorted(list(counters.items()) + list(histograms.items())):
+            kind, help_text = METRIC_HELP[name]
+            names = labels.get(name, ('route',))
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for key, value in sorted(values.items()):
+                label = ','.join('%s="%s"' % (n, v) for n, v in zip(names, key))
+                if kind == 'counter':
+                    lines.append('%s{%s} %s' % (name, label, value))
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        name, label, '+Inf' if bound == float('inf') else repr(bound),
+                        cumulative))
+                lines.append('%s_sum{%s} %r' % (name, label, total))
+                lines.append('%s_count{%s} %d' % (name, label, count))
+        # the pool and the cache keep their own counts, pass them along
+        for prefix, stats in (('mongo_pool', mongo_registry.stats()),
+                              ('result_cache', result_cache.stats()),
+                              ('single_flight', single_flight.stats())):
+            for key, value in sorted(stats.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append('# TYPE %s_%s gauge' % (prefix, key))
+                    lines.append('%s_%s %s' % (prefix, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.configure(settings)
         
 
 
@@ -313,7 +3956,7 @@ Section 2:  The Web Service... Also Known As Our API
     what happens if I navigate to
     http://www.somesite.com/
     Nothing the / at the end of that URL?  That
-    is defined within the @app.route line.  We
+    is defined within the @api.route line.  We
     also need to define what kind of request we
     are allowed to accept at this route.  
 
@@ -325,13 +3968,14 @@ Section 2:  The Web Service... Also Known As Our API
 '''
 
 # homepage
-@app.route("/", methods=["GET"])
+@api.route("/", methods=["GET"])
 def home_page():
     #use a flask method to read a static HTML file
     #this file get's served everytime we got to /
     #Doing this allows for updates to the content
     #without dropping our application offline
-    return flask.render_template('index.html')
+    with metrics.timed('render'):
+        return flask.render_template('index.html')
 
 
 
@@ -395,9 +4039,221 @@ def home_page():
 '''
 
 # root for api/v1
-@app.route('/api/v1', methods=['GET'])
+@api.route('/api/v1', methods=['GET'])
 def api_root():
-    return flask.render_template('docs.html')
+    with metrics.timed('render'):
+        return flask.render_template('docs.html')
+
+
+
+
+
+
+
+
+
+
+'''
+    Remember the connection registry from our helper functions?
+    This route shows how the pool behind it is doing.  If
+    'waiting' is regularly above zero, requests are queueing for
+    a connection and MONGO_MAX_POOL_SIZE is too small.  If
+    'created' keeps climbing, connections are being thrown away
+    and rebuilt, which is exactly what we wanted to stop.
+'''
+
+# GET to show how busy the MongoDB connection pool is
+@api.route('/api/v1/mongo/pool', methods=['GET'])
+def api_mongo_pool():
+    return jsonify(mongo_registry.stats())
+
+
+
+
+
+
+
+
+
+
+
+'''
+    And this one shows what the QueryAdvisor has learned about
+    the queries people actually send.  It explains the slowest
+    shapes against the database, so it's not free, don't poll it.
+    ?top=N picks how many shapes to look at.
+'''
+
+# GET to see which queries need an index
+@api.route('/api/v1/mongo/advisor', methods=['GET'])
+def api_mongo_advisor():
+    top = request.args.get('top', 10, type=int)
+    return flask.Response(json_util.dumps(query_advisor.report(top)),
+                          mimetype='application/json')
+
+
+
+
+
+
+
+
+
+
+'''
+    The slow query log, newest first.  Narrow it down with
+    ?operation=find, ?route=api.api_mongo_find_args, ?min_ms=500
+    and ?limit=20.  The full history is in SLOW_QUERY_LOG.
+'''
+
+# GET the most recent slow queries
+@api.route('/api/v1/mongo/slowqueries', methods=['GET'])
+def api_mongo_slow_queries():
+    entries = slow_queries.entries(
+        operation=request.args.get('operation'),
+        route=request.args.get('route'),
+        min_ms=request.args.get('min_ms', 0.0, type=float),
+        limit=request.args.get('limit', 50, type=int))
+    return flask.Response(json_util.dumps(entries), mimetype='application/json')
+
+
+
+
+
+
+
+
+
+
+
+'''
+    How well is the result cache doing?  Lots of misses and
+    evictions means RESULT_CACHE_MAX_ENTRIES is too small, lots
+    of expirations means the TTL is too short for how often the
+    same questions get asked.
+'''
+
+# GET to see the result cache counters
+@api.route('/api/v1/mongo/cache', methods=['GET'])
+def api_mongo_cache():
+    return jsonify(result_cache.stats())
+
+
+
+
+
+
+
+
+
+
+
+'''
+    If write-behind is on, this is how you keep an eye on it.
+    queue_depth creeping up means MongoDB can't keep up, a high
+    lag_ms_max means documents sit in the queue for a long time
+    before they are written, and any 'rejected' were turned away
+    with a 429.
+'''
+
+# GET to see how the write-behind queue is doing
+@api.route('/api/v1/mongo/writebehind', methods=['GET'])
+def api_mongo_write_behind():
+    return jsonify(write_behind.stats())
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Which snapshots this worker has open, how old they are, and how
+    many finds they answered.  Lots of fallbacks means the queries
+    people send need something snapshots can't do, like a regex.
+'''
+
+# GET to see the snapshots the find routes answer from
+@api.route('/api/v1/mongo/snapshot', methods=['GET'])
+def api_mongo_snapshot():
+    return jsonify(snapshots.stats())
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Every request through the API is timed, see Metrics.  Point
+    Prometheus at /metrics, or just read it, it's plain text.
+'''
+@api.before_request
+def start_request_timer():
+    if metrics.enabled:
+        flask.g.metrics_started = time.perf_counter()
+
+
+@api.after_request
+def record_request(response):
+    started = flask.g.pop('metrics_started', None)
+    if started is None:
+        return response
+    route = request.endpoint or 'unknown'
+    metrics.inc('api_requests_total', (route, str(response.status_code)))
+    failed = response.status_code >= 500
+    if response.is_streamed:
+        response.response = metrics.counted(route, started, response.response, failed)
+    else:
+        metrics.finish(route, started, response.content_length or 0, failed)
+    return response
+
+
+# GET request timings and counters for Prometheus
+@api.route('/metrics', methods=['GET'])
+def api_metrics():
+    if not metrics.enabled:
+        flask.abort(404, "metrics are switched off, set METRICS_ENABLED")
+    return flask.Response(metrics.render(),
+                          mimetype='text/plain; version=0.0.4')
+
+
+
+
+
+
+
+
+
+
+'''
+    The statistics from titanic_mongo.py, without counting anything.
+    /api/v1/mongo/stats gives you all of them, add the name of one
+    (/api/v1/mongo/stats/survivors) for just that one.  Check
+    refreshed_at and stale to see how fresh the number is, and add
+    ?refresh=true if you really need it recounted right now.
+'''
+
+# GET precomputed statistics
+@api.route('/api/v1/mongo/stats', methods=['GET'])
+@api.route('/api/v1/mongo/stats/<name>', methods=['GET'])
+def api_mongo_stats(name=None):
+    if name is not None and name not in rollups.declared('apitest.v1'):
+        flask.abort(404, "there is no rollup called %s" % name)
+    if request.args.get('refresh', 'false').lower() in TRUE_STRINGS:
+        rollups.refresh('apitest.v1', name)
+    stats = rollups.get('apitest.v1', name)
+    if name is not None:
+        stats = stats[name]
+    return flask.Response(json_util.dumps(stats), mimetype='application/json')
 
 
 
@@ -468,12 +4324,18 @@ def api_root():
 
     Refer to the MongoDB documentation if you don't understand
     why {} was the filter arguement for our mongo_find function
+
+    This route can return a LOT of documents, so we ask
+    mongo_find() to stream them back as JSON instead of building
+    one giant string first.  Big collections have to be paged
+    through, try /api/v1/mongo/find/all?limit=50 and then send the
+    'next' token you get back as ?after=<token>
 '''
 
 # GET to show data from MongoDB
-@app.route('/api/v1/mongo/find/all', methods=['GET'])
+@api.route('/api/v1/mongo/find/all', methods=['GET'])
 def api_mongo_find_all():
-    return mongo_find({})
+    return mongo_find({}, stream=True, **find_args(request.args))
 
 
 
@@ -513,13 +4375,16 @@ def api_mongo_find_all():
 '''
 
 # GET to filter find query from MongoDB
-@app.route('/api/v1/mongo/find', methods=['GET', 'POST'])
+@api.route('/api/v1/mongo/find', methods=['GET', 'POST'])
 def api_mongo_find():
     if request.method == 'GET':
         return flask.render_template('query.html')
     elif request.method == 'POST':
         data = parse_form()
-        return mongo_find(data)
+        kwargs = find_args(data)
+        for key in FIND_ARGS:
+            data.pop(key, None)
+        return mongo_find(data, **kwargs)
 
 
 
@@ -566,12 +4431,96 @@ def api_mongo_find():
     Refer to HTTP query strings for more information about
     how to craft a query like this (hint:  give examples
     in your documentation!)
+
+    The query string goes through compile_query() first, so
+    you can write things like
+    /api/v1/mongo/findargs?survived=1&age__lt=18&fields=name,age
+
+    limit, after, sort and fields are not fields of our documents,
+    they control paging and projection (see the helpers), so we
+    take them out of the filter before it goes to MongoDB.
 '''
 
 # GET to filter find query from MongoDB with request.args
-@app.route('/api/v1/mongo/findargs', methods=['GET'])
+@api.route('/api/v1/mongo/findargs', methods=['GET'])
 def api_mongo_find_args():
-    return mongo_find(request.args)
+    query = compile_query(request.args, ignore=FIND_ARGS)
+    return mongo_find(query, **find_args(request.args))
+
+
+
+
+
+
+
+
+
+
+
+'''
+    The aggregation route.  POST a pipeline as JSON, either the
+    list of stages on its own or {"pipeline": [...]}, for example
+    how many people survived in each class:
+
+        [{"$match": {"survived": 1}},
+         {"$group": {"_id": "$class", "count": {"$sum": 1}}},
+         {"$sort": {"_id": 1}}]
+
+    or where people boarded:  [{"$distinct": "point_of_embarkation"}]
+
+    The body is read with bson's json_util, so {"$oid": ...} and
+    {"$date": ...} work in a $match.  See mongo_aggregate() for
+    the stages you are allowed to use.
+'''
+
+# POST to run an aggregation pipeline in MongoDB
+@api.route('/api/v1/mongo/aggregate', methods=['POST'])
+def api_mongo_aggregate():
+    try:
+        body = json_util.loads(request.get_data(as_text=True))
+    except ValueError:
+        flask.abort(400, "body must be JSON")
+    if isinstance(body, dict):
+        body = body.get('pipeline')
+    return mongo_aggregate(body)
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Counting and listing distinct values, with the same query
+    strings as /findargs:
+
+        /api/v1/mongo/count?survived=1&age__lt=18
+        /api/v1/mongo/distinct/point_of_embarkation?class=1
+
+    Add exact=false if an answer from a rollup (see
+    /api/v1/mongo/stats) is good enough.  The "source" in the
+    answer says where the number came from.
+'''
+COUNT_ARGS = ('exact',)
+
+# GET to count documents in MongoDB with request.args
+@api.route('/api/v1/mongo/count', methods=['GET'])
+def api_mongo_count():
+    query = compile_query(request.args, ignore=COUNT_ARGS)
+    exact = request.args.get('exact', 'true').lower() not in FALSE_STRINGS
+    return mongo_count(query, exact)
+
+
+# GET the distinct values of a field in MongoDB with request.args
+@api.route('/api/v1/mongo/distinct/<field>', methods=['GET'])
+def api_mongo_distinct(field):
+    query = compile_query(request.args, ignore=COUNT_ARGS)
+    exact = request.args.get('exact', 'true').lower() not in FALSE_STRINGS
+    return mongo_distinct(field, query, exact)
 
 
 
@@ -623,17 +4572,21 @@ def api_mongo_find_args():
     Again, we take the request arguments, only this time those
     arguements aren't for reading data based on a filter, they
     become the data that we plan to write into the database.
+
+    If write-behind is switched on the document is only queued
+    when we answer, so we say so with a 202 Accepted.
 '''
 
 # GET to insert data to MongoDB with request.args
-@app.route('/api/v1/mongo/insertargs', methods=['GET'])
+@api.route('/api/v1/mongo/insertargs', methods=['GET'])
 def api_mongo_insert_args():
     x = {}
     args = request.args
     for key in args.keys():
         value = request.args.getlist(key)
         x[key]=value
-    mongo_insert_one(x)
+    if insert_document(x):
+        return "data queued", 202
     return "data inserted"
 
 '''
@@ -644,7 +4597,7 @@ def api_mongo_insert_args():
 '''
 
 # POST to create new entry to Mongodb
-@app.route('/api/v1/mongo/insert', methods=['GET', 'POST'])
+@api.route('/api/v1/mongo/insert', methods=['GET', 'POST'])
 def api_mongo_insert():
     if request.method == 'GET':
         return flask.render_template('mongoinsert.html')
@@ -652,11 +4605,84 @@ def api_mongo_insert():
         #we have to use our parse_form() function becuase of
         #how Flask handles responses
         data = parse_form()
-        mongo_insert_one(data)
+        insert_document(data)
         #another Flask method is used, this time to redirect
         #the browser to the API root.  You could create something
         #that shows the newly inserted data instead
-        return flask.redirect(flask.url_for('api_root'))
+        return flask.redirect(flask.url_for('api.api_root'))
+
+
+
+
+
+
+
+
+
+
+
+'''
+    Loading a big dataset through /insert means one HTTP request
+    and one round trip to MongoDB per document.  This route takes
+    the whole lot in one POST, either as NDJSON (one document per
+    line) or as a JSON array, and writes it in batches with
+    insert_many(ordered=False).
+
+        curl -X POST --data-binary @titanic.ndjson \\
+             http://localhost/api/v1/mongo/bulk?batch_size=5000
+
+    The body is read as it arrives (see iter_documents()), so a
+    10GB upload needs no more memory than a 10KB one.  What we get
+    back counts what went in and what failed, and shows the last
+    BULK_REPORT_FAILED_BATCHES batches that had failures.  If a
+    document fails the rest of its batch still goes in.
+'''
+
+# POST to insert lots of documents at once
+@api.route('/api/v1/mongo/bulk', methods=['POST'])
+def api_mongo_bulk():
+    config = flask.current_app.config
+    batch_size = request.args.get('batch_size', config["BULK_BATCH_SIZE"], type=int)
+    batch_size = max(1, min(batch_size, config["BULK_MAX_BATCH_SIZE"]))
+    report = {'inserted': 0, 'failed': 0, 'batches': 0}
+    # only the last few batches that had failures, the upload may be endless
+    failed_batches = deque(maxlen=config["BULK_REPORT_FAILED_BATCHES"])
+
+    def flush(batch, rejected):
+        inserted, failed, errors = mongo_insert_many(batch, ordered=False) \
+            if batch else (0, 0, [])
+        if failed or rejected:
+            failed_batches.append({
+                'batch': report['batches'],
+                'inserted': inserted,
+                'failed': failed + rejected,
+                'errors': [e.get('errmsg') for e in errors[:5]],
+            })
+        report['batches'] += 1
+        report['inserted'] += inserted
+        report['failed'] += failed + rejected
+
+    batch, rejected = [], 0
+    try:
+        for doc in iter_documents(request.stream, config["BULK_MAX_DOC_BYTES"]):
+            if isinstance(doc, dict):
+                batch.append(doc)
+            else:
+                rejected += 1
+            if len(batch) + rejected >= batch_size:
+                flush(batch, rejected)
+                batch, rejected = [], 0
+    except BadDocumentStream as e:
+        if batch or rejected:
+            flush(batch, rejected)
+        report['error'] = "bad JSON after %d documents: %s" % (
+            report['inserted'] + report['failed'], e)
+        report['failed_batches'] = list(failed_batches)
+        return jsonify(report), 400
+    if batch or rejected:
+        flush(batch, rejected)
+    report['failed_batches'] = list(failed_batches)
+    return jsonify(report)
 
 
 
@@ -707,11 +4733,59 @@ skip to the bottom before covering this, let's take a look at what exists
 '''
     Exercise 1:  build the following route using what you know
                  and the PyMongo library
+
+    Here's my answer.  POST JSON to it (json_util again, so
+    {"$oid": ...} works in a filter):
+
+        {"filter": {"name": {"$regex": "Mis"}},
+         "update": {"$set": {"gender": "female"}}}
+
+    Add "upsert": true to insert a document when nothing matches,
+    "all": true to allow an empty filter and "dry_run": true (or
+    ?dry_run=true) to only see how many documents would be
+    touched.  /delete takes just a filter, /bulkwrite takes
+    {"operations": [...], "ordered": true}, see mongo_bulk_write().
 '''
+def write_request():
+    try:
+        body = json_util.loads(request.get_data(as_text=True))
+    except ValueError:
+        flask.abort(400, "body must be JSON")
+    if not isinstance(body, dict):
+        flask.abort(400, "body must be a JSON document")
+    try:
+        dry_run = to_bool(str(body.get('dry_run', request.args.get('dry_run', 'false'))))
+    except ValueError:
+        flask.abort(400, "dry_run must be true or false")
+    return body, {'dry_run': dry_run, 'everything': bool(body.get('all'))}
+
+
+def write_response(result):
+    return flask.Response(json_util.dumps(result), mimetype='application/json')
+
+
 # POST to update old entry from MongoDB
-@app.route('/api/v1/mongo/update', methods=['GET', 'POST'])
+@api.route('/api/v1/mongo/update', methods=['POST'])
 def api_mongo_update():
-    return "<h1>mongo update</h1>"
+    body, options = write_request()
+    return write_response(mongo_update(body.get('filter'), body.get('update'),
+                                       upsert=bool(body.get('upsert')), **options))
+
+
+# POST to delete entries from MongoDB
+@api.route('/api/v1/mongo/delete', methods=['POST'])
+def api_mongo_delete():
+    body, options = write_request()
+    return write_response(mongo_delete(body.get('filter'), **options))
+
+
+# POST a list of inserts, updates and deletes to MongoDB
+@api.route('/api/v1/mongo/bulkwrite', methods=['POST'])
+def api_mongo_bulk_write():
+    body, options = write_request()
+    return write_response(mongo_bulk_write(body.get('operations'),
+                                           ordered=body.get('ordered', True) is not False,
+                                           **options))
 
 
 
@@ -719,17 +4793,17 @@ def api_mongo_update():
     Exercise 2:  Create and API to query your HR database
 '''
 # GET to show data from Oracle 12c
-@app.route('/api/v1/oracle/find', methods=['GET'])
+@api.route('/api/v1/oracle/find', methods=['GET'])
 def api_oracle_find():
     return "<h1>12c find</h1>"
 
 # POST to create new entry to Oracle 12c
-@app.route('/api/v1/oracle/insert', methods=['GET', 'POST'])
+@api.route('/api/v1/oracle/insert', methods=['GET', 'POST'])
 def api_oracle_insert():
     return "<h1>12c insert</h1>"
 
 # POST to update data in Oracle 12c
-@app.route('/api/v1/oracle/update', methods=['GET', 'POST'])
+@api.route('/api/v1/oracle/update', methods=['GET', 'POST'])
 def api_oracle_update():
     return "<h1>12c update</h1>"
 
@@ -769,8 +4843,113 @@ def api_oracle_update():
 START THE FLASK SERVER OR ELSE NO ROUTES WILL WORK
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 
+'''
+    create_app() is our application factory.  It makes the Flask
+    object, loads the settings (and anything you want to change,
+    handy for trying things out), and plugs in our routes.
+
+    Nothing in this file starts a server when it's imported, so a
+    real server can do the serving:
+
+        gunicorn --workers 4 --threads 8 --bind 0.0.0.0:80 'app:create_app()'
+
+    or just run `python app.py`, which does the same thing for you
+    using the SERVER_* settings (or --workers, --threads, --bind...
+    see --help).  Every worker is its own process, so the API can
+    use every core.  When a worker is told to stop it finishes the
+    requests it has, writes out the write-behind queue, and exits.
+
+    If gunicorn isn't installed (it doesn't run on Windows) or you
+    pass --dev, you get Flask's own server instead, threaded but a
+    single process.  --debug turns on the debugger and reloader,
+    never do that anywhere people can reach it.
+'''
+def create_app(config=None):
+    app = flask.Flask(__name__)
+    app.config.update(settings)
+    if config:
+        app.config.update(config)
+    app.register_blueprint(api)
+    mongo_registry.configure(app.config)
+    result_cache.configure(app.config)
+    single_flight.configure(app.config)
+    change_feed.configure(app.config)
+    write_behind.configure(app.config)
+    rollups.configure(app.config)
+    metrics.configure(app.config)
+    slow_queries.configure(app.config)
+    snapshots.configure(app.config)
+    return app
+
+
+def serve_with_gunicorn(options):
+    from gunicorn.app.base import BaseApplication
+
+    def worker_exit(server, worker):
+        write_behind.stop()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', [options.bind])
+            self.cfg.set('workers', options.workers)
+            self.cfg.set('threads', options.threads)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('keepalive', options.keep_alive)
+            self.cfg.set('timeout', options.timeout)
+            self.cfg.set('graceful_timeout', options.graceful_timeout)
+            self.cfg.set('worker_exit', worker_exit)
+
+        def load(self):
+            return create_app()
+
+    Server().run()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the API")
+    parser.add_argument('--bind', default=settings["SERVER_BIND"],
+                        help="host:port to listen on (%(default)s)")
+    parser.add_argument('--workers', type=int, default=settings["SERVER_WORKERS"],
+                        help="worker processes (%(default)s)")
+    parser.add_argument('--threads', type=int, default=settings["SERVER_THREADS"],
+                        help="threads per worker (%(default)s)")
+    parser.add_argument('--keep-alive', type=int, default=settings["SERVER_KEEPALIVE"],
+                        help="seconds to hold an idle connection open (%(default)s)")
+    parser.add_argument('--timeout', type=int, default=settings["SERVER_TIMEOUT"],
+                        help="seconds before a stuck worker is restarted (%(default)s)")
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=settings["SERVER_GRACEFUL_TIMEOUT"],
+                        help="seconds a stopping worker gets to finish (%(default)s)")
+    parser.add_argument('--dev', action='store_true',
+                        help="use Flask's single process server")
+    parser.add_argument('--debug', action='store_true', default=settings["DEBUG"],
+                        help="Flask's server with the debugger and reloader")
+    options = parser.parse_args(argv)
+
+    #Make sure our indexes exist, once, before any worker starts
+    if settings["MONGO_ENSURE_INDEXES"]:
+        try:
+            ensure_indexes()
+        except PyMongoError as e:
+            log.warning("could not ensure indexes: %s", e)
+
+    if not (options.dev or options.debug):
+        try:
+            return serve_with_gunicorn(options)
+        except ImportError:
+            log.warning("gunicorn is not installed, falling back to Flask's server")
+    host, _, port = options.bind.rpartition(':')
+    create_app({'DEBUG': options.debug}).run(
+        host=host or '127.0.0.1', port=int(port), debug=options.debug,
+        threaded=options.threads > 1)
+
+
+app = create_app()
+
 #Tell flask to start serving your API and specify which port to serve on!
-app.run(port=80)
+#Only when this file is run, not when it's imported
+if __name__ == '__main__':
+    main()
 
 """""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
 Exercise 3:
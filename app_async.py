@@ -0,0 +1,329 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Web Services using Python and MongoDB... the asynchronous edition
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+''' app.py is a normal Flask app.  Every request gets a thread,
+    and while that thread waits on MongoDB it can't do anything
+    else.  A few slow queries on /find/all and every thread is
+    busy waiting, so everybody else waits too.
+
+    This file serves the same routes with asyncio instead.  One
+    process can have thousands of requests waiting on MongoDB at
+    the same time, because waiting doesn't tie anything up.
+
+    Quart is Flask's asyncio twin, same API and same templates
+    folder, and Motor is the asyncio version of pymongo.  All the
+    parsing (query strings, projections, paging tokens) comes
+    straight from app.py, so both versions answer the same way.
+    Neither comes with Flask, pip install quart motor (they're in
+    requirements.txt).
+
+    It needs an ASGI server to run, for example:
+
+        hypercorn app_async:app --workers 4 --bind 0.0.0.0:80
+        uvicorn app_async:app --workers 4 --port 80
+
+    Not everything from app.py is here.  The result cache, the
+    query advisor and write-behind are built around threads, so
+    they stay with the Flask version.
+'''
+
+import asyncio
+import os
+
+import quart
+from quart import request
+import motor.motor_asyncio
+from bson import json_util
+
+# importing app does NOT start the Flask server, we just want its
+# helpers and its settings
+import app as sync
+
+app = quart.Quart(__name__)
+config = sync.app.config
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section One:  Helper Functions
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+
+
+'''
+    One Motor client per process, same idea as the registry in
+    app.py.  It is built the first time we need it, by then the
+    ASGI server has forked its workers and started the event
+    loop the client will live on.
+'''
+mongo = {}
+
+
+def create_mongo_session(database, collection):
+    if mongo.get('pid') != os.getpid():
+        mongo['client'] = motor.motor_asyncio.AsyncIOMotorClient(
+            config['MONGO_URI'], **sync.mongo_client_options(config))
+        mongo['pid'] = os.getpid()
+    db = mongo['client'][database]
+    return db, db[collection]
+
+
+@app.after_serving
+async def close_mongo_session():
+    client = mongo.pop('client', None)
+    mongo.pop('pid', None)
+    if client is not None:
+        client.close()
+
+
+
+
+
+
+
+
+
+
+'''
+    The form parser from app.py, except reading the form is
+    something we have to wait for here.
+'''
+async def parse_form():
+    x = {}
+    d = await request.form
+    for key in d.keys():
+        for val in d.getlist(key):
+            x[key] = val
+    return x
+
+
+
+
+
+
+
+
+
+
+'''
+    mongo_find() works just like the one in app.py: same paging,
+    same projections, same row cap, and the same
+
+        {"results": [...], "next": "<token or null>"}
+
+    envelope.  The only difference is the 'await' wherever we wait
+    for MongoDB, which is where other requests get their turn.
+'''
+async def mongo_find(query, stream=False, fields=None, limit=None, after=None, sort=None):
+    _, col = create_mongo_session('apitest', 'v1')
+    batch_size = config["FIND_BATCH_SIZE"]
+    sort = sync.parse_sort(sort)
+    projection = sync.parse_fields(fields)
+    hidden = ()
+    if limit is not None:
+        projection, hidden = sync.page_projection(projection, sort)
+    query = dict(query)
+    if after is not None:
+        position = sync.decode_after(sort, after)
+        query = {'$and': [query, sync.after_filter(sort, position)]}
+    if limit is None:
+        await check_row_cap(col, query)
+        cursor = col.find(query, projection, sort=sync.sort_spec(sort),
+                          batch_size=batch_size)
+    else:
+        cursor = col.find(query, projection, sort=sync.sort_spec(sort),
+                          limit=limit + 1, batch_size=min(batch_size, limit + 1))
+    body = stream_results(cursor, batch_size, limit, sort, hidden)
+    if not stream:
+        body = ''.join([chunk async for chunk in body])
+    return quart.Response(body, mimetype='application/json')
+
+
+async def check_row_cap(col, query):
+    cap = config["FIND_MAX_ROWS"]
+    if await col.count_documents(query, limit=cap + 1) > cap:
+        quart.abort(400, "query matches more than %d rows, page through "
+                         "it with limit and after" % cap)
+
+
+async def stream_results(cursor, batch_size, limit, sort, hidden=()):
+    last, more, count = None, False, 0
+    try:
+        yield '{"results": ['
+        batch = []
+        first = True
+        async for doc in cursor:
+            if limit is not None and count == limit:
+                more = True
+                break
+            count += 1
+            last = doc
+            if hidden:
+                doc = {k: v for k, v in doc.items() if k not in hidden}
+            batch.append(json_util.dumps(doc))
+            if len(batch) >= batch_size:
+                yield ('' if first else ',') + ','.join(batch)
+                first = False
+                batch = []
+        if batch:
+            yield ('' if first else ',') + ','.join(batch)
+        next_token = sync.encode_after(sort, last) if more else None
+        yield '], "next": %s}' % json_util.dumps(next_token)
+    finally:
+        await cursor.close()
+
+
+
+
+
+
+
+
+
+
+'''
+    Inserts.  Like app.py we let the result cache know the
+    collection changed, in case both versions are running side by
+    side with a shared cache tier, and bump the ROLLUPS the new
+    document counts towards.  The rollups talk to MongoDB through
+    app.py's pymongo client, so that happens on a thread where it
+    can't hold up the event loop.
+'''
+async def mongo_insert_one(doc):
+    _, col = create_mongo_session('apitest', 'v1')
+    await col.insert_one(doc)
+    sync.result_cache.invalidate('apitest.v1')
+    await asyncio.get_running_loop().run_in_executor(
+        None, sync.rollups.on_insert, 'apitest.v1', [doc])
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section 2:  The Web Service, same routes as app.py
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+# homepage
+@app.route("/", methods=["GET"])
+async def home_page():
+    return await quart.render_template('index.html')
+
+
+# root for api/v1
+@app.route('/api/v1', methods=['GET'])
+async def api_root():
+    return await quart.render_template('docs.html')
+
+
+# GET to show data from MongoDB
+@app.route('/api/v1/mongo/find/all', methods=['GET'])
+async def api_mongo_find_all():
+    return await mongo_find({}, stream=True, **sync.find_args(request.args))
+
+
+# GET to filter find query from MongoDB
+@app.route('/api/v1/mongo/find', methods=['GET', 'POST'])
+async def api_mongo_find():
+    if request.method == 'GET':
+        return await quart.render_template('query.html')
+    data = await parse_form()
+    kwargs = sync.find_args(data)
+    for key in sync.FIND_ARGS:
+        data.pop(key, None)
+    return await mongo_find(data, **kwargs)
+
+
+# GET to filter find query from MongoDB with request.args
+@app.route('/api/v1/mongo/findargs', methods=['GET'])
+async def api_mongo_find_args():
+    query = sync.compile_query(request.args, ignore=sync.FIND_ARGS)
+    return await mongo_find(query, **sync.find_args(request.args))
+
+
+# GET to insert data to MongoDB with request.args
+@app.route('/api/v1/mongo/insertargs', methods=['GET'])
+async def api_mongo_insert_args():
+    x = {}
+    for key in request.args.keys():
+        x[key] = request.args.getlist(key)
+    await mongo_insert_one(x)
+    return "data inserted"
+
+
+# POST to create new entry to Mongodb
+@app.route('/api/v1/mongo/insert', methods=['GET', 'POST'])
+async def api_mongo_insert():
+    if request.method == 'GET':
+        return await quart.render_template('mongoinsert.html')
+    data = await parse_form()
+    await mongo_insert_one(data)
+    return quart.redirect(quart.url_for('api_root'))
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+START THE SERVER
+    For real use, run it with hypercorn or uvicorn as shown at the top,
+    python app_async.py only starts a single process on port 80
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+if __name__ == '__main__':
+    app.run(port=80)
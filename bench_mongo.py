@@ -0,0 +1,574 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Benchmarking the API... so we know if a change helped
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+''' Every change to mongo_find() or create_mongo_session() is
+    supposed to make things faster.  This script is how we check.
+
+    It fills a collection with made up passengers shaped like the
+    titanic dataset, as many as you like, then sends requests to
+    each route from a number of threads at once and measures:
+
+      - latency per request, p50/p95/p99 and max
+      - throughput, requests per second
+      - memory (RSS) of the process serving the requests
+      - how many operations reached MongoDB, per command
+
+    and writes it all to a JSON report.  Run it on two commits and
+    compare the reports:
+
+        python bench_mongo.py --stand-in --scale 10000 --out before.json
+        git checkout my-branch
+        python bench_mongo.py --stand-in --scale 10000 --out after.json \\
+                              --compare before.json
+
+    --compare exits with 1 if a route got slower than --threshold
+    percent, so it can fail a CI job.
+
+    By default the requests go straight into the Flask app in this
+    process, no network in between.  --stand-in uses mongomock, an
+    in-memory MongoDB, so you don't even need a mongod.  That's fine
+    for comparing two versions of our Python code, but mongomock is
+    nothing like MongoDB's speed, and 10 million documents won't fit
+    in it.  For real numbers point --mongo-uri at a mongod, and
+    --url at a running server (python app.py) to include gunicorn
+    and the network.  The memory numbers are only about this
+    process, so with --url they don't say much.
+
+    The benchmark uses the database you give it (apitest by
+    default) and --seed drops the collection first, never point
+    it at real data.
+'''
+
+import argparse
+import collections
+import datetime
+import http.client
+import inspect
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section One:  Helper Functions
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+
+
+'''
+    Made up passengers.  Same fields and types as FIELD_TYPES in
+    app.py, and roughly the same mix as the real thing: most of
+    them in third class, most of the women survived, most of the
+    men didn't, and one in five has no age.  The same --random-seed
+    always makes the same passengers.
+'''
+FIRST_NAMES = ('John', 'William', 'Mary', 'Anna', 'James', 'Elizabeth',
+               'Thomas', 'Margaret', 'Charles', 'Helen', 'George', 'Alice')
+LAST_NAMES = ('Smith', 'Brown', 'Kelly', 'Andersson', 'Sage', 'Goodwin',
+              'Johnson', 'Carter', 'Skoog', 'Rice', 'Panula', 'Asplund')
+
+
+def passenger(rng):
+    gender = 'male' if rng.random() < 0.65 else 'female'
+    age = float(rng.randint(1, 80)) if rng.random() < 0.8 else None
+    if gender == 'male':
+        title = 'Master.' if age is not None and age < 14 else 'Mr.'
+    else:
+        title = 'Miss.' if age is None or age < 25 else 'Mrs.'
+    doc = {
+        'survived': int(rng.random() < (0.74 if gender == 'female' else 0.19)),
+        'class': rng.choices((1, 2, 3), (0.24, 0.21, 0.55))[0],
+        'name': '%s %s %s' % (title, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)),
+        'gender': gender,
+        'siblings_spouses': rng.choice((0, 0, 0, 0, 1, 1, 2, 3, 4)),
+        'parents_children': rng.choice((0, 0, 0, 0, 0, 1, 1, 2)),
+        'fare_paid': round(rng.uniform(0, 100) if rng.random() < 0.98 else 0.0, 2),
+        'ticket_number': str(rng.randint(1000, 999999)),
+        'point_of_embarkation': rng.choices('SCQ', (0.72, 0.19, 0.09))[0],
+    }
+    if age is not None:
+        doc['age'] = age
+    return doc
+
+
+def seed(col, scale, rng, batch_size=10000):
+    col.drop()
+    done = 0
+    while done < scale:
+        batch = [passenger(rng) for _ in range(min(batch_size, scale - done))]
+        col.insert_many(batch, ordered=False)
+        done += len(batch)
+        print("seeded %d/%d" % (done, scale), file=sys.stderr, end='\r')
+    print(file=sys.stderr)
+
+
+
+
+
+
+
+
+
+
+'''
+    Counting what reaches MongoDB.  A real MongoClient tells every
+    CommandListener about each command it sends, so we add one
+    when we build the client.  mongomock doesn't send commands, so
+    for the stand-in we count the collection methods that get
+    called instead, close enough to compare two runs.
+'''
+class OpCounter(monitoring.CommandListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def bump(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+    def started(self, event):
+        self.bump(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+STAND_IN_METHODS = ('find', 'find_one', 'insert_one', 'insert_many', 'update_one',
+                    'update_many', 'replace_one', 'delete_one', 'delete_many',
+                    'bulk_write', 'count_documents', 'estimated_document_count',
+                    'distinct', 'aggregate')
+
+
+def stand_in_factory(counter):
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("--stand-in needs mongomock, pip install mongomock")
+
+    def counted(name, method):
+        def call(self, *args, **kwargs):
+            counter.bump(name)
+            return method(self, *args, **kwargs)
+        return call
+
+    for name in STAND_IN_METHODS:
+        setattr(mongomock.collection.Collection, name,
+                counted(name, getattr(mongomock.collection.Collection, name)))
+    # newer pymongo hands bulk_write()'s UpdateOne a sort= that
+    # mongomock doesn't know about yet, we never use it
+    builder = mongomock.collection.BulkOperationBuilder
+    if 'sort' not in inspect.signature(builder.add_update).parameters:
+        add_update = builder.add_update
+        builder.add_update = lambda self, *args, sort=None, **kwargs: \
+            add_update(self, *args, **kwargs)
+    client = mongomock.MongoClient()
+    return lambda config: client
+
+
+def mongo_factory(service, counter):
+    import pymongo
+
+    def build(config):
+        return pymongo.MongoClient(
+            config['MONGO_URI'], connect=False,
+            event_listeners=[service.mongo_registry.pool_stats, counter],
+            **service.mongo_client_options(config))
+    return build
+
+
+def diff_counts(before, after):
+    return {name: after[name] - before.get(name, 0) for name in sorted(after)
+            if after[name] - before.get(name, 0)}
+
+
+def rss_kb():
+    # what this process is using right now, and the most it ever used
+    current = None
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return current, peak
+
+
+
+
+
+
+
+
+
+
+'''
+    What we send to each route.  Every request gets slightly
+    different values (a random age, a random class...) so we don't
+    just measure the result cache answering the same thing over
+    and over, unless that's what you want (--repeat).
+
+    find/all is asked for a page at a time, the whole collection
+    would hit FIND_MAX_ROWS as soon as the scale is bigger than it.
+    The write routes go last so the reads all see the same data.
+'''
+def route_find_all(rng):
+    return 'GET', '/api/v1/mongo/find/all?limit=%d' % rng.choice((100, 500)), None
+
+
+def route_find(rng):
+    return 'POST', '/api/v1/mongo/find', {
+        'gender': rng.choice(('male', 'female')),
+        'point_of_embarkation': rng.choice('SCQ'),
+        'limit': '100',
+    }
+
+
+def route_findargs(rng):
+    return 'GET', '/api/v1/mongo/findargs?survived=%d&age__lt=%d&limit=100' % (
+        rng.randint(0, 1), rng.randint(5, 80)), None
+
+
+def route_count(rng):
+    return 'GET', '/api/v1/mongo/count?class=%d&gender=%s' % (
+        rng.randint(1, 3), rng.choice(('male', 'female'))), None
+
+
+def route_aggregate(rng):
+    pipeline = [{'$match': {'class': rng.randint(1, 3)}},
+                {'$group': {'_id': '$survived', 'count': {'$sum': 1}}}]
+    return 'POST', '/api/v1/mongo/aggregate', json.dumps(pipeline)
+
+
+def route_insert(rng):
+    doc = passenger(rng)
+    return 'POST', '/api/v1/mongo/insert', {k: str(v) for k, v in doc.items()}
+
+
+def route_insertargs(rng):
+    doc = passenger(rng)
+    return 'GET', '/api/v1/mongo/insertargs?' + urllib.parse.urlencode(doc), None
+
+
+ROUTES = collections.OrderedDict([
+    ('find_all', route_find_all),
+    ('find', route_find),
+    ('findargs', route_findargs),
+    ('count', route_count),
+    ('aggregate', route_aggregate),
+    ('insert', route_insert),
+    ('insertargs', route_insertargs),
+])
+
+
+
+
+
+
+
+
+
+
+'''
+    Two ways to send a request.  InProcess calls the Flask app
+    directly with its test client, HTTP opens a keep-alive
+    connection to --url.  Each thread gets its own, and both read
+    the whole body, a streamed response isn't done until it's sent.
+'''
+class InProcess(object):
+    def __init__(self, service):
+        self.client = service.app.test_client()
+
+    def send(self, method, path, body):
+        response = self.client.open(path, method=method, data=body)
+        response.get_data()
+        return response.status_code
+
+
+class HTTP(object):
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        self.prefix = parts.path.rstrip('/')
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+
+    def send(self, method, path, body):
+        headers = {}
+        if isinstance(body, dict):
+            body = urllib.parse.urlencode(body)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            self.connection.request(method, self.prefix + path, body, headers)
+            response = self.connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            return 0
+        return response.status
+
+
+def percentile(ordered, p):
+    # nearest rank, ordered is sorted already
+    if not ordered:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_route(name, make_request, new_sender, options, counter):
+    rng = random.Random('%s:%s' % (options.random_seed, name))
+    fixed = make_request(rng)
+    planned = [fixed if options.repeat else make_request(rng)
+               for _ in range(options.warmup + options.requests)]
+    warmup, planned = planned[:options.warmup], planned[options.warmup:]
+    local = threading.local()
+
+    def send(request):
+        if not hasattr(local, 'sender'):
+            local.sender = new_sender()
+        started = time.perf_counter()
+        status = local.sender.send(*request)
+        return time.perf_counter() - started, status
+
+    with ThreadPoolExecutor(options.concurrency) as pool:
+        list(pool.map(send, warmup))
+        ops_before = counter.snapshot()
+        started = time.perf_counter()
+        results = list(pool.map(send, planned))
+        elapsed = time.perf_counter() - started
+        ops_after = counter.snapshot()
+    latencies = sorted(seconds * 1000.0 for seconds, _ in results)
+    statuses = collections.Counter(status for _, status in results)
+    current, peak = rss_kb()
+    return {
+        'requests': len(results),
+        'errors': sum(n for status, n in statuses.items() if status == 0 or status >= 400),
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(results) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(latencies[-1], 3),
+            'mean': round(sum(latencies) / len(latencies), 3),
+        },
+        'rss_kb': current,
+        'peak_rss_kb': peak,
+        'mongo_ops': diff_counts(ops_before, ops_after),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+
+
+
+
+
+
+
+
+'''
+    Comparing two reports.  For every route in both, how p50, p95,
+    p99 and throughput moved.  A route regressed if its p95 went up
+    or its throughput went down by more than the threshold.
+'''
+def compare(old, new, threshold):
+    regressed = []
+    print("%-12s %-10s %12s %12s %9s" % ('route', 'metric', 'before', 'after', 'change'))
+    for name, after in new['routes'].items():
+        before = old['routes'].get(name)
+        if before is None:
+            continue
+        rows = [(metric, before['latency_ms'][metric], after['latency_ms'][metric])
+                for metric in ('p50', 'p95', 'p99')]
+        rows.append(('req/s', before['throughput'], after['throughput']))
+        for metric, was, now in rows:
+            change = (now - was) / was * 100.0 if was else 0.0
+            print("%-12s %-10s %12.3f %12.3f %+8.1f%%" % (name, metric, was, now, change))
+            if (metric == 'p95' and change > threshold) or \
+                    (metric == 'req/s' and -change > threshold):
+                regressed.append('%s %s' % (name, metric))
+    if regressed:
+        print("regressed more than %g%%: %s" % (threshold, ', '.join(sorted(set(regressed)))))
+    return regressed
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section 2:  Running it
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the API routes")
+    parser.add_argument('--stand-in', action='store_true',
+                        help="use mongomock in memory instead of a mongod")
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'),
+                        help="MongoDB to use (MONGO_URI, or app.py's default)")
+    parser.add_argument('--url',
+                        help="benchmark a running server, e.g. http://127.0.0.1:80, "
+                             "instead of the app in this process")
+    parser.add_argument('--scale', type=int, default=1000,
+                        help="passengers to seed (%(default)s)")
+    parser.add_argument('--no-seed', dest='seed', action='store_false',
+                        help="use what's already in the collection")
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help="which routes, comma separated (%(default)s)")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="requests in flight at once (%(default)s)")
+    parser.add_argument('--requests', type=int, default=500,
+                        help="measured requests per route (%(default)s)")
+    parser.add_argument('--warmup', type=int, default=50,
+                        help="unmeasured requests per route first (%(default)s)")
+    parser.add_argument('--repeat', action='store_true',
+                        help="send the same request every time, cache and all")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="switch the result cache off (in process only)")
+    parser.add_argument('--random-seed', type=int, default=1912,
+                        help="seed for the made up data and requests (%(default)s)")
+    parser.add_argument('--out', help="write the JSON report here")
+    parser.add_argument('--compare', help="a report to compare this run with")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="percent worse before --compare fails (%(default)s)")
+    options = parser.parse_args(argv)
+
+    routes = [name for name in options.routes.split(',') if name]
+    unknown = [name for name in routes if name not in ROUTES]
+    if unknown:
+        parser.error("unknown routes: %s" % ', '.join(unknown))
+
+    # app.py reads its settings when it is imported, so these go first.
+    # We create the indexes ourselves, after seeding
+    if options.mongo_uri:
+        os.environ['MONGO_URI'] = options.mongo_uri
+    os.environ['MONGO_ENSURE_INDEXES'] = 'false'
+    if options.stand_in:
+        os.environ['FIND_RAW_BATCHES'] = 'false'
+    if options.no_cache:
+        os.environ['RESULT_CACHE_ENABLED'] = 'false'
+    import app as service
+
+    counter = OpCounter()
+    if options.stand_in:
+        if options.url:
+            parser.error("--stand-in only works in process, not with --url")
+        service.mongo_registry.client_factory = stand_in_factory(counter)
+    else:
+        service.mongo_registry.client_factory = mongo_factory(service, counter)
+    service.mongo_registry.close()
+
+    _, col = service.create_mongo_session('apitest', 'v1')
+    if options.seed:
+        seed(col, options.scale, random.Random(options.random_seed))
+    with service.app.app_context():
+        service.ensure_indexes()
+
+    if options.url:
+        new_sender = lambda: HTTP(options.url)
+    else:
+        new_sender = lambda: InProcess(service)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': 'stand-in' if options.stand_in else 'mongod',
+            'target': options.url or 'in-process',
+            'documents': col.estimated_document_count(),
+            'scale': options.scale if options.seed else None,
+            'concurrency': options.concurrency,
+            'requests': options.requests,
+            'warmup': options.warmup,
+            'repeat': options.repeat,
+            'result_cache': not options.no_cache,
+            'random_seed': options.random_seed,
+        },
+        'routes': collections.OrderedDict(),
+    }
+    for name in routes:
+        result = run_route(name, ROUTES[name], new_sender, options, counter)
+        report['routes'][name] = result
+        print("%-12s p50 %8.2fms  p95 %8.2fms  p99 %8.2fms  %9.1f req/s  %d errors" % (
+            name, result['latency_ms']['p50'], result['latency_ms']['p95'],
+            result['latency_ms']['p99'], result['throughput'], result['errors']))
+    service.write_behind.stop()
+
+    if options.out:
+        with open(options.out, 'w') as out:
+            json.dump(report, out, indent=2)
+    if options.compare:
+        with open(options.compare) as previous:
+            if compare(json.load(previous), report, options.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,533 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Filtering with NumPy... every row at once
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+''' The filters in titanic_mongo.py, and the ones people send to
+    /findargs, are each a separate scan of the collection in MongoDB:
+
+        {"$and": [{"survived": 1}, {"age": {"$lt": 18}}]}
+        {"parents_children": {"$gte": 5}}
+        {"name": {"$regex": "Mis"}}
+
+    A snapshot (see snapshot_mongo.py) already has every field as a
+    column: a tag saying what kind of value each row holds, missing
+    and null included, and a float64 key that sorts like the value.
+    FilterEngine puts NumPy arrays straight on top of those columns,
+    no copying, and turns each part of a filter into a boolean mask
+    over all the rows in one go.  $and is &, $or is |, $not is ~,
+    and the matching rows are np.flatnonzero(mask).
+
+    It knows $eq $ne $gt $gte $lt $lte $in $nin $exists $regex $not
+    $and $or $nor on top level fields, with MongoDB's rules:
+
+      - values only compare with values of the same kind, so
+        {"age": {"$lt": 18}} never matches age "unknown"
+      - a missing field equals null, $ne null means "is there"
+      - $regex only matches strings, and runs once per distinct
+        string in the column, not once per row
+
+    Arrays, embedded documents and dotted field names it doesn't
+    know, those raise Unanswerable and go to MongoDB.  Regexes run
+    on Python's re module, not PCRE, which is the same thing for
+    everything but the fancy stuff.
+
+    snapshot_find() in app.py uses it (when numpy is installed) for
+    the filters the snapshot's sorted indexes can't answer.
+
+    Identical answers to MongoDB's is the whole point, so this file
+    is also a conformance check.  It exports a collection, runs the
+    titanic_mongo.py filters and a few hundred random ones through
+    both, and exits with 1 if any answer differs:
+
+        python filter_engine.py --mongo-uri mongodb://localhost:27017
+        python filter_engine.py --seed 5000 --namespace apitest.conformance
+        python filter_engine.py --stand-in --seed 2000
+
+    --seed drops the collection and fills it with made up
+    passengers (plus some odd ones, null ages, ages as text...),
+    don't point it at real data.  --stand-in uses mongomock instead
+    of MongoDB, which only tells you the engine agrees with
+    mongomock.  tests/test_filter_engine.py runs the same check
+    against mongomock with pytest.
+'''
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import weakref
+
+import numpy as np
+import bson
+from bson.regex import Regex
+
+import snapshot_mongo
+from snapshot_mongo import (TAG_MISSING, TAG_NULL, TAG_STRING, TAG_OTHER,
+                            Unanswerable, bracket)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section One:  Masks
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+
+
+'''
+    One column as NumPy arrays.  np.frombuffer() over the mmap'd
+    sections means the arrays are the snapshot file, every worker
+    shares the same pages.  brackets is the tag with missing folded
+    into null, the "null mask" is brackets == TAG_NULL.
+
+    A field that no document has still gets a column, all missing,
+    so {"cabin": null} matches everything and {"cabin": "C85"}
+    matches nothing, same as MongoDB.
+'''
+COMPARISONS = {
+    '$lt': np.less,
+    '$lte': np.less_equal,
+    '$gt': np.greater,
+    '$gte': np.greater_equal,
+}
+
+REGEX_FLAGS = {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}
+
+
+class EngineColumn(object):
+    def __init__(self, name, column, count):
+        self.name = name
+        self.column = column
+        if column is None:
+            self.exact = True
+            self.tags = np.zeros(count, dtype=np.uint8)
+            self.keys = np.zeros(count, dtype=np.float64)
+        else:
+            self.exact = column.exact
+            self.tags = np.frombuffer(column.tags, dtype=np.uint8)
+            self.keys = np.frombuffer(column.keys, dtype=np.float64)
+        self.brackets = np.where(self.tags == TAG_MISSING, TAG_NULL, self.tags)
+        self._strings = None
+
+    def key_of(self, value):
+        if self.column is not None:
+            return self.column.key_of(value)
+        tag, key = snapshot_mongo.value_tag(value)
+        if tag == TAG_OTHER:
+            raise Unanswerable("can't compare %r" % (value,))
+        return tag, (-0.5 if key is None else key)
+
+    def strings(self):
+        # every distinct string in the column, in rank order
+        if self._strings is None:
+            count = 0 if self.column is None else self.column._string_count
+            self._strings = [self.column.string(rank) for rank in range(count)]
+        return self._strings
+
+
+class FilterEngine(object):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.count = snapshot.count
+        self._columns = {}
+
+    def column(self, field, exact=True):
+        if '.' in field or field.startswith('$'):
+            raise Unanswerable(field)
+        column = self._columns.get(field)
+        if column is None:
+            column = EngineColumn(field, self.snapshot.columns.get(field), self.count)
+            self._columns[field] = column
+        if exact and not column.exact:
+            raise Unanswerable("%s holds values we can't index" % field)
+        return column
+
+    def everything(self):
+        return np.ones(self.count, dtype=bool)
+
+    def nothing(self):
+        return np.zeros(self.count, dtype=bool)
+
+    def mask(self, query):
+        if not isinstance(query, dict):
+            raise Unanswerable("a filter is a document")
+        mask = self.everything()
+        for key, condition in query.items():
+            if key in ('$and', '$or', '$nor'):
+                if not isinstance(condition, (list, tuple)) or not condition:
+                    raise Unanswerable("%s needs a list" % key)
+                parts = [self.mask(part) for part in condition]
+                if key == '$and':
+                    mask &= np.logical_and.reduce(parts)
+                elif key == '$or':
+                    mask &= np.logical_or.reduce(parts)
+                else:
+                    mask &= ~np.logical_or.reduce(parts)
+            elif key.startswith('$'):
+                raise Unanswerable(key)
+            else:
+                mask &= self.field_mask(key, condition)
+        return mask
+
+    def field_mask(self, field, condition):
+        if isinstance(condition, (re.Pattern, Regex)):
+            return self.regex(field, condition)
+        if not (isinstance(condition, dict) and condition and
+                all(op.startswith('$') for op in condition)):
+            return self.equal(field, condition)
+        mask = self.everything()
+        for op, value in condition.items():
+            if op == '$options':
+                if '$regex' not in condition:
+                    raise Unanswerable("$options without $regex")
+                continue
+            if op == '$regex':
+                mask &= self.regex(field, value, condition.get('$options', ''))
+            else:
+                mask &= self.operator(field, op, value)
+        return mask
+
+    def operator(self, field, op, value):
+        if op == '$eq':
+            return self.equal(field, value)
+        if op == '$ne':
+            return ~self.equal(field, value)
+        if op in ('$in', '$nin'):
+            if not isinstance(value, (list, tuple)):
+                raise Unanswerable("%s needs a list" % op)
+            mask = self.nothing()
+            for item in value:
+                if isinstance(item, (re.Pattern, Regex)):
+                    mask |= self.regex(field, item)
+                else:
+                    mask |= self.equal(field, item)
+            return mask if op == '$in' else ~mask
+        if op in COMPARISONS:
+            return self.compare(field, op, value)
+        if op == '$exists':
+            return (self.column(field, exact=False).tags != TAG_MISSING) == bool(value)
+        if op == '$not':
+            if isinstance(value, dict) and any(not key.startswith('$') for key in value):
+                raise Unanswerable("$not needs operators or a regex")
+            return ~self.field_mask(field, value)
+        raise Unanswerable(op)
+
+    def equal(self, field, value):
+        column = self.column(field)
+        if value is None:
+            return column.brackets == TAG_NULL
+        tag, key = column.key_of(value)
+        return (column.tags == tag) & (column.keys == key)
+
+    def compare(self, field, op, value):
+        column = self.column(field)
+        if value is None:
+            # MongoDB's rules for null in a range have changed between
+            # versions, leave those to it
+            raise Unanswerable("range on null")
+        tag, key = column.key_of(value)
+        return (column.brackets == bracket(tag)) & COMPARISONS[op](column.keys, key)
+
+    def regex(self, field, pattern, options=''):
+        if isinstance(pattern, Regex):
+            pattern = pattern.try_compile()
+        if isinstance(pattern, re.Pattern):
+            compiled = pattern
+        elif isinstance(pattern, str):
+            flags = 0
+            for option in options or '':
+                if option not in REGEX_FLAGS:
+                    raise Unanswerable("regex option %r" % option)
+                flags |= REGEX_FLAGS[option]
+            try:
+                compiled = re.compile(pattern, flags)
+            except re.error as e:
+                raise Unanswerable("regex %r: %s" % (pattern, e))
+        else:
+            raise Unanswerable("$regex needs a string")
+        column = self.column(field)
+        ranks = [rank for rank, value in enumerate(column.strings())
+                 if compiled.search(value)]
+        return (column.tags == TAG_STRING) & np.isin(column.keys, ranks)
+
+    def rows(self, query):
+        return np.flatnonzero(self.mask(query))
+
+
+
+
+
+
+
+
+
+
+'''
+    Sorting the matches, and paging through them.  np.lexsort sorts
+    on the last key first, so (row, key, bracket) means by kind,
+    then by value, then by _id (the rows are in _id order).  A page
+    token's position comes from the snapshot, and "after it" is the
+    same three way comparison done on every row at once.
+
+    find() has the same arguments and answer as Snapshot.find(), so
+    app.py can use either one.
+'''
+def after_mask(brackets, keys, rows, position, direction):
+    position_bracket, position_key, position_row = position
+    if direction == 1:
+        later = lambda a, b: a > b
+    else:
+        later = lambda a, b: a < b
+    return later(brackets, position_bracket) | (brackets == position_bracket) & (
+        later(keys, position_key) | (keys == position_key) & later(rows, position_row))
+
+
+def find(engine, query, sort=('_id', 1), position=None, at_most=None):
+    field, direction = sort
+    rows = engine.rows(query)
+    if not engine.count:
+        # an empty snapshot has no _id column to find a position in
+        return []
+    if field == '_id':
+        if position is not None:
+            after = engine.snapshot.position(field, *position)
+            rows = rows[rows > after] if direction == 1 else rows[rows < after]
+        if direction == -1:
+            rows = rows[::-1]
+    else:
+        column = engine.column(field)
+        brackets, keys = column.brackets[rows], column.keys[rows]
+        order = np.lexsort((rows, keys, brackets))
+        if direction == -1:
+            order = order[::-1]
+        rows, brackets, keys = rows[order], brackets[order], keys[order]
+        if position is not None:
+            after = engine.snapshot.position(field, *position)
+            rows = rows[after_mask(brackets, keys, rows, after, direction)]
+    if at_most is not None:
+        rows = rows[:at_most]
+    return rows.tolist()
+
+
+_engines = weakref.WeakKeyDictionary()
+
+
+def engine_for(snapshot):
+    # one engine per snapshot, it goes away when the snapshot does
+    engine = _engines.get(snapshot)
+    if engine is None:
+        engine = _engines[snapshot] = FilterEngine(snapshot)
+    return engine
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section 2:  Checking it against MongoDB
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+'''
+    The filters from titanic_mongo.py, plus the ones that trip people
+    up: nulls, missing fields, values of the wrong kind, and
+    negations, which match the documents that don't have the field.
+'''
+CORPUS = [
+    {},
+    {'survived': 1},
+    {'age': {'$lt': 18}},
+    {'$and': [{'survived': 1}, {'age': {'$lt': 18}}]},
+    {'name': {'$regex': 'Mis'}},
+    {'ticket_number': {'$exists': False}},
+    {'parents_children': {'$gte': 5}},
+    {'age': {'$gte': 70}},
+    {'age': None},
+    {'age': {'$ne': None}},
+    {'age': 'unknown'},
+    {'age': {'$gt': 'a'}},
+    {'age': {'$not': {'$lt': 18}}},
+    {'age': {'$nin': [None, 30.0]}},
+    {'class': {'$in': [1, 2]}, 'gender': 'female'},
+    {'$or': [{'class': 1}, {'fare_paid': {'$gt': 80}}]},
+    {'$nor': [{'survived': 1}, {'class': 3}]},
+    {'name': {'$regex': '^mrs', '$options': 'i'}},
+    {'name': {'$not': re.compile('Mr\\.')}},
+    {'point_of_embarkation': {'$in': ['S', re.compile('^Q')]}},
+    {'cabin': None},
+    {'cabin': {'$exists': True}},
+    {'fare_paid': 0},
+    {'fare_paid': {'$lte': 0.0}},
+]
+
+OPERATORS = ('$eq', '$ne', '$lt', '$lte', '$gt', '$gte', '$in', '$nin', '$exists')
+
+
+def odd_passenger(rng, passenger):
+    # the documents that make type bracketing matter
+    doc = passenger(rng)
+    doc[rng.choice(('age', 'fare_paid', 'name'))] = rng.choice(
+        (None, 'unknown', 0, ''))
+    doc.pop(rng.choice(('ticket_number', 'survived', 'class')), None)
+    return doc
+
+
+def random_condition(rng, fields, samples):
+    field = rng.choice(fields)
+    values = [doc.get(field) for doc in samples] + [None, 'S', 0, 18.5]
+    op = rng.choice(OPERATORS)
+    if op in ('$in', '$nin'):
+        value = rng.sample(values, min(3, len(values)))
+    elif op == '$exists':
+        value = rng.random() < 0.5
+    else:
+        value = rng.choice(values)
+    if op == '$eq' and rng.random() < 0.5:
+        return {field: value}
+    if rng.random() < 0.1:
+        return {field: {'$not': {op: value}}}
+    return {field: {op: value}}
+
+
+def random_query(rng, fields, samples, depth=0):
+    choice = rng.random()
+    if depth < 2 and choice < 0.3:
+        parts = [random_query(rng, fields, samples, depth + 1)
+                 for _ in range(rng.randint(1, 3))]
+        return {rng.choice(('$and', '$or', '$nor')): parts}
+    query = {}
+    for _ in range(rng.randint(1, 2)):
+        query.update(random_condition(rng, fields, samples))
+    return query
+
+
+def stand_in_client():
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("--stand-in needs mongomock, pip install mongomock")
+    return mongomock.MongoClient()
+
+
+def exported(col, path, namespace, raw=True):
+    # mongomock has no find_raw_batches(), it gets encoded one by one
+    if raw:
+        cursor = col.find_raw_batches({}, sort=[('_id', 1)])
+    else:
+        cursor = (bson.encode(doc) for doc in col.find({}, sort=[('_id', 1)]))
+    snapshot_mongo.export(cursor, path, namespace)
+    return snapshot_mongo.Snapshot(path)
+
+
+def check(col, engine, query, sort):
+    expected = [doc['_id'] for doc in col.find(
+        query, {'_id': 1}, sort=[(sort[0], sort[1]), ('_id', sort[1])])]
+    rows = find(engine, query, sort)
+    got = [bson.decode(engine.snapshot.document(row))['_id'] for row in rows]
+    return expected, got
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check the NumPy filter engine gives MongoDB's answers")
+    parser.add_argument('--namespace', default='apitest.v1',
+                        help="database.collection to check against (%(default)s)")
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI',
+                                                              'mongodb://localhost:27017'),
+                        help="MongoDB to check against (%(default)s)")
+    parser.add_argument('--stand-in', action='store_true',
+                        help="use mongomock instead of a real MongoDB")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="drop the collection and fill it with this many "
+                             "made up passengers first")
+    parser.add_argument('--random', type=int, default=500,
+                        help="random filters to try besides the fixed ones (%(default)s)")
+    parser.add_argument('--random-seed', type=int, default=1,
+                        help="for the random filters and passengers (%(default)s)")
+    options = parser.parse_args(argv)
+
+    rng = random.Random(options.random_seed)
+    if options.stand_in:
+        client = stand_in_client()
+    else:
+        import pymongo
+        client = pymongo.MongoClient(options.mongo_uri)
+    database, _, collection = options.namespace.partition('.')
+    col = client[database][collection]
+    if options.seed:
+        import bench_mongo
+        col.drop()
+        docs = [odd_passenger(rng, bench_mongo.passenger) if rng.random() < 0.05
+                else bench_mongo.passenger(rng) for _ in range(options.seed)]
+        col.insert_many(docs, ordered=False)
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot = exported(col, os.path.join(directory, 'check.snap'), options.namespace,
+                            raw=not options.stand_in)
+        engine = FilterEngine(snapshot)
+        fields = sorted(field for field in snapshot.columns if field != '_id')
+        samples = [bson.decode(snapshot.document(rng.randrange(snapshot.count)))
+                   for _ in range(20)] if snapshot.count else [{}]
+        queries = list(CORPUS) + [random_query(rng, fields, samples)
+                                  for _ in range(options.random)]
+        report = {'documents': snapshot.count, 'checked': 0, 'skipped': 0,
+                  'mismatches': 0}
+        for query in queries:
+            sort = rng.choice([('_id', 1), ('_id', -1)] +
+                              [(field, rng.choice((1, -1))) for field in fields])
+            try:
+                expected, got = check(col, engine, query, sort)
+            except Unanswerable:
+                report['skipped'] += 1
+                continue
+            report['checked'] += 1
+            if expected != got:
+                report['mismatches'] += 1
+                print(json.dumps({
+                    'query': repr(query), 'sort': sort,
+                    'mongodb': len(expected), 'engine': len(got),
+                    'missing': [str(i) for i in set(expected) - set(got)][:5],
+                    'extra': [str(i) for i in set(got) - set(expected)][:5],
+                }), file=sys.stderr)
+        del engine, snapshot
+    print(json.dumps(report))
+    return 1 if report['mismatches'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
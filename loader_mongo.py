@@ -0,0 +1,438 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Loading big datasets into MongoDB... in parallel
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+''' titanic_mongo.py starts with the titanic collection already full,
+    and the micro-project at the bottom of app.py has you import a JSON
+    file by hand.  That's fine for 891 passengers.  Our real datasets
+    are files of several GB, and loading those one document at a time
+    takes hours.
+
+    This script loads NDJSON (one document per line), JSON arrays
+    written one document per line, or CSV with a header line:
+
+        python loader_mongo.py titanic.csv --namespace titanic.guests
+        python loader_mongo.py passengers.ndjson --workers 8 --batch-size 5000
+
+    The file is cut into chunks of --chunk-mb, always at the end of a
+    line, and a pool of processes each parses a chunk, converts the
+    fields to the types in FIELD_TYPES (app.py) and writes them with
+    unordered insert_many() batches straight to the collection,
+    without the API's per-batch rollup updates; the rollups are
+    marked stale once the load is done.  Every process has its own pooled client from app.py's
+    registry, so the parsing and the writing both happen in parallel.
+
+    Progress, with documents per second, goes to stderr.  After every
+    chunk we save a checkpoint: the offset in the file up to which
+    every chunk is done.  Stop the load (or let it crash) and run it
+    again with --resume to carry on from there.  Chunks after the
+    checkpoint that had already finished get loaded again, so every
+    document gets an _id made from the file name and where it is in
+    the file, and the second copy is skipped as a duplicate.  Use
+    --no-stable-ids if you'd rather get ObjectIds.
+
+    Pretty printed JSON (one document over many lines) can't be cut
+    into lines, convert it first (jq -c '.[]') or send it to
+    /api/v1/mongo/bulk.  The same goes for CSV with line breaks
+    inside quoted values.
+'''
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section One:  Helper Functions
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+
+
+'''
+    Cutting the file up.  chunks() walks through it --chunk-mb at a
+    time and moves each cut forward to the next line break, so no
+    line is ever split between two workers.
+'''
+def detect_format(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension == '.json':
+        return 'json'
+    return 'ndjson'
+
+
+def chunks(path, start, chunk_bytes):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            yield start, end
+            start = end
+
+
+def read_header(path):
+    # the CSV column names, and where the data starts
+    with open(path, 'rb') as f:
+        line = f.readline()
+        names = next(csv.reader([line.decode('utf-8-sig')]))
+        return [name.strip() for name in names], f.tell()
+
+
+
+
+
+
+
+
+
+
+'''
+    Turning a line into a document.  NDJSON lines go through bson's
+    json_util, so mongoexport's {"$oid": ...} and {"$date": ...} come
+    back as the real types.  CSV values are all text, and an empty
+    value means the field isn't there at all, like a passenger whose
+    age nobody knows.
+
+    Then every field listed in the schema gets converted, with the
+    same conversions /findargs uses.  A value that won't convert is
+    kept as it is and counted, so one bad row doesn't stop the load.
+'''
+def parse_line(line, fmt, header):
+    if fmt == 'csv':
+        values = next(csv.reader([line]))
+        return {name: value for name, value in zip(header, values) if value != ''}
+    line = line.strip().strip(',[]').strip()
+    if not line:
+        return None
+    return json.loads(line, object_hook=json_util.object_hook)
+
+
+def coerce(doc, types, casts, renames):
+    bad = 0
+    if renames:
+        doc = {renames.get(field, field): value for field, value in doc.items()}
+    for field, kind in types.items():
+        value = doc.get(field)
+        if value is None:
+            continue
+        try:
+            if kind == 'bool':
+                doc[field] = value if isinstance(value, bool) else casts['bool'](str(value))
+            elif kind in ('int', 'float') and isinstance(value, str):
+                # CSV writes 3 as "3.0" sometimes, int("3.0") doesn't work
+                number = float(value)
+                doc[field] = int(number) if kind == 'int' and number.is_integer() \
+                    else casts[kind](value)
+            elif not isinstance(value, (dict, list)):
+                doc[field] = casts[kind](value)
+        except (ValueError, TypeError, KeyError):
+            bad += 1
+    return doc, bad
+
+
+def stable_id(name, offset):
+    # the same line of the same file always gets the same _id
+    return ObjectId(hashlib.sha1(('%s:%d' % (name, offset)).encode('utf-8')).digest()[:12])
+
+
+
+
+
+
+
+
+
+
+'''
+    What each worker process does with its chunk.  It imports app.py
+    for the schema, the conversions and the connection, so the
+    settings (MONGO_URI and friends) come from the environment like
+    they do for the API.  Duplicate _ids (code 11000) are counted as
+    skipped, those are documents an earlier run already loaded.
+'''
+def load_chunk(path, start, end, options):
+    import app as service
+
+    database, _, collection = options['namespace'].partition('.')
+    types = service.settings["FIELD_TYPES"].get(options['schema'], {})
+    name = os.path.basename(path)
+    report = {'start': start, 'end': end, 'read': 0, 'inserted': 0, 'skipped': 0,
+              'failed': 0, 'bad_lines': 0, 'bad_values': 0, 'errors': []}
+
+    # straight to the collection, mongo_insert_many() would bump the
+    # rollups after every batch and start their thread in every worker
+    _, col = service.create_mongo_session(database, collection)
+    col = col.with_options(write_concern=options['write_concern'])
+
+    def flush(batch):
+        try:
+            inserted, errors = len(col.insert_many(batch, ordered=False).inserted_ids), []
+        except BulkWriteError as e:
+            inserted = e.details.get('nInserted', 0)
+            errors = e.details.get('writeErrors', [])
+        failed = len(batch) - inserted
+        duplicates = sum(1 for error in errors if error.get('code') == 11000)
+        report['inserted'] += inserted
+        report['skipped'] += duplicates
+        report['failed'] += failed - duplicates
+        for error in errors:
+            if error.get('code') != 11000 and len(report['errors']) < 5:
+                report['errors'].append(error.get('errmsg'))
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    batch, offset = [], start
+    for raw in io.BytesIO(data):
+        line_offset, offset = offset, offset + len(raw)
+        try:
+            doc = parse_line(raw.decode('utf-8'), options['format'], options['header'])
+        except ValueError:
+            report['bad_lines'] += 1
+            continue
+        if not isinstance(doc, dict):
+            if doc is not None:
+                report['bad_lines'] += 1
+            continue
+        report['read'] += 1
+        doc, bad = coerce(doc, types, service.FIELD_CASTS, options['rename'])
+        report['bad_values'] += bad
+        if options['stable_ids'] and '_id' not in doc:
+            doc['_id'] = stable_id(name, line_offset)
+        batch.append(doc)
+        if len(batch) >= options['batch_size']:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return report
+
+
+
+
+
+
+
+
+
+
+'''
+    The checkpoint.  Chunks finish in any order, so we remember which
+    ones are done and only move the checkpoint forward when every
+    chunk before it is finished too.  It's written to a temporary
+    file and renamed over the old one, so a crash never leaves half
+    a checkpoint behind.
+'''
+class Checkpoint(object):
+    def __init__(self, path, input_path, size, offset=0, totals=None):
+        self.path = path
+        self.input_path = input_path
+        self.size = size
+        self.offset = offset
+        self.totals = totals or {}
+        self._done = {}
+
+    @classmethod
+    def load(cls, path, input_path, size):
+        with open(path) as f:
+            saved = json.load(f)
+        if saved['input'] != os.path.abspath(input_path) or saved['size'] != size:
+            raise ValueError("checkpoint %s is for %s (%d bytes)"
+                             % (path, saved['input'], saved['size']))
+        return cls(path, input_path, size, saved['offset'], saved['totals'])
+
+    def finished(self, start, end, counts):
+        # the totals only count chunks before the offset, the ones after
+        # it are loaded (and counted) again by a resume
+        self._done[start] = (end, counts)
+        while self.offset in self._done:
+            self.offset, counts = self._done.pop(self.offset)
+            for key, value in counts.items():
+                self.totals[key] = self.totals.get(key, 0) + value
+
+    def save(self):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'input': os.path.abspath(self.input_path), 'size': self.size,
+                       'offset': self.offset, 'totals': self.totals}, f)
+        os.replace(temporary, self.path)
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section 2:  Running it
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+def parse_renames(value):
+    renames = {}
+    for pair in filter(None, value.split(',')):
+        old, _, new = pair.partition('=')
+        if not old or not new:
+            raise argparse.ArgumentTypeError("rename as old=new,old2=new2")
+        renames[old.strip()] = new.strip()
+    return renames
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load a big JSON or CSV file into MongoDB")
+    parser.add_argument('input', help="the file to load")
+    parser.add_argument('--format', choices=('ndjson', 'json', 'csv'),
+                        help="what the file is (guessed from the extension)")
+    parser.add_argument('--namespace', default='apitest.v1',
+                        help="database.collection to load into (%(default)s)")
+    parser.add_argument('--schema',
+                        help="FIELD_TYPES entry to convert with (the namespace, "
+                             "or apitest.v1 if it has none)")
+    parser.add_argument('--rename', type=parse_renames, default={},
+                        help="rename fields first, e.g. Pclass=class,Sex=gender")
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'),
+                        help="MongoDB to load into (MONGO_URI, or app.py's default)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="processes parsing and writing (%(default)s)")
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help="documents per insert_many() (%(default)s)")
+    parser.add_argument('--chunk-mb', type=float, default=16.0,
+                        help="MB of the file each worker takes at a time (%(default)s)")
+    parser.add_argument('--write-concern', type=int, default=1,
+                        help="w for the inserts, 0 doesn't wait at all (%(default)s)")
+    parser.add_argument('--checkpoint',
+                        help="where to save progress (the input file + .checkpoint)")
+    parser.add_argument('--resume', action='store_true',
+                        help="carry on from the checkpoint")
+    parser.add_argument('--no-stable-ids', dest='stable_ids', action='store_false',
+                        help="let MongoDB make the _ids (a resumed load may "
+                             "insert some documents twice)")
+    options = parser.parse_args(argv)
+
+    # app.py reads its settings when it is imported, the workers
+    # import it too and inherit the environment
+    if options.mongo_uri:
+        os.environ['MONGO_URI'] = options.mongo_uri
+    os.environ['MONGO_ENSURE_INDEXES'] = 'false'
+    import app as service
+    from pymongo.write_concern import WriteConcern
+
+    fmt = options.format or detect_format(options.input)
+    schema = options.schema or options.namespace
+    if schema not in service.settings["FIELD_TYPES"]:
+        schema = 'apitest.v1'
+    size = os.path.getsize(options.input)
+    header, start = (read_header(options.input) if fmt == 'csv' else (None, 0))
+    checkpoint_path = options.checkpoint or options.input + '.checkpoint'
+    if options.resume and os.path.exists(checkpoint_path):
+        try:
+            checkpoint = Checkpoint.load(checkpoint_path, options.input, size)
+        except ValueError as e:
+            parser.error(str(e))
+        start = max(start, checkpoint.offset)
+        print("resuming at byte %d of %d" % (start, size), file=sys.stderr)
+    else:
+        checkpoint = Checkpoint(checkpoint_path, options.input, size)
+    checkpoint.offset = start
+    totals = dict(checkpoint.totals)
+    for key in ('read', 'inserted', 'skipped', 'failed', 'bad_lines', 'bad_values'):
+        totals.setdefault(key, 0)
+
+    work = {
+        'namespace': options.namespace,
+        'schema': schema,
+        'format': fmt,
+        'header': header,
+        'rename': options.rename,
+        'batch_size': max(1, options.batch_size),
+        'stable_ids': options.stable_ids,
+        'write_concern': WriteConcern(w=options.write_concern),
+    }
+    pending = chunks(options.input, start, max(1, int(options.chunk_mb * 1024 * 1024)))
+    started, loaded, errors = time.monotonic(), 0, []
+    with ProcessPoolExecutor(max_workers=max(1, options.workers)) as pool:
+        running = set()
+        while True:
+            # keep every worker busy, plus one chunk waiting for each
+            while len(running) < 2 * max(1, options.workers):
+                chunk = next(pending, None)
+                if chunk is None:
+                    break
+                running.add(pool.submit(load_chunk, options.input, chunk[0], chunk[1], work))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                report = future.result()
+                for key in totals:
+                    totals[key] += report[key]
+                loaded += report['inserted']
+                errors.extend(report['errors'][:5 - len(errors)])
+                checkpoint.finished(report['start'], report['end'],
+                                    {key: report[key] for key in totals})
+            checkpoint.save()
+            elapsed = time.monotonic() - started
+            print("%5.1f%%  %d inserted  %d skipped  %d failed  %.0f docs/s" % (
+                100.0 * checkpoint.offset / size if size else 100.0, totals['inserted'],
+                totals['skipped'], totals['failed'], loaded / elapsed if elapsed else 0.0),
+                file=sys.stderr)
+
+    # the workers went around the API, its rollups need a recount
+    service.rollups.on_change(options.namespace)
+    service.result_cache.invalidate(options.namespace)
+    elapsed = time.monotonic() - started
+    summary = dict(totals, seconds=round(elapsed, 3), errors=errors,
+                   docs_per_second=round(loaded / elapsed, 1) if elapsed else None)
+    print(json.dumps(summary))
+    if checkpoint.offset >= size:
+        os.remove(checkpoint_path)
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
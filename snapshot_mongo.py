@@ -0,0 +1,585 @@
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Snapshots... answering reads without asking MongoDB
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+''' Almost everything the API gets asked is a read, /find/all and
+    /findargs, on data that changes once a day.  Still, every one of
+    those reads is a trip to MongoDB.
+
+    A snapshot is a copy of a collection in one file on disk, laid
+    out by column.  Export one after the daily load:
+
+        python snapshot_mongo.py apitest.v1 --dir snapshots
+
+    and start the API with SNAPSHOT_DIR=snapshots.  Every worker
+    memory-maps the file, so the operating system keeps one copy of
+    it in memory no matter how many workers there are, and equality
+    and range filters ($eq, $in, $lt, $lte, $gt, $gte, and $and of
+    them) are answered from the sorted indexes stored in the file.
+    Most of the rest (regexes, $or, $exists...) filter_engine.py can
+    do with numpy, and whatever is left (arrays, embedded documents)
+    still goes to MongoDB, see snapshot_find() in app.py.
+
+    The export is written next to the old file and renamed over it,
+    which is atomic, so a worker either sees the old snapshot or the
+    new one, never half of each.  Workers notice the new file within
+    SNAPSHOT_CHECK_INTERVAL seconds and switch over, the requests
+    still reading the old one finish with it.
+
+    A snapshot is exactly as old as its export.  Writes made through
+    the API after that don't show up in it until the next export,
+    that's the deal.
+'''
+
+import argparse
+import bisect
+import datetime
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+import bson
+from bson.objectid import ObjectId
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section One:  The file
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+
+
+'''
+    What's in a snapshot file, front to back:
+
+      - every document as raw BSON, one after the other, sorted by
+        _id, and where each one starts
+      - for every top level field, one entry per document:
+          a tag, what kind of value it is (missing, null, number...)
+          a key, the value as a float64 that sorts the same way
+          the value does
+          the order, every row sorted by (tag, key) and then _id,
+          that's the index we search with bisect
+      - the strings and ObjectIds of each field, sorted, once each.
+        Their key is where they are in that list, so 'Q' < 'S'
+        because 'Q' comes first in it
+      - a JSON header saying where all of that is, then its length
+        and MAGIC again at the very end
+
+    MongoDB only compares values of the same kind (5 < 'a' is never
+    true), and sorts the kinds in this order, which is why the tags
+    are numbered the way they are.  A missing field sorts and
+    matches like null, so the index puts them together.
+
+    A field that holds anything we can't turn into a key (arrays,
+    embedded documents, NaN, huge integers) has inexact columns,
+    and filters and sorts on it go to MongoDB.
+'''
+MAGIC = b'MSNAP001'
+TRAILER = struct.Struct('<Q8s')
+
+TAG_MISSING = 0
+TAG_NULL = 1
+TAG_NUMBER = 2
+TAG_STRING = 3
+TAG_OTHER = 4
+TAG_OBJECTID = 7
+TAG_BOOL = 8
+TAG_DATE = 9
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MAX_EXACT_INT = 2 ** 53
+
+
+class Unanswerable(ValueError):
+    pass
+
+
+def bracket(tag):
+    # missing and null are the same thing to sorts and {"field": null}
+    return TAG_NULL if tag == TAG_MISSING else tag
+
+
+def date_key(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return (value - EPOCH) // datetime.timedelta(milliseconds=1)
+
+
+def value_tag(value):
+    # the tag of a value, and its key if it doesn't need a dictionary
+    if value is None:
+        return TAG_NULL, 0.0
+    if isinstance(value, bool):
+        return TAG_BOOL, float(value)
+    if isinstance(value, int):
+        if abs(value) > MAX_EXACT_INT:
+            return TAG_OTHER, 0.0
+        return TAG_NUMBER, float(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return TAG_OTHER, 0.0
+        return TAG_NUMBER, value
+    if isinstance(value, str):
+        return TAG_STRING, None
+    if isinstance(value, ObjectId):
+        return TAG_OBJECTID, None
+    if isinstance(value, datetime.datetime):
+        return TAG_DATE, float(date_key(value))
+    return TAG_OTHER, 0.0
+
+
+
+
+
+
+
+
+
+
+'''
+    Writing a snapshot.  The documents go straight into the file as
+    they arrive, only the column values are kept in memory until the
+    end, when they are sorted and written out after the documents.
+'''
+class SnapshotWriter(object):
+    def __init__(self, path, namespace):
+        self.path = path
+        self.namespace = namespace
+        self.count = 0
+        self._temporary = path + '.tmp'
+        self._file = open(self._temporary, 'wb')
+        self._file.write(MAGIC)
+        self._offsets = array('Q', [self._file.tell()])
+        self._columns = {}
+        self._sections = {}
+
+    def add(self, raw):
+        # raw is one document as BSON bytes
+        doc = bson.decode(raw)
+        self._file.write(raw)
+        self._offsets.append(self._file.tell())
+        for field in doc:
+            if field not in self._columns:
+                self._columns[field] = [None] * self.count
+        for field, values in self._columns.items():
+            values.append((doc[field],) if field in doc else None)
+        self.count += 1
+
+    def _section(self, name, data, typecode):
+        # every section starts on an 8 byte boundary, so it can be
+        # read as an array of doubles straight out of the mmap
+        self._file.write(b'\0' * (-self._file.tell() % 8))
+        offset = self._file.tell()
+        data = data.tobytes() if isinstance(data, array) else bytes(data)
+        self._file.write(data)
+        self._sections[name] = [offset, len(data), typecode]
+
+    def _column(self, field, values):
+        tags, keys = array('B'), array('d')
+        strings, objectids = set(), set()
+        for value in values:
+            if value is not None:
+                value = value[0]
+                if isinstance(value, str):
+                    strings.add(value)
+                elif isinstance(value, ObjectId):
+                    objectids.add(value.binary)
+        strings, objectids = sorted(strings), sorted(objectids)
+        string_rank = {value: rank for rank, value in enumerate(strings)}
+        objectid_rank = {value: rank for rank, value in enumerate(objectids)}
+        exact = True
+        for value in values:
+            if value is None:
+                tag, key = TAG_MISSING, 0.0
+            else:
+                tag, key = value_tag(value[0])
+                if tag == TAG_STRING:
+                    key = float(string_rank[value[0]])
+                elif tag == TAG_OBJECTID:
+                    key = float(objectid_rank[value[0].binary])
+                elif tag == TAG_OTHER:
+                    exact = False
+            tags.append(tag)
+            keys.append(key)
+        order = array('I', sorted(range(len(tags)), key=lambda row: (
+            bracket(tags[row]), keys[row], row)))
+        encoded = [value.encode('utf-8') for value in strings]
+        string_offsets = array('Q', [0])
+        for value in encoded:
+            string_offsets.append(string_offsets[-1] + len(value))
+        self._section(field + '.tags', tags, 'B')
+        self._section(field + '.keys', keys, 'd')
+        self._section(field + '.order', order, 'I')
+        self._section(field + '.strings.offsets', string_offsets, 'Q')
+        self._section(field + '.strings', b''.join(encoded), 'bytes')
+        self._section(field + '.objectids', b''.join(objectids), 'bytes')
+        return {'exact': exact, 'strings': len(strings), 'objectids': len(objectids)}
+
+    def close(self):
+        # finish the file and swap it in for the old one, in one go
+        self._section('documents.offsets', self._offsets, 'Q')
+        columns = {}
+        for field in list(self._columns):
+            columns[field] = self._column(field, self._columns.pop(field))
+        header = json.dumps({
+            'format': 1,
+            'namespace': self.namespace,
+            'count': self.count,
+            'exported_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'columns': columns,
+            'sections': self._sections,
+        }).encode('utf-8')
+        self._file.write(header)
+        self._file.write(TRAILER.pack(len(header), MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._temporary, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._temporary)
+
+
+def export(cursor, path, namespace):
+    # cursor gives raw BSON batches sorted by _id, find_raw_batches() does
+    writer = SnapshotWriter(path, namespace)
+    try:
+        for batch in cursor:
+            view, offset = memoryview(batch), 0
+            while offset < len(view):
+                size = struct.unpack_from('<i', view, offset)[0]
+                writer.add(view[offset:offset + size])
+                offset += size
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.count
+
+
+
+
+
+
+
+
+
+
+'''
+    Reading a snapshot.  Every section is a memoryview straight into
+    the mmap, nothing is copied or parsed up front, so opening a
+    snapshot is instant and the pages are shared with every other
+    process that has it open.
+
+    A column turns a value from a filter into its (tag, key) and
+    bisects the order for the rows in a range.  Strings and
+    ObjectIds that aren't in the snapshot get a key half way between
+    their neighbours, so ranges still start and stop in the right
+    place.
+'''
+class Column(object):
+    def __init__(self, name, sections, info):
+        self.name = name
+        self.exact = info['exact']
+        self.tags = sections[name + '.tags']
+        self.keys = sections[name + '.keys']
+        self.order = sections[name + '.order']
+        self._string_offsets = sections[name + '.strings.offsets']
+        self._strings = sections[name + '.strings']
+        self._objectids = sections[name + '.objectids']
+        self._string_count = info['strings']
+        self._objectid_count = info['objectids']
+
+    def string(self, rank):
+        start, end = self._string_offsets[rank], self._string_offsets[rank + 1]
+        return str(self._strings[start:end], 'utf-8')
+
+    def objectid(self, rank):
+        return bytes(self._objectids[rank * 12:rank * 12 + 12])
+
+    def sort_key(self, row):
+        return (bracket(self.tags[row]), self.keys[row])
+
+    def key_of(self, value):
+        tag, key = value_tag(value)
+        if tag == TAG_STRING:
+            key = self._rank(value, self._string_count, self.string)
+        elif tag == TAG_OBJECTID:
+            key = self._rank(value.binary, self._objectid_count, self.objectid)
+        elif tag == TAG_OTHER:
+            raise Unanswerable("can't compare %r" % (value,))
+        return tag, key
+
+    def _rank(self, value, count, entry):
+        rank = bisect.bisect_left(range(count), value, key=entry)
+        if rank < count and entry(rank) == value:
+            return float(rank)
+        return rank - 0.5
+
+    def rows(self, op, value):
+        # the slice of the order that matches {field: {op: value}}
+        tag, key = self.key_of(value)
+        tag = bracket(tag)
+        find = lambda target, side: side(self.order, target, key=self.sort_key)
+        if op == '$eq':
+            low = find((tag, key), bisect.bisect_left)
+            high = find((tag, key), bisect.bisect_right)
+        elif tag == TAG_NULL:
+            # null isn't less or greater than anything
+            raise Unanswerable("range on null")
+        elif op in ('$gt', '$gte'):
+            side = bisect.bisect_right if op == '$gt' else bisect.bisect_left
+            low = find((tag, key), side)
+            high = find((tag, math.inf), bisect.bisect_right)
+        elif op in ('$lt', '$lte'):
+            side = bisect.bisect_left if op == '$lt' else bisect.bisect_right
+            low = find((tag, -math.inf), bisect.bisect_left)
+            high = find((tag, key), side)
+        else:
+            raise Unanswerable(op)
+        return self.order[low:high]
+
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._map)
+        if len(view) < len(MAGIC) + TRAILER.size or view[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a snapshot" % path)
+        length, magic = TRAILER.unpack_from(view, len(view) - TRAILER.size)
+        if magic != MAGIC:
+            raise ValueError("%s is not a whole snapshot" % path)
+        end = len(view) - TRAILER.size
+        header = json.loads(bytes(view[end - length:end]))
+        self.namespace = header['namespace']
+        self.count = header['count']
+        self.exported_at = header['exported_at']
+        self.size = len(view)
+        sections = {}
+        for name, (offset, size, typecode) in header['sections'].items():
+            sections[name] = view[offset:offset + size]
+            if typecode != 'bytes':
+                sections[name] = sections[name].cast(typecode)
+        self.sections = sections
+        self.columns = {name: Column(name, sections, info)
+                        for name, info in header['columns'].items()}
+        self._offsets = sections['documents.offsets']
+        self._view = view
+
+    def document(self, row):
+        # one document, as the raw BSON bytes in the file
+        return self._view[self._offsets[row]:self._offsets[row + 1]]
+
+    def column(self, field):
+        if '.' in field or field.startswith('$'):
+            raise Unanswerable(field)
+        column = self.columns.get(field)
+        if column is not None and not column.exact:
+            raise Unanswerable("%s holds values we can't index" % field)
+        return column
+
+    def select(self, query):
+        # the rows matching query as a set, None meaning every row
+        rows = None
+        for part in conditions(query):
+            matched = self._matching(*part)
+            rows = matched if rows is None else rows & matched
+        return rows
+
+    def _matching(self, field, op, value):
+        column = self.column(field)
+        values = value if op == '$in' else [value]
+        if op == '$in':
+            op = '$eq'
+        matched = set()
+        for value in values:
+            if column is not None:
+                matched.update(column.rows(op, value))
+            elif value_tag(value)[0] == TAG_OTHER or (value is None and op != '$eq'):
+                raise Unanswerable("can't compare %r" % (value,))
+            elif value is None:
+                # nobody has this field, it's missing (null) everywhere
+                return set(range(self.count))
+        return matched
+
+    def sort_key(self, field):
+        # row -> something that sorts like MongoDB would, _id breaks ties
+        # (the rows are in _id order, so the row number is the _id order)
+        if field == '_id':
+            return lambda row: row
+        column = self.column(field)
+        if column is None:
+            return lambda row: (TAG_NULL, 0.0, row)
+        return lambda row: column.sort_key(row) + (row,)
+
+    def position(self, field, value, last_id):
+        # where a page token points, in sort_key() terms
+        ids = self.column('_id')
+        tag, key = ids.key_of(last_id)
+        target = (bracket(tag), key)
+        index = bisect.bisect_left(ids.order, target, key=ids.sort_key)
+        if index < self.count and ids.sort_key(ids.order[index]) == target:
+            row = ids.order[index]
+        else:
+            row = index - 0.5
+        if field == '_id':
+            return row
+        column = self.column(field)
+        if column is None:
+            return (TAG_NULL, 0.0, row)
+        tag, key = column.key_of(value)
+        return (bracket(tag), key, row)
+
+    def find(self, query, sort=('_id', 1), position=None, at_most=None):
+        # the rows to answer a find with, in order, at most at_most
+        # of them, after position (the (value, _id) of a page token)
+        field, direction = sort
+        rows = self.select(query)
+        if not self.count:
+            return []
+        key = self.sort_key(field)
+        after = None if position is None else self.position(field, *position)
+        if rows is None:
+            column = None if field == '_id' else self.column(field)
+            order = range(self.count) if column is None else column.order
+            low, high = 0, len(order)
+            if after is not None and direction == 1:
+                low = bisect.bisect_right(order, after, key=key)
+            elif after is not None:
+                high = bisect.bisect_left(order, after, key=key)
+            if at_most is not None and direction == 1:
+                high = min(high, low + at_most)
+            elif at_most is not None:
+                low = max(low, high - at_most)
+            picked = list(order[low:high])
+            return picked if direction == 1 else picked[::-1]
+        rows = sorted(rows, key=key, reverse=direction == -1)
+        if after is not None and direction == 1:
+            rows = [row for row in rows if key(row) > after]
+        elif after is not None:
+            rows = [row for row in rows if key(row) < after]
+        return rows if at_most is None else rows[:at_most]
+
+
+def conditions(query):
+    # {'age': {'$gte': 18, '$lt': 30}, 'class': 1} ->
+    # ('age', '$gte', 18), ('age', '$lt', 30), ('class', '$eq', 1)
+    for field, condition in query.items():
+        if field == '$and':
+            for part in condition:
+                for found in conditions(part):
+                    yield found
+        elif field.startswith('$'):
+            raise Unanswerable(field)
+        elif isinstance(condition, dict) and condition and \
+                all(op.startswith('$') for op in condition):
+            for op, value in condition.items():
+                if op not in ('$eq', '$in', '$lt', '$lte', '$gt', '$gte'):
+                    raise Unanswerable(op)
+                if op == '$in' and not isinstance(value, (list, tuple)):
+                    raise Unanswerable("$in needs a list")
+                yield field, op, value
+        else:
+            yield field, '$eq', condition
+
+
+def project(doc, projection):
+    # MongoDB's top level projections, {'name': 1} or {'ticket_number': 0}
+    if not projection:
+        return doc
+    if any('.' in field or field.startswith('$') for field in projection):
+        raise Unanswerable("projection on embedded fields")
+    including = any(value for field, value in projection.items() if field != '_id')
+    if including:
+        keep_id = projection.get('_id', 1)
+        return {field: value for field, value in doc.items()
+                if projection.get(field) or (field == '_id' and keep_id)}
+    return {field: value for field, value in doc.items()
+            if projection.get(field, 1)}
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+Section 2:  Exporting a snapshot
+"""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""""
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a collection to a snapshot file")
+    parser.add_argument('namespace', nargs='?', default='apitest.v1',
+                        help="database.collection to export (%(default)s)")
+    parser.add_argument('--dir',
+                        help="where the API looks for snapshots (SNAPSHOT_DIR)")
+    parser.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'),
+                        help="MongoDB to export from (MONGO_URI, or app.py's default)")
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="documents per batch read from MongoDB (%(default)s)")
+    options = parser.parse_args(argv)
+
+    if options.mongo_uri:
+        os.environ['MONGO_URI'] = options.mongo_uri
+    os.environ['MONGO_ENSURE_INDEXES'] = 'false'
+    import app as service
+
+    directory = options.dir or service.settings["SNAPSHOT_DIR"]
+    if not directory:
+        parser.error("say where to put it with --dir or SNAPSHOT_DIR")
+    os.makedirs(directory, exist_ok=True)
+    database, _, collection = options.namespace.partition('.')
+    _, col = service.create_mongo_session(database, collection)
+    path = snapshot_path(directory, options.namespace)
+    cursor = col.find_raw_batches({}, sort=[('_id', 1)], batch_size=options.batch_size)
+    count = export(cursor, path, options.namespace)
+    print("%d documents written to %s (%d bytes)" % (count, path, os.path.getsize(path)))
+    return 0
+
+
+def snapshot_path(directory, namespace):
+    return os.path.join(directory, namespace + '.snap')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+mongomock = pytest.importorskip('mongomock')
+
+
+@pytest.fixture
+def client():
+    # one in-memory MongoDB per test, in place of the real one
+    return mongomock.MongoClient()
+
+
+@pytest.fixture
+def service(client):
+    import app as service
+
+    service.mongo_registry.close()
+    service.mongo_registry.client_factory = lambda config: client
+    yield service
+    service.mongo_registry.close()
+    service.mongo_registry.client_factory = None
@@ -0,0 +1,79 @@
+import random
+
+import bson
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import bench_mongo
+import filter_engine
+from snapshot_mongo import Unanswerable
+
+SORTS = [('_id', 1), ('_id', -1), ('age', 1), ('fare_paid', -1), ('name', 1)]
+
+
+@pytest.fixture(scope='module')
+def checked(tmp_path_factory):
+    # made up passengers, one in ten with a missing field or a value of
+    # the wrong kind, and the engine over a snapshot of them
+    import mongomock
+
+    rng = random.Random(1)
+    col = mongomock.MongoClient().apitest.v1
+    col.insert_many([filter_engine.odd_passenger(rng, bench_mongo.passenger)
+                     if rng.random() < 0.1 else bench_mongo.passenger(rng)
+                     for _ in range(400)])
+    path = str(tmp_path_factory.mktemp('snapshots') / 'check.snap')
+    snapshot = filter_engine.exported(col, path, 'apitest.v1', raw=False)
+    return col, filter_engine.FilterEngine(snapshot)
+
+
+def mismatches(col, engine, queries, sorts):
+    found, answered = [], 0
+    for query in queries:
+        for sort in sorts:
+            try:
+                expected, got = filter_engine.check(col, engine, query, sort)
+            except Unanswerable:
+                continue
+            answered += 1
+            if expected != got:
+                found.append((query, sort))
+    return found, answered
+
+
+@pytest.mark.parametrize('query', filter_engine.CORPUS, ids=repr)
+def test_corpus_matches_mongodb(checked, query):
+    col, engine = checked
+    found, answered = mismatches(col, engine, [query], SORTS)
+    assert found == []
+
+
+def test_every_operator_is_covered(checked):
+    col, engine = checked
+    queries = [
+        {'$and': [{'age': {'$lt': 30}}, {'fare_paid': {'$gte': 10}}]},
+        {'class': {'$in': [1, 3]}},
+        {'ticket_number': {'$exists': False}},
+        {'survived': {'$exists': True}},
+        {'name': {'$regex': 'Mrs?\\.'}},
+        {'age': {'$gte': 'a'}},
+        {'name': {'$lt': 5}},
+        {'fare_paid': {'$in': ['unknown', 0, None]}},
+    ]
+    found, answered = mismatches(col, engine, queries, SORTS)
+    assert found == []
+    assert answered == len(queries) * len(SORTS)
+
+
+def test_random_filters_match_mongodb(checked):
+    col, engine = checked
+    rng = random.Random(2)
+    snapshot = engine.snapshot
+    fields = sorted(field for field in snapshot.columns if field != '_id')
+    samples = [bson.decode(snapshot.document(rng.randrange(snapshot.count)))
+               for _ in range(20)]
+    queries = [filter_engine.random_query(rng, fields, samples) for _ in range(300)]
+    found, answered = mismatches(col, engine, queries, [('_id', 1), ('age', -1)])
+    assert found == []
+    assert answered > 300
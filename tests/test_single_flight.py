@@ -0,0 +1,56 @@
+import threading
+import time
+
+import mongomock.collection
+
+
+class LazyCursor(object):
+    # like pymongo's, nothing is asked until the first next()
+    def __init__(self, cursor, queries):
+        self._cursor = cursor
+        self._queries = queries
+        self._asked = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self._asked:
+            self._asked = True
+            self._queries.append(1)
+            time.sleep(0.3)
+        return next(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+def test_concurrent_finds_share_one_lazy_query(service, client, monkeypatch):
+    client.apitest.v1.insert_many([{'name': 'n%d' % i, 'age': i} for i in range(20)])
+    queries = []
+    find = mongomock.collection.Collection.find
+    monkeypatch.setattr(mongomock.collection.Collection, 'find',
+                        lambda self, *args, **kwargs:
+                        LazyCursor(find(self, *args, **kwargs), queries))
+    flask_app = service.create_app({'RESULT_CACHE_ENABLED': False,
+                                    'FIND_RAW_BATCHES': False,
+                                    'SINGLE_FLIGHT_ENABLED': True,
+                                    'SNAPSHOT_DIR': ''})
+    answers = []
+
+    def get():
+        response = flask_app.test_client().get('/api/v1/mongo/find/all?limit=5')
+        answers.append((response.status_code, response.data))
+        response.close()
+
+    threads = [threading.Thread(target=get) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(queries) == 1
+    assert len(answers) == 10
+    assert set(status for status, _ in answers) == {200}
+    assert len(set(body for _, body in answers)) == 1
+    assert service.single_flight.stats()['in_flight'] == 0